@@ -0,0 +1,406 @@
+import collections
+import smtplib
+import threading
+import time
+from datetime import datetime
+from email.message import EmailMessage
+
+# Alerting on the readings as the subscriber ingests them. AlertEngine keeps a small state record per device
+# and updates it from every row (constant work per reading, no database polling); the rules that depend on
+# time passing rather than on a reading (device silent, box still empty, no opening by the deadline) are
+# checked over those records every check_interval seconds. Alerts go to a Notifier, which sends them from
+# a background thread in batches and rate-limited, so a slow or unreachable mail server never holds up
+# ingestion.
+
+# Default rules (None disables a rule)
+DEFAULT_BATTERY_BELOW = 20  # Percent
+DEFAULT_BATTERY_REARM = 5  # Percentage points above the threshold before a low battery alerts again
+DEFAULT_BOX_EMPTY_MINUTES = 60
+DEFAULT_LDR_OPEN_BY = "12:00"  # Local time by which the box should have been opened every day
+DEFAULT_SILENT_MINUTES = 30  # A device that sent nothing for this long has stopped reporting
+DEFAULT_CHECK_INTERVAL = 30.0  # Seconds between checks of the time-based rules
+
+# Default notifier settings
+DEFAULT_BATCH_DELAY = 30.0  # Seconds to collect further notifications before sending a batch
+DEFAULT_MAX_BATCH = 50  # Notifications per message
+DEFAULT_RATE_LIMIT = (10, 3600)  # At most this many sends per this many seconds
+DEFAULT_MAX_PENDING = 1000  # Notifications queued before the oldest are dropped
+DEFAULT_RETRY_DELAY = 60.0  # Seconds before a failed send is retried
+DEFAULT_MAX_ATTEMPTS = 5  # Sends of a notification before it is given up on
+
+# Alert kinds
+BATTERY_LOW = "battery_low"
+BOX_EMPTY = "box_empty"
+LDR_NOT_OPENED = "ldr_not_opened"
+SILENT = "silent"
+
+Alert = collections.namedtuple("Alert", ("kind", "device_owner", "at", "message"))
+
+
+class DeviceState:
+    """What the rules remember about one device."""
+
+    __slots__ = ("last_seen", "battery_low", "box_empty_since", "box_alerted", "last_opened_on", "ldr_alerted_on",
+                 "silent")
+
+    def __init__(self, last_seen):
+        self.last_seen = last_seen
+        self.battery_low = False  # Alerted, until the battery recovers
+        self.box_empty_since = None
+        self.box_alerted = False
+        self.last_opened_on = None  # Local date of the newest LDR opening
+        self.ldr_alerted_on = None  # Local date of the last missed opening alert
+        self.silent = False
+
+
+class AlertEngine:
+    """Evaluates the alert rules per device on the subscriber's rows and passes new alerts to `notify`.
+
+    Rows use the subscriber's insert layout (timestamp, reading..., device_owner). Every condition alerts
+    once and only alerts again after it cleared (battery recovered, box filled, a new day, device heard from).
+    """
+
+    def __init__(self, notify, battery_below=DEFAULT_BATTERY_BELOW, box_empty_minutes=DEFAULT_BOX_EMPTY_MINUTES,
+                 ldr_open_by=DEFAULT_LDR_OPEN_BY, silent_minutes=DEFAULT_SILENT_MINUTES,
+                 battery_rearm=DEFAULT_BATTERY_REARM, check_interval=DEFAULT_CHECK_INTERVAL, tz=None):
+        self.notify = notify  # Callable taking one Alert; must not block (see Notifier.submit)
+        self.battery_below = battery_below
+        self.battery_rearm = battery_rearm
+        self.box_empty_seconds = None if box_empty_minutes is None else box_empty_minutes * 60
+        self.ldr_open_by = None if ldr_open_by is None else datetime.strptime(ldr_open_by, "%H:%M").time()
+        self.silent_seconds = None if silent_minutes is None else silent_minutes * 60
+        self.check_interval = check_interval
+        self.tz = tz
+
+        self._devices = {}  # device_owner -> DeviceState
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+        # Counters
+        self.alerts = collections.Counter()
+        self.errors = 0
+
+    def start(self):
+        """Start the background thread that checks the time-based rules."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="alert-check", daemon=True)
+            self._thread.start()
+        return self
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def load(self, conn):
+        """Restore the device states from device_latest_state after a restart.
+
+        Conditions that already hold are treated as alerted, so a restart does not repeat them.
+        """
+        cur = conn.cursor()
+        try:
+            cur.execute("SELECT device_owner, last_seen, box_status, box_status_at, battery_percentage, "
+                        "last_ldr_open_at FROM device_latest_state;")
+            rows = cur.fetchall()
+        finally:
+            cur.close()
+        now = self._now()
+        with self._lock:
+            for device_owner, last_seen, box_status, box_status_at, battery_percentage, last_open in rows:
+                state = self._devices.setdefault(device_owner, DeviceState(self._local(last_seen)))
+                state.silent = self._is_silent(state, now)
+                state.battery_low = self._battery_low(battery_percentage)
+                if box_status == "empty" and box_status_at is not None:
+                    state.box_empty_since = self._local(box_status_at)
+                    state.box_alerted = self._box_overdue(state, now)
+                if last_open is not None:
+                    state.last_opened_on = self._local(last_open).date()
+                if self._ldr_overdue(state, now):
+                    state.ldr_alerted_on = now.date()
+        return len(rows)
+
+    def observe(self, table_name, values):
+        """Update the device's state with one row and raise the alerts it triggers."""
+        timestamp, device_owner = self._local(values[0]), values[-1]
+        alerts = []
+        with self._lock:
+            state = self._devices.get(device_owner)
+            if state is None:
+                state = self._devices[device_owner] = DeviceState(timestamp)
+            elif timestamp > state.last_seen:
+                state.last_seen = timestamp
+            state.silent = False
+
+            if table_name == "battery_data":
+                percentage = values[2]
+                if self._battery_low(percentage):
+                    if not state.battery_low:
+                        state.battery_low = True
+                        alerts.append(Alert(BATTERY_LOW, device_owner, timestamp,
+                                            f"Battery of {device_owner} is at {percentage}%"))
+                elif (percentage is not None and self.battery_below is not None
+                      and percentage >= self.battery_below + self.battery_rearm):
+                    state.battery_low = False
+
+            elif table_name == "empty_box_status":
+                if values[1] == "empty":
+                    if state.box_empty_since is None:
+                        state.box_empty_since = timestamp
+                    if not state.box_alerted and self._box_overdue(state, timestamp):
+                        state.box_alerted = True
+                        alerts.append(self._box_alert(device_owner, state, timestamp))
+                else:
+                    state.box_empty_since = None
+                    state.box_alerted = False
+
+            elif table_name == "ldr_data" and values[1] == 1:
+                if state.last_opened_on is None or timestamp.date() > state.last_opened_on:
+                    state.last_opened_on = timestamp.date()
+        self._raise(alerts)
+
+    def check(self, now=None):
+        """Check the time-based rules for every device; called periodically by the background thread."""
+        now = now or self._now()
+        alerts = []
+        with self._lock:
+            for device_owner, state in self._devices.items():
+                if not state.silent and self._is_silent(state, now):
+                    state.silent = True
+                    minutes = int((now - state.last_seen).total_seconds() // 60)
+                    alerts.append(Alert(SILENT, device_owner, now,
+                                        f"{device_owner} has not reported for {minutes} minutes "
+                                        f"(last seen {state.last_seen:%Y-%m-%d %H:%M})"))
+                if not state.box_alerted and self._box_overdue(state, now):
+                    state.box_alerted = True
+                    alerts.append(self._box_alert(device_owner, state, now))
+                if state.ldr_alerted_on != now.date() and self._ldr_overdue(state, now):
+                    state.ldr_alerted_on = now.date()
+                    alerts.append(Alert(LDR_NOT_OPENED, device_owner, now,
+                                        f"The box of {device_owner} has not been opened today "
+                                        f"(by {self.ldr_open_by:%H:%M})"))
+        self._raise(alerts)
+
+    def stats(self):
+        with self._lock:
+            devices = len(self._devices)
+        return {"devices": devices, "alerts": dict(self.alerts), "errors": self.errors}
+
+    def _raise(self, alerts):
+        for alert in alerts:
+            self.alerts[alert.kind] += 1
+            self.notify(alert)
+
+    def _battery_low(self, percentage):
+        return self.battery_below is not None and percentage is not None and percentage < self.battery_below
+
+    def _is_silent(self, state, now):
+        return self.silent_seconds is not None and (now - state.last_seen).total_seconds() >= self.silent_seconds
+
+    def _box_overdue(self, state, now):
+        return (self.box_empty_seconds is not None and state.box_empty_since is not None
+                and (now - state.box_empty_since).total_seconds() >= self.box_empty_seconds)
+
+    def _ldr_overdue(self, state, now):
+        return (self.ldr_open_by is not None and now.time() >= self.ldr_open_by
+                and (state.last_opened_on is None or state.last_opened_on < now.date()))
+
+    def _box_alert(self, device_owner, state, now):
+        minutes = int((now - state.box_empty_since).total_seconds() // 60)
+        return Alert(BOX_EMPTY, device_owner, now,
+                     f"The box of {device_owner} has been empty for {minutes} minutes "
+                     f"(since {state.box_empty_since:%Y-%m-%d %H:%M})")
+
+    def _now(self):
+        return datetime.now(self.tz) if self.tz is not None else datetime.now()
+
+    def _local(self, timestamp):
+        """Timestamps in the timezone of the rules (naive ones are taken to be in it already)."""
+        if self.tz is None:
+            return timestamp.replace(tzinfo=None)
+        if timestamp.tzinfo is None:
+            return self.tz.localize(timestamp)
+        return timestamp.astimezone(self.tz)
+
+    def _run(self):
+        while not self._stop.wait(self.check_interval):
+            try:
+                self.check()
+            except Exception as err:
+                self.errors += 1
+                print(f"Error while checking alert rules: {err}")
+
+
+class Notifier:
+    """Sends queued notifications from a background thread: in batches, rate-limited, retried on failure.
+
+    `send` is called with a list of up to `max_batch` notifications. Once the first notification is
+    queued, further ones are collected for `batch_delay` seconds, so a burst becomes one message. At most
+    rate_limit[0] sends happen per rate_limit[1] seconds; while limited, notifications keep queueing and
+    go out together with the next send. submit() never blocks.
+
+    A failed batch is retried before anything else, one notification at a time if it held several, so a
+    single undeliverable notification cannot hold up the others. A notification whose send failed
+    `max_attempts` times is given up on and passed to `dead_letter` (a callable taking the list).
+    """
+
+    def __init__(self, send, batch_delay=DEFAULT_BATCH_DELAY, max_batch=DEFAULT_MAX_BATCH,
+                 rate_limit=DEFAULT_RATE_LIMIT, max_pending=DEFAULT_MAX_PENDING, retry_delay=DEFAULT_RETRY_DELAY,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS, dead_letter=None):
+        self.send = send
+        self.batch_delay = batch_delay
+        self.max_batch = max_batch
+        self.rate_limit = rate_limit
+        self.max_pending = max_pending
+        self.retry_delay = retry_delay
+        self.max_attempts = max_attempts
+        self.dead_letter = dead_letter
+
+        self._pending = collections.deque()
+        self._retry = collections.deque()  # [batch, failed attempts] of failed sends, retried first
+        self._sent_at = collections.deque()  # Monotonic times of the sends within the rate limit window
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+        # Counters
+        self.submitted = 0
+        self.sent = 0
+        self.batches = 0
+        self.dropped = 0
+        self.errors = 0
+        self.failed = 0  # Notifications given up on after max_attempts
+
+    def start(self):
+        """Start the sender thread (once, however often it is called)."""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="notifier", daemon=True)
+                self._thread.start()
+        return self
+
+    def submit(self, notification):
+        """Queue one notification; the oldest are dropped beyond max_pending."""
+        with self._lock:
+            self._pending.append(notification)
+            self.submitted += 1
+            while len(self._pending) > self.max_pending:
+                self._pending.popleft()
+                self.dropped += 1
+        self._wakeup.set()
+
+    def flush(self):
+        """Send one batch of the queued notifications now, ignoring the rate limit. Returns the number sent."""
+        with self._lock:
+            if self._retry:
+                batch, attempts = self._retry.popleft()
+            else:
+                batch = [self._pending.popleft() for _ in range(min(self.max_batch, len(self._pending)))]
+                attempts = 0
+        if not batch:
+            return 0
+        try:
+            self.send(batch)
+        except Exception:
+            self.errors += 1
+            self._failed(batch, attempts + 1)
+            raise
+        self._sent_at.append(time.monotonic())
+        self.sent += len(batch)
+        self.batches += 1
+        return len(batch)
+
+    def close(self, timeout=None):
+        """Stop the sender thread and try once to send what is still queued."""
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        try:
+            while self.flush():
+                pass
+        except Exception as err:
+            print(f"Error while sending notifications at shutdown: {err}")
+
+    def stats(self):
+        with self._lock:
+            pending = len(self._pending) + sum(len(batch) for batch, _ in self._retry)
+        return {"pending": pending, "submitted": self.submitted, "sent": self.sent, "batches": self.batches,
+                "dropped": self.dropped, "errors": self.errors, "failed": self.failed}
+
+    def _failed(self, batch, attempts):
+        """Queue a failed batch for its retry, split into single notifications, or give up on it."""
+        if attempts >= self.max_attempts:
+            self.failed += len(batch)
+            print(f"Giving up on {len(batch)} notifications after {attempts} failed sends")
+            if self.dead_letter is not None:
+                try:
+                    self.dead_letter(batch)
+                except Exception as err:
+                    print(f"Error in the notification dead letter handler: {err}")
+            return
+        retries = [[batch, attempts]] if len(batch) == 1 else [[[notification], attempts] for notification in batch]
+        with self._lock:
+            self._retry.extendleft(reversed(retries))
+
+    def _rate_limit_wait(self):
+        """Seconds until the rate limit allows another send (0 if it does now)."""
+        limit, period = self.rate_limit
+        now = time.monotonic()
+        while self._sent_at and now - self._sent_at[0] >= period:
+            self._sent_at.popleft()
+        if len(self._sent_at) < limit:
+            return 0
+        return self._sent_at[0] + period - now
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wakeup.wait()
+            self._wakeup.clear()
+            # Collect the rest of the burst, then wait for the rate limit
+            if self._stop.wait(self.batch_delay):
+                return
+            while not self._stop.is_set() and (self._retry or self._pending):
+                delay = self._rate_limit_wait()
+                if delay > 0:
+                    if self._stop.wait(delay):
+                        return
+                    continue
+                try:
+                    self.flush()
+                except Exception as err:
+                    print(f"Error while sending notifications (retrying in {self.retry_delay:.0f} s): {err}")
+                    if self._stop.wait(self.retry_delay):
+                        return
+
+
+def format_alerts(alerts):
+    """Return (subject, body) of the email for a batch of alerts."""
+    if len(alerts) == 1:
+        subject = f"Sensor alert: {alerts[0].message}"
+    else:
+        owners = sorted({alert.device_owner for alert in alerts})
+        subject = f"{len(alerts)} sensor alerts for {', '.join(owners)}"
+    body = "\n".join(f"{alert.at:%Y-%m-%d %H:%M}  {alert.device_owner}  {alert.message}" for alert in alerts)
+    return subject, body + "\n"
+
+
+def smtp_sender(host, port, sender, recipients, username=None, password=None, starttls=False, timeout=30.0):
+    """Return a Notifier `send` function that mails each batch of alerts as one email over SMTP."""
+    def send(alerts):
+        subject, body = format_alerts(alerts)
+        message = EmailMessage()
+        message["Subject"] = subject
+        message["From"] = sender
+        message["To"] = ", ".join(recipients)
+        message.set_content(body)
+        with smtplib.SMTP(host, port, timeout=timeout) as smtp:
+            if starttls:
+                smtp.starttls()
+            if username:
+                smtp.login(username, password)
+            smtp.send_message(message)
+    return send
@@ -1,13 +1,28 @@
-from flask import Flask, render_template, request, redirect, url_for, session
+from flask import Flask, render_template, request, redirect, url_for, session, jsonify, g, Response
 import mysql.connector
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
-from io import BytesIO
-import base64
+import hashlib
+import numpy as np
 from datetime import datetime, timedelta
 import pytz
 import logging
+import time
+import atexit
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from flask_mail import Mail, Message
+from werkzeug.utils import secure_filename
+import db
+from plot_cache import PlotCache
+from downsample import downsample, MODES as DOWNSAMPLE_MODES
+import columnar
+from columnar import fetch_columns, convert_timezone
+import metrics
+import live_events
+import export
+import alerts
+import plot_renderer
 
 # Initialize Flask app
 app = Flask(__name__)
@@ -22,123 +37,460 @@ app.config['MAIL_USE_TLS'] = True
 app.config['MAIL_USERNAME'] = 'srbin@gmail.com'  # Replace with your email
 app.config['MAIL_PASSWORD'] = 'Srbin12345678'  # Replace with your email password
 
+app.config['MAIL_RATE_LIMIT'] = (5, 60)  # At most this many SMTP sessions per this many seconds
+
 mail = Mail(app)
 
+def deliver_mail(messages):
+    """Send a batch of queued messages over one SMTP connection (runs on the outbox thread)."""
+    with app.app_context(), mail.connect() as connection:
+        for msg in messages:
+            connection.send(msg)
+
+def undeliverable_mail(messages):
+    """Log the messages the outbox gave up on (dead letters)."""
+    for msg in messages:
+        logging.error(f"Giving up on mail {msg.subject!r} to {', '.join(msg.recipients)}")
+
+# Outgoing mail is queued and sent in the background, so a slow mail server never holds up a request
+mail_outbox = alerts.Notifier(deliver_mail, batch_delay=0, rate_limit=app.config['MAIL_RATE_LIMIT'],
+                              dead_letter=undeliverable_mail).start()
+
 @app.route('/send_mail', methods=['POST'])
 def send_mail():
     """Handle sending an email."""
     if 'username' not in session:
         return redirect(url_for('login'))
-    
-    try:
-        msg = Message("Hello from your Website",
-                      sender="@gmail.com",  # Replace with your email
-                      recipients=["recipient_email@gmail.com"])  # Replace with recipient's email
-        msg.body = "This is a test email sent from your Flask website!"
-        mail.send(msg)
-        return "Mail sent successfully!", 200
-    except Exception as e:
-        logging.error(f"Failed to send email: {e}")
-        return f"Failed to send email: {e}", 500
+
+    msg = Message("Hello from your Website",
+                  sender="@gmail.com",  # Replace with your email
+                  recipients=["recipient_email@gmail.com"])  # Replace with recipient's email
+    msg.body = "This is a test email sent from your Flask website!"
+    mail_outbox.submit(msg)
+    return "Mail queued for sending.", 202
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG,
                     format='%(asctime)s - %(levelname)s - %(message)s',
                     handlers=[logging.StreamHandler()])
 
-def connect_db():
-    """Connect to the database."""
-    return mysql.connector.connect(
-        host="localhost",
-        user="xxx",
-        password="xxx",
-        database="sensor_data"
-    )
-
-def generate_plot(data):
-    """Generate ultrasound plot."""
-    fig, ax = plt.subplots(figsize=(8, 4))  # Adjusted size (width, height)
-
-    # Assuming the second column is the timestamp and the third is the value
-    timestamps = [row[1] for row in data]  # Extract timestamps from the database
-    values = [float(row[2]) for row in data]  # Extract values from the database
-
-    # Get the timezone for Denmark (Copenhagen)
-    denmark_timezone = pytz.timezone('Europe/Copenhagen')
-
-    # Convert the timestamps to Denmark timezone
-    timestamps = [timestamp.replace(tzinfo=pytz.utc).astimezone(denmark_timezone) if timestamp.tzinfo is None else timestamp.astimezone(denmark_timezone) for timestamp in timestamps]
-
-    # Define the start and end time for the 24-hour period
-    today_start = datetime.now(denmark_timezone).replace(hour=0, minute=0, second=0, microsecond=0)
-    today_end = today_start + timedelta(days=1)
-
-    # Plot the data
-    ax.plot(timestamps, values, marker='o', linestyle='-', color='b')
-    ax.set_title('Ultrasound Sensor Data')
-    ax.set_xlabel('Time of Day')
-    ax.set_ylabel('Distance (cm)')
-
-    # Set proper date format for the x-axis to show only the time portion (HH:MM)
-    ax.xaxis.set_major_formatter(mdates.DateFormatter('%H:%M'))  # HH:MM format
-
-    # Set the x-axis limits to cover the entire 24-hour period
-    ax.set_xlim(today_start, today_end)
-
-    # Set the x-axis major locator to have ticks every 2 hours
-    ax.xaxis.set_major_locator(mdates.HourLocator(interval=2))  # Ticks every 2 hours
-
-    # Rotate date labels for better readability
-    plt.xticks(rotation=45)
-    plt.tight_layout()
-
-    # Save the plot to a BytesIO object
-    img = BytesIO()
-    fig.savefig(img, format='png')
-    img.seek(0)
+# Database connection pool settings
+app.config['DB_POOL_SIZE'] = 5
+app.config['DB_POOL_TIMEOUT'] = 5.0  # Seconds to wait for a free connection before failing the request
+
+# Shared connection pool (replaces opening a new connection per request)
+db.init_pool(
+    pool_size=app.config['DB_POOL_SIZE'],
+    timeout=app.config['DB_POOL_TIMEOUT'],
+    host="localhost",
+    user="xxx",
+    password="xxx",
+    database="sensor_data"
+)
+
+# Rendered plot cache limits
+app.config['PLOT_CACHE_MAX_ENTRIES'] = 128
+app.config['PLOT_CACHE_MAX_BYTES'] = 32 * 1024 * 1024
+
+# Cache of rendered PNG plots, keyed by plot type, device owner and data version
+plot_cache = PlotCache(max_entries=app.config['PLOT_CACHE_MAX_ENTRIES'],
+                       max_bytes=app.config['PLOT_CACHE_MAX_BYTES'])
+
+# Draw charts in the browser with Plotly from the JSON series API instead of rendering PNGs on the server
+app.config['CLIENT_SIDE_CHARTS'] = True
+
+# Run a page's independent queries concurrently, each on its own pooled connection (False: one after another)
+app.config['PARALLEL_QUERIES'] = True
+app.config['QUERY_WORKERS'] = app.config['DB_POOL_SIZE']  # Threads running page queries
+
+# Render plots in this many worker processes, off the request threads' GIL (0: render in the request thread)
+app.config['RENDER_PROCESSES'] = 2
+app.config['RENDER_MAX_TASKS_PER_CHILD'] = 200  # Replace a render worker after this many plots
+
+# Browsers may reuse a plot image this many seconds before revalidating it with its ETag
+app.config['PLOT_HTTP_MAX_AGE'] = 30
+
+# Reduce ultrasound series to about this many points before plotting (roughly the plot width in pixels)
+app.config['PLOT_MAX_POINTS'] = 800
+app.config['PLOT_DOWNSAMPLE_MODE'] = 'lttb'  # 'lttb' or 'minmax'
+app.config['API_MAX_POINTS'] = 5000  # Upper bound for the ?points= parameter of the JSON API
+
+# Resolution the dashboard reads ultrasound data at: 'minute' or 'hour' rollups, or 'raw' samples
+app.config['ULTRASOUND_RESOLUTION'] = 'minute'
+
+# Patient filter: the raw and rollup tables reference the devices table by integer id (the subquery is
+# resolved once, through its unique index, before the (device_id, timestamp/bucket) index is used)
+DEVICE_CONDITION = "device_id = (SELECT id FROM devices WHERE device_owner = %s)"
+
+# Where ultrasound series are read from, per resolution:
+# (table, time column, value expression, version expression, patient filter)
+ULTRASOUND_SOURCES = {
+    'raw': ("ultrasound_data", "timestamp", "value", "COUNT(*), MAX(id)", DEVICE_CONDITION),
+    'minute': ("ultrasound_rollup_minute", "bucket", "sum_value / sample_count", "COUNT(*), SUM(sample_count)",
+               DEVICE_CONDITION),
+    'hour': ("ultrasound_rollup_hour", "bucket", "sum_value / sample_count", "COUNT(*), SUM(sample_count)",
+             DEVICE_CONDITION),
+}
+
+# Timezone the dashboard shows times in
+DENMARK_TZ = pytz.timezone('Europe/Copenhagen')
+
+# Timezone of the stored timestamps (final_sub.py writes Copenhagen wall-clock time)
+app.config['DB_TIMEZONE'] = 'Europe/Copenhagen'
+
+# Bulk exports stream from their own database connection (outside the pool), at most this many at once
+app.config['EXPORT_MAX_CONCURRENT'] = 2
+app.config['EXPORT_FETCH_ROWS'] = export.DEFAULT_FETCH_ROWS  # Rows per round trip and per chunk sent
+
+# Flag a device on the fleet page when its newest reading is older than this (seconds)
+app.config['FLEET_STALE_SECONDS'] = 15 * 60
+
+# Log requests slower than this with their stage breakdown
+app.config['SLOW_REQUEST_LOG'] = True
+app.config['SLOW_REQUEST_SECONDS'] = 1.0
+
+# Live updates: new readings relayed by final_sub.py through the MQTT broker and streamed to open pages as
+# Server-Sent Events (each open page holds a worker thread, so run gunicorn with threaded or gevent workers)
+app.config['LIVE_EVENTS'] = True
+app.config['LIVE_EVENTS_BROKER'] = {
+    'host': "72.145.2.196",
+    'port': 8883,
+    'tls': True,
+    'username': "YOUR_USERNAME",
+    'password': "YOUR_PASSWORD",
+}
+app.config['LIVE_EVENTS_KEEPALIVE'] = 15.0  # Seconds between keepalive comments on an idle stream
+# Event batches not signed with this secret (final_sub.py's LIVE_EVENTS_SECRET) are dropped; the broker ACL should
+# let only the dashboard's user read live_events.EVENTS_TOPIC
+app.config['LIVE_EVENTS_SECRET'] = 'your_live_events_secret'  # Replace with the subscriber's secret
+
+# Prometheus metrics, served on /metrics
+registry = metrics.Registry()
+REQUESTS = registry.counter("dashboard_requests_total", "HTTP requests, by endpoint and status",
+                            ("endpoint", "status"))
+REQUEST_SECONDS = registry.histogram("dashboard_request_seconds", "Request duration, by endpoint", ("endpoint",))
+stage_timer = metrics.StageTimer(registry.histogram(
+    "dashboard_stage_seconds", "Time spent in each stage of a request (SQL statements, plot, encoding, template); "
+    "plot stages include plot_draw and png_encode, timed in the render process", ("endpoint", "stage")))
+registry.gauge("dashboard_db_pool_in_use", "Pooled database connections in use",
+               func=lambda: db.get_pool().stats()["in_use"])
+registry.gauge("dashboard_db_pool_wait_seconds", "Recent waits for a pooled connection", ("quantile",),
+               func=lambda: {q: db.get_pool().stats()[f"wait_p{q}"] for q in (50, 95, 99)})
+registry.counter("dashboard_db_pool_timeouts_total", "Requests that got no pooled connection in time",
+                 func=lambda: db.get_pool().stats()["timeouts"])
+registry.gauge("dashboard_plot_cache_bytes", "Size of the rendered plot cache", func=lambda: plot_cache.stats()["bytes"])
+registry.counter("dashboard_plot_cache_hits_total", "Rendered plot cache hits", func=lambda: plot_cache.stats()["hits"])
+registry.counter("dashboard_plot_cache_misses_total", "Rendered plot cache misses",
+                 func=lambda: plot_cache.stats()["misses"])
+registry.gauge("dashboard_live_subscribers", "Open live update streams",
+               func=lambda: _event_hub.stats()["subscribers"])
+registry.counter("dashboard_live_events_total", "Live events received from the subscriber",
+                 func=lambda: _event_hub.stats()["received"])
+registry.counter("dashboard_live_events_dropped_total", "Live events not delivered to slow viewers",
+                 func=lambda: _event_hub.stats()["dropped"])
+registry.counter("dashboard_live_event_batches_rejected_total", "Live event batches dropped as unsigned, forged or stale",
+                 func=lambda: _event_hub.stats()["invalid"])
+registry.counter("dashboard_mail_sent_total", "Emails sent from the outbox", func=lambda: mail_outbox.stats()["sent"])
+registry.counter("dashboard_mail_send_errors_total", "Failed outbox sends", func=lambda: mail_outbox.stats()["errors"])
+registry.counter("dashboard_mail_failed_total", "Emails given up on after repeated failed sends",
+                 func=lambda: mail_outbox.stats()["failed"])
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    stage_timer.begin(request.endpoint)
+
+@app.after_request
+def record_request(response):
+    elapsed = time.perf_counter() - g.get('request_started', time.perf_counter())
+    endpoint = request.endpoint or "unknown"
+    stages = stage_timer.end()
+    REQUESTS.inc(endpoint=endpoint, status=response.status_code)
+    REQUEST_SECONDS.observe(elapsed, endpoint=endpoint)
+    if app.config['SLOW_REQUEST_LOG'] and elapsed >= app.config['SLOW_REQUEST_SECONDS']:
+        breakdown = ", ".join(f"{name}={seconds * 1000:.0f}ms" for name, seconds in stages)
+        logging.warning(f"Slow request {request.method} {request.path} took {elapsed * 1000:.0f} ms: {breakdown or 'no timed stages'}")
+    return response
+
+# Thread pool for page queries and process pool for plot renders, created on first use
+_executor_lock = threading.Lock()
+_query_executor = None
+_render_executor = None
+
+# Running exports, bounded by EXPORT_MAX_CONCURRENT
+_export_slots = threading.BoundedSemaphore(app.config['EXPORT_MAX_CONCURRENT'])
+
+# Live event fan-out, connected to the broker on the first live update stream
+_event_hub = None
+
+def get_query_executor():
+    """Return the page query thread pool, or None when queries run serially."""
+    global _query_executor
+    if not app.config['PARALLEL_QUERIES'] or app.config['QUERY_WORKERS'] < 2:
+        return None
+    with _executor_lock:
+        if _query_executor is None:
+            _query_executor = ThreadPoolExecutor(max_workers=app.config['QUERY_WORKERS'],
+                                                 thread_name_prefix='page-query')
+        return _query_executor
+
+def get_render_executor():
+    """Return the plot render process pool, or None when plots are rendered in-process."""
+    global _render_executor
+    if app.config['RENDER_PROCESSES'] < 1:
+        return None
+    with _executor_lock:
+        if _render_executor is None:
+            # Spawn rather than fork: forking a process with live threads and DB connections is unsafe
+            _render_executor = ProcessPoolExecutor(max_workers=app.config['RENDER_PROCESSES'],
+                                                   mp_context=multiprocessing.get_context('spawn'),
+                                                   max_tasks_per_child=app.config['RENDER_MAX_TASKS_PER_CHILD'])
+        return _render_executor
+
+def get_event_hub():
+    """Return the live event hub, or None when live updates are disabled."""
+    global _event_hub
+    if not app.config['LIVE_EVENTS']:
+        return None
+    with _executor_lock:
+        if _event_hub is None:
+            broker = app.config['LIVE_EVENTS_BROKER']
+            _event_hub = live_events.EventHub(lambda: live_events.mqtt_client(**broker),
+                                              app.config['LIVE_EVENTS_SECRET']).start()
+        return _event_hub
+
+@atexit.register
+def shutdown_executors():
+    with _executor_lock:
+        for executor in (_query_executor, _render_executor):
+            if executor is not None:
+                executor.shutdown(wait=False, cancel_futures=True)
+        if _event_hub is not None:
+            _event_hub.stop()
+    mail_outbox.close(timeout=5.0)
+
+def render_plot(plot_function, *args):
+    """Run plot_renderer.render_ultrasound/render_ldr in the render process pool, or in this process if it is
+    disabled.
+
+    The function is pickled by reference, so it must live in a module the workers can import without this one
+    (importing app would start another DB pool and mail outbox in every worker). Returns the PNG; the stages
+    the render timed are recorded here, so they reach this process's metrics.
+    """
+    img, stages = _run_render(plot_function, *args)
+    for name, seconds in stages:
+        stage_timer.record(name, seconds)
     return img
 
-# Function to generate LDR-specific plot
-def generate_ldr_plot(data):
-    """Generate LDR plot."""
-    fig, ax = plt.subplots(figsize=(8, 4))  # Adjusted size (width, height)
-
-    # Get the timezone for Denmark (Copenhagen)
-    denmark_timezone = pytz.timezone('Europe/Copenhagen')
-
-    # Define the start and end time for the 24-hour period
-    today_start = datetime.now(denmark_timezone).replace(hour=0, minute=0, second=0, microsecond=0)
-    today_end = today_start + timedelta(days=1)
-
-    # Filter data for "1" values and convert timestamps to Denmark timezone
-    ldr_timestamps = [row[1] for row in data if float(row[2]) == 1]
-    ldr_timestamps = [timestamp.replace(tzinfo=pytz.utc).astimezone(denmark_timezone) if timestamp.tzinfo is None else timestamp.astimezone(denmark_timezone) for timestamp in ldr_timestamps]
+def _run_render(plot_function, *args):
+    global _render_executor
+    executor = get_render_executor()
+    if executor is not None:
+        try:
+            return executor.submit(plot_function, *args).result()
+        except BrokenProcessPool as e:
+            logging.error(f"Render process pool failed, rendering in-process from now on: {e}")
+            with _executor_lock:
+                app.config['RENDER_PROCESSES'] = 0
+                _render_executor = None
+    # Chart templates are per thread (plot_renderer), so in-process renders need no lock
+    return plot_function(*args)
+
+def run_page_queries(tasks):
+    """Run a page's independent queries and return {name: result}. Each task is a function of a connection.
+
+    With PARALLEL_QUERIES every task runs on the query thread pool with its own pooled connection, so the
+    page takes about as long as its slowest query (or plot); otherwise they run one after another on one
+    connection.
+    """
+    executor = get_query_executor()
+    if executor is None:
+        with db.connection() as conn:
+            return {name: task(conn) for name, task in tasks.items()}
+
+    context = stage_timer.context()
+
+    def run(task):
+        with stage_timer.attach(context), db.connection() as conn:
+            return task(conn)
+
+    futures = {name: executor.submit(run, task) for name, task in tasks.items()}
+    return {name: future.result() for name, future in futures.items()}
+
+def today_range():
+    """Return the half-open range [midnight, next midnight) for today, Copenhagen time."""
+    start = datetime.now(DENMARK_TZ).replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=None)
+    return start, start + timedelta(days=1)
+
+def last_day_range():
+    """Return the half-open range [now - 24 h, now) in Copenhagen time."""
+    end = datetime.now(DENMARK_TZ).replace(tzinfo=None)
+    return end - timedelta(days=1), end
+
+# Epoch used to send wall-clock timestamps to the browser (Plotly dates are timezone-naive)
+EPOCH = datetime(1970, 1, 1)
+
+def to_epoch_ms(timestamp):
+    """Convert a naive wall-clock datetime to milliseconds since the epoch."""
+    return int((timestamp.replace(tzinfo=None) - EPOCH).total_seconds() * 1000)
+
+def local_times(timestamps):
+    """Convert stored timestamps (datetime64 array) to Copenhagen wall-clock time, vectorized."""
+    return convert_timezone(timestamps, app.config['DB_TIMEZONE'], DENMARK_TZ)
+
+def generate_plot(timestamps, values, max_points=None, mode=None):
+    """Generate ultrasound plot from timestamp (datetime64) and distance arrays; returns (PNG, stage timings)."""
+    # Denmark wall-clock time, downsampled, over the entire 24-hour period
+    return plot_renderer.render_ultrasound(timestamps, values, today_range(),
+                                           app.config['DB_TIMEZONE'], DENMARK_TZ,
+                                           max_points or app.config['PLOT_MAX_POINTS'],
+                                           mode or app.config['PLOT_DOWNSAMPLE_MODE'])
 
-    # Plot dots at the times when the LDR is triggered
-    ax.plot(ldr_timestamps, [1]*len(ldr_timestamps), 'bo', label="LDR Openings")
-
-    # Set the x-axis to cover the entire 24-hour period
-    ax.set_xlim(today_start, today_end)
-    ax.set_ylim(0, 1.2)  # Space above the graph for better visualization
-    ax.set_title('LDR Data - Open Times')
-    ax.set_xlabel('Time of Day')
-    ax.set_ylabel('Detection')
-
-    # Set proper date format for the x-axis to show only the time portion (HH:MM)
-    ax.xaxis.set_major_formatter(mdates.DateFormatter('%H:%M'))  # HH:MM format
-
-    # Set the x-axis major locator to have ticks every 1 hour
-    ax.xaxis.set_major_locator(mdates.HourLocator(interval=1))  # Ticks every 1 hour
-
-    # Rotate date labels for better readability
-    plt.xticks(rotation=45)
-    plt.tight_layout()
-
-    # Save the plot to a BytesIO object
-    img = BytesIO()
-    fig.savefig(img, format='png')
-    img.seek(0)
-    return img
+# Function to generate LDR-specific plot
+def generate_ldr_plot(timestamps):
+    """Generate LDR plot from an array of opening times (datetime64); returns (PNG, stage timings)."""
+    # Dots at the times when the LDR is triggered (Denmark time), over the entire 24-hour period
+    return plot_renderer.render_ldr(timestamps, today_range(), app.config['DB_TIMEZONE'], DENMARK_TZ)
+
+def range_condition(start, end, patient_name=None, column="timestamp", patient_condition=DEVICE_CONDITION):
+    """Build the WHERE clause and parameters for a half-open time range, optionally for one patient."""
+    if patient_name is None:
+        return f"{column} >= %s AND {column} < %s", (start, end)
+    return f"{patient_condition} AND {column} >= %s AND {column} < %s", (patient_name, start, end)
+
+def data_version(conn, table, where, params, fingerprint="COUNT(*), MAX(id)"):
+    """Return a cheap fingerprint (by default row count and latest id) of the rows a plot is drawn from."""
+    cursor = conn.cursor()
+    cursor.execute(f"SELECT {fingerprint} FROM {table} WHERE {where};", params)
+    version = tuple(cursor.fetchone())
+    cursor.close()
+    return version
+
+def fetch_ultrasound(conn, start, end, patient_name=None, resolution=None):
+    """Fetch timestamp and distance arrays for [start, end), from the rollups unless raw resolution is asked for."""
+    table, time_column, value_expr, _, patient_condition = \
+        ULTRASOUND_SOURCES[resolution or app.config['ULTRASOUND_RESOLUTION']]
+    where, params = range_condition(start, end, patient_name, time_column, patient_condition)
+    return fetch_columns(conn, f"SELECT {time_column}, {value_expr} FROM {table} WHERE {where} ORDER BY {time_column};",
+                         params, ("datetime", "float"))
+
+def fetch_ldr_openings(conn, start, end, patient_name=None):
+    """Fetch the LDR opening times in [start, end) as a datetime64 array."""
+    where, params = range_condition(start, end, patient_name)
+    timestamps, = fetch_columns(conn, f"SELECT timestamp FROM ldr_data WHERE {where} AND value = 1 ORDER BY timestamp;",
+                                params, ("datetime",))
+    return timestamps
+
+def fetch_ldr_open_count(conn, day, patient_name=None):
+    """Return the number of LDR openings on the given day from the daily rollup."""
+    cursor = conn.cursor()
+    with stage_timer.stage('sql_ldr_open_count'):
+        if patient_name is None:
+            cursor.execute("SELECT COALESCE(SUM(open_count), 0) FROM ldr_rollup_day WHERE bucket = %s;", (day,))
+        else:
+            cursor.execute(f"SELECT COALESCE(SUM(open_count), 0) FROM ldr_rollup_day WHERE {DEVICE_CONDITION} AND bucket = %s;",
+                           (patient_name, day))
+        result = cursor.fetchone()
+    cursor.close()
+    return int(result[0]) if result and result[0] is not None else 0
+
+# Columns of the latest-row tables on the pages; the templates index the rows (row[1] is the timestamp), so
+# these keep the row shape independent of the columns the tables gain later
+BOX_STATUS_COLUMNS = "id, timestamp, status, distance"
+BATTERY_COLUMNS = "id, timestamp, voltage, percentage"
+
+def fetch_box_status(conn, patient_name=None, limit=10):
+    """Return the latest box status rows (id, timestamp, status, distance), optionally for one patient."""
+    cursor = conn.cursor()
+    with stage_timer.stage('sql_box_status'):
+        if patient_name is None:
+            cursor.execute(f"SELECT {BOX_STATUS_COLUMNS} FROM empty_box_status ORDER BY timestamp DESC LIMIT %s;",
+                           (limit,))
+        else:
+            cursor.execute(f"SELECT {BOX_STATUS_COLUMNS} FROM empty_box_status WHERE {DEVICE_CONDITION} "
+                           "ORDER BY timestamp DESC LIMIT %s;",
+                           (patient_name, limit))
+        rows = cursor.fetchall()
+    cursor.close()
+    return rows
+
+def fetch_battery(conn, patient_name=None, limit=1):
+    """Return the latest battery rows (id, timestamp, voltage, percentage), optionally for one patient."""
+    cursor = conn.cursor()
+    with stage_timer.stage('sql_battery'):
+        if patient_name is None:
+            cursor.execute(f"SELECT {BATTERY_COLUMNS} FROM battery_data ORDER BY timestamp DESC LIMIT %s;", (limit,))
+        else:
+            cursor.execute(f"SELECT {BATTERY_COLUMNS} FROM battery_data WHERE {DEVICE_CONDITION} "
+                           "ORDER BY timestamp DESC LIMIT %s;",
+                           (patient_name, limit))
+        rows = cursor.fetchall()
+    cursor.close()
+    return rows
+
+def fetch_fleet(conn):
+    """Fetch the latest state of every device, one row per device from device_latest_state."""
+    cursor = conn.cursor(dictionary=True)
+    cursor.execute("SELECT device_owner, last_seen, distance, box_status, battery_percentage, last_ldr_open_at "
+                   "FROM device_latest_state ORDER BY device_owner;")
+    devices = cursor.fetchall()
+    cursor.close()
+    return devices
+
+def ultrasound_plot_version(conn, patient_name=None):
+    """Return (version, latest data time) of the ultrasound plot for the last 24 hours."""
+    day_start, day_end = last_day_range()
+    resolution = app.config['ULTRASOUND_RESOLUTION']
+    table, time_column, _, fingerprint, patient_condition = ULTRASOUND_SOURCES[resolution]
+    where, params = range_condition(day_start, day_end, patient_name, time_column, patient_condition)
+    with stage_timer.stage('sql_ultrasound_version'):
+        state = data_version(conn, table, where, params, f"MAX({time_column}), {fingerprint}")
+    # Today's date is part of the version because the x-axis always shows the current day
+    return (today_range()[0].date(), resolution) + state, state[0]
+
+def render_ultrasound_png(conn, patient_name=None):
+    """Render the ultrasound plot for the last 24 hours as PNG bytes."""
+    day_start, day_end = last_day_range()
+    with stage_timer.stage('sql_ultrasound_series'):
+        timestamps, values = fetch_ultrasound(conn, day_start, day_end, patient_name)
+    with stage_timer.stage('plot_ultrasound'):
+        img = render_plot(plot_renderer.render_ultrasound, timestamps, values, today_range(),
+                          app.config['DB_TIMEZONE'], DENMARK_TZ,
+                          app.config['PLOT_MAX_POINTS'], app.config['PLOT_DOWNSAMPLE_MODE'])
+    return img.getvalue()
+
+def ldr_plot_version(conn, patient_name=None):
+    """Return (version, latest data time) of today's LDR plot."""
+    today_start, today_end = today_range()
+    where, params = range_condition(today_start, today_end, patient_name)
+    with stage_timer.stage('sql_ldr_version'):
+        state = data_version(conn, "ldr_data", where, params, "MAX(timestamp), COUNT(*), MAX(id)")
+    return (today_start.date(),) + state, state[0]
+
+def render_ldr_png(conn, patient_name=None):
+    """Render today's LDR plot as PNG bytes."""
+    today_start, today_end = today_range()
+    with stage_timer.stage('sql_ldr_openings'):
+        timestamps = fetch_ldr_openings(conn, today_start, today_end, patient_name)
+    with stage_timer.stage('plot_ldr'):
+        img = render_plot(plot_renderer.render_ldr, timestamps, today_range(),
+                          app.config['DB_TIMEZONE'], DENMARK_TZ)
+    return img.getvalue()
+
+# Server-rendered plots: plot type -> (version function, render function)
+PLOTS = {
+    'ultrasound': (ultrasound_plot_version, render_ultrasound_png),
+    'ldr': (ldr_plot_version, render_ldr_png),
+}
+
+def plot_etag(plot_type, patient_name, version):
+    """Strong ETag for one version of a plot."""
+    return hashlib.sha1(repr((plot_type, patient_name, version)).encode('utf-8')).hexdigest()[:20]
+
+def get_plot_png(conn, plot_type, patient_name, version):
+    """Return the PNG for this version of a plot, re-rendering only when the data changed."""
+    render = PLOTS[plot_type][1]
+    return plot_cache.get_or_render(plot_type, patient_name, version, lambda: render(conn, patient_name))
 
 # Route for login page
 @app.route('/login', methods=['GET', 'POST'])
@@ -179,48 +531,63 @@ def home():
         return redirect(url_for('login'))
 
     try:
-        logging.debug("Connecting to database...")
-        conn = connect_db()
-        cursor = conn.cursor()
-
-        # Fetch ultrasound data for the last 24 hours
-        cursor.execute("SELECT * FROM ultrasound_data WHERE timestamp > NOW() - INTERVAL 1 DAY ORDER BY timestamp DESC;")
-        ultrasound_data = cursor.fetchall()
+        today_start = today_range()[0]
+        tasks = {
+            # Count of LDR openings today, from the daily rollup
+            'ldr_open_count': lambda conn: fetch_ldr_open_count(conn, today_start.date()),
+            # Fetch the box status (empty/full) and limit to 10 latest records
+            'empty_box_data': lambda conn: fetch_box_status(conn, limit=10),
+            # Fetch the most recent battery data
+            'battery_data': lambda conn: fetch_battery(conn, limit=1),
+        }
+        logging.debug("Running dashboard queries...")
+        results = run_page_queries(tasks)
+        logging.debug(f"Fetched empty_box_data: {results['empty_box_data']}")  # Add debug log for box status data
+
+        # Pass the data to the template (server-rendered plots are loaded from /plot/... by the browser)
+        with stage_timer.stage('template'):
+            return render_template('index.html', 
+                                   client_side_charts=app.config['CLIENT_SIDE_CHARTS'],
+                                   live_events=app.config['LIVE_EVENTS'],
+                                   ldr_open_count=results['ldr_open_count'],
+                                   empty_box_data=results['empty_box_data'],
+                                   battery_data=results['battery_data'])  # Pass battery data here
 
-        # Fetch LDR data for today
-        cursor.execute("SELECT * FROM ldr_data WHERE DATE(timestamp) = CURDATE();")
-        ldr_data = cursor.fetchall()
-
-        cursor.execute("SELECT COUNT(*) FROM ldr_data WHERE DATE(timestamp) = CURDATE() AND value = 1;")
-        ldr_open_count_result = cursor.fetchone()
-        ldr_open_count = ldr_open_count_result[0] if ldr_open_count_result and ldr_open_count_result[0] is not None else 0
-
-        # Fetch the box status (empty/full) and limit to 10 latest records
-        cursor.execute("SELECT * FROM empty_box_status ORDER BY timestamp DESC LIMIT 10;")
-        empty_box_data = cursor.fetchall()
-        logging.debug(f"Fetched empty_box_data: {empty_box_data}")  # Add debug log for box status data
+    except mysql.connector.Error as err:
+        logging.error(f"Database Error: {err}")
+        return f"Error: {err}"
 
-        # Fetch the most recent battery data
-        cursor.execute("SELECT * FROM battery_data ORDER BY timestamp DESC LIMIT 1;")
-        battery_data = cursor.fetchall()
+    except Exception as e:
+        logging.error(f"Error: {e}")
+        return f"Error: {e}"
 
-        conn.close()
 
-        # Generate the plots with the fetched data
-        ultrasound_plot = generate_plot(ultrasound_data)
-        ldr_plot = generate_ldr_plot(ldr_data)
+@app.route('/patient/<patient_name>')
+def patient_data(patient_name):
+    if 'username' not in session:
+        return redirect(url_for('login'))
 
-        # Convert the plots to base64 for embedding in HTML
-        ultrasound_plot_b64 = base64.b64encode(ultrasound_plot.getvalue()).decode('utf-8')
-        ldr_plot_b64 = base64.b64encode(ldr_plot.getvalue()).decode('utf-8')
+    try:
+        today_start = today_range()[0]
+        tasks = {
+            # Fetch the count of LDR openings (value = 1) for today, from the daily rollup
+            'ldr_open_count': lambda conn: fetch_ldr_open_count(conn, today_start.date(), patient_name),
+            # Fetch the latest battery data for the specific patient
+            'battery_data': lambda conn: fetch_battery(conn, patient_name, limit=10),
+            # Fetch box status (empty/full) for the specific patient
+            'empty_box_status': lambda conn: fetch_box_status(conn, patient_name, limit=10),
+        }
+        results = run_page_queries(tasks)
 
-        # Pass the base64-encoded plots and data to the template
-        return render_template('index.html', 
-                               ultrasound_plot=ultrasound_plot_b64, 
-                               ldr_plot=ldr_plot_b64, 
-                               ldr_open_count=ldr_open_count,
-                               empty_box_data=empty_box_data,
-                               battery_data=battery_data)  # Pass battery data here
+        # Pass the data to the template
+        with stage_timer.stage('template'):
+            return render_template('patient_data.html', 
+                                   patient_name=patient_name,
+                                   client_side_charts=app.config['CLIENT_SIDE_CHARTS'],
+                                   live_events=app.config['LIVE_EVENTS'],
+                                   ldr_open_count=results['ldr_open_count'],
+                                   battery_data=results['battery_data'],  # Pass the battery data as a list of records
+                                   empty_box_status=results['empty_box_status'])  # Corrected name
 
     except mysql.connector.Error as err:
         logging.error(f"Database Error: {err}")
@@ -231,63 +598,237 @@ def home():
         return f"Error: {e}"
 
 
-@app.route('/patient/<patient_name>')
-def patient_data(patient_name):
+@app.route('/fleet')
+def fleet():
+    """List every device's latest state, flagging devices that have not reported for FLEET_STALE_SECONDS."""
     if 'username' not in session:
         return redirect(url_for('login'))
 
     try:
-        # Connect to the database
-        conn = connect_db()
-        cursor = conn.cursor()
+        with db.connection() as conn, stage_timer.stage('sql_fleet'):
+            devices = fetch_fleet(conn)
 
-        # Fetch ultrasound data for the last 24 hours for the specific patient
-        cursor.execute("""SELECT * FROM ultrasound_data WHERE device_owner = %s AND timestamp > NOW() - INTERVAL 1 DAY ORDER BY timestamp DESC;""", (patient_name,))
-        ultrasound_data = cursor.fetchall()
+        # last_seen is naive wall-clock time in DB_TIMEZONE
+        now = datetime.now(pytz.timezone(app.config['DB_TIMEZONE'])).replace(tzinfo=None)
+        stale_after = timedelta(seconds=app.config['FLEET_STALE_SECONDS'])
+        for device in devices:
+            device['stale'] = now - device['last_seen'] > stale_after
 
-        # Fetch LDR data for today for the specific patient
-        cursor.execute("""SELECT * FROM ldr_data WHERE device_owner = %s AND DATE(timestamp) = CURDATE();""", (patient_name,))
-        ldr_data = cursor.fetchall()
+        with stage_timer.stage('template'):
+            return render_template('fleet.html',
+                                   devices=devices,
+                                   stale_count=sum(device['stale'] for device in devices),
+                                   stale_minutes=app.config['FLEET_STALE_SECONDS'] // 60)
+
+    except mysql.connector.Error as err:
+        logging.error(f"Database Error: {err}")
+        return f"Error: {err}"
 
-        # Fetch the count of LDR openings (value = 1) for today
-        cursor.execute("""SELECT COUNT(*) FROM ldr_data WHERE device_owner = %s AND DATE(timestamp) = CURDATE() AND value = 1;""", (patient_name,))
-        ldr_open_count_result = cursor.fetchone()
-        ldr_open_count = ldr_open_count_result[0] if ldr_open_count_result and ldr_open_count_result[0] is not None else 0
 
-        # Fetch all battery data for the specific patient
-        cursor.execute("""SELECT * FROM battery_data WHERE device_owner = %s ORDER BY timestamp DESC LIMIT 10;""", (patient_name,))
-        battery_data = cursor.fetchall()  # Fetch multiple records
+@app.route('/plot/<any(ultrasound, ldr):plot_type>.png')
+@app.route('/plot/<patient_name>/<any(ultrasound, ldr):plot_type>.png')
+def plot_image(plot_type, patient_name=None):
+    """Serve a server-rendered plot as a PNG.
+
+    The ETag comes from the plot's data version and Last-Modified from its latest reading, so a browser
+    revalidating an unchanged plot costs one cheap version query and a 304, without rendering.
+    """
+    if 'username' not in session:
+        return "Not logged in", 401
 
-        # Fetch box status (empty/full) for the specific patient
-        cursor.execute("""SELECT * FROM empty_box_status WHERE device_owner = %s ORDER BY timestamp DESC LIMIT 10;""", (patient_name,))
-        empty_box_status = cursor.fetchall()  # This will fetch all records
+    plot_version = PLOTS[plot_type][0]
+    try:
+        with db.connection() as conn:
+            version, latest = plot_version(conn, patient_name)
+            etag = plot_etag(plot_type, patient_name, version)
+            if request.if_none_match.contains(etag):
+                response = Response(status=304)
+            else:
+                response = Response(get_plot_png(conn, plot_type, patient_name, version), mimetype='image/png')
 
-        conn.close()
+    except mysql.connector.Error as err:
+        logging.error(f"Database Error: {err}")
+        return f"Error: {err}", 500
+
+    response.set_etag(etag)
+    if latest is not None:
+        # Stored times are naive wall-clock times in DB_TIMEZONE; HTTP dates are UTC
+        response.last_modified = pytz.timezone(app.config['DB_TIMEZONE']).localize(latest).astimezone(pytz.utc)
+    response.cache_control.private = True  # Patient data: never in shared caches
+    response.cache_control.max_age = app.config['PLOT_HTTP_MAX_AGE']
+    return response
+
+
+@app.route('/export/<any(ultrasound, ldr, box, battery):series>.<any(csv, ndjson):fmt>')
+@app.route('/export/<patient_name>/<any(ultrasound, ldr, box, battery):series>.<any(csv, ndjson):fmt>')
+def export_data(series, fmt, patient_name=None):
+    """Stream one series for a date range as CSV or NDJSON.
+
+    Query parameters: start and end as ISO dates or date-times in Copenhagen time (end is exclusive and
+    defaults to now). Rows are sent in chunks as they are read, so memory stays flat however long the
+    range is and the first bytes go out straight away.
+    """
+    if 'username' not in session:
+        return "Not logged in", 401
 
-        # Generate the plots with the fetched data
-        ultrasound_plot = generate_plot(ultrasound_data)
-        ldr_plot = generate_ldr_plot(ldr_data)
+    try:
+        start = parse_export_time(request.args['start'])
+        end = parse_export_time(request.args['end']) if 'end' in request.args else \
+            datetime.now(DENMARK_TZ).replace(tzinfo=None)
+    except (KeyError, ValueError):
+        return "Give start (and optionally end) as ISO dates, for example ?start=2026-01-01&end=2026-02-01", 400
+    if start >= end:
+        return "start must be before end", 400
+
+    if not _export_slots.acquire(blocking=False):
+        return "Too many exports running, try again later", 429
+    # The response releases the slot and closes the stream once it is handed them; until then, any way out
+    # of this function does
+    stream = None
+    handed_over = False
+    try:
+        where, params = range_condition(start, end, patient_name)
+        try:
+            stream = export.QueryStream(db.connect(), export.export_query(series, where), params,
+                                        app.config['EXPORT_FETCH_ROWS'])
+        except mysql.connector.Error as err:
+            logging.error(f"Database Error: {err}")
+            return f"Error: {err}", 500
+
+        # Called when the response is finished or the client went away
+        def finished():
+            stream.close()
+            _export_slots.release()
+            logging.info(f"Exported {stream.rows} {series} rows ({patient_name or 'all devices'}, {start} to {end})")
+
+        filename = secure_filename(f"{series}-{patient_name or 'all'}-{start:%Y%m%d}-{end:%Y%m%d}.{fmt}")
+        response = Response(export.CHUNKS[fmt](stream, series), mimetype=export.FORMATS[fmt])
+        response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+        response.call_on_close(finished)
+        handed_over = True
+        return response
+    finally:
+        if not handed_over:
+            if stream is not None:
+                stream.close()
+            _export_slots.release()
+
+def parse_export_time(value):
+    """Parse an ISO date or date-time into naive Copenhagen wall-clock time, as the tables store it."""
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(DENMARK_TZ).replace(tzinfo=None)
+    return parsed
+
+
+@app.route('/events')
+@app.route('/events/<patient_name>')
+def live_updates(patient_name=None):
+    """Stream new readings (of all devices, or of one patient) as Server-Sent Events.
+
+    The pages append the events to their charts and tables, so an open dashboard costs one queued batch
+    per ingested batch of readings instead of a full page load per refresh.
+    """
+    if 'username' not in session:
+        return "Not logged in", 401
+    hub = get_event_hub()
+    if hub is None:
+        return "Live updates are disabled", 404
+
+    response = Response(live_events.stream(hub, patient_name, app.config['LIVE_EVENTS_KEEPALIVE']),
+                        mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # Keep nginx from buffering the stream
+    return response
+
+
+@app.route('/api/ultrasound')
+@app.route('/api/patient/<patient_name>/ultrasound')
+def api_ultrasound(patient_name=None):
+    """Return the last 24 hours of ultrasound readings as columnar arrays.
+
+    Optional query parameters: points (target number of points, 0 for all), mode (lttb or minmax) and
+    resolution (minute or hour rollups, or raw samples).
+    """
+    if 'username' not in session:
+        return jsonify(error="Not logged in"), 401
 
-        # Convert the plots to base64 for embedding in HTML
-        ultrasound_plot_b64 = base64.b64encode(ultrasound_plot.getvalue()).decode('utf-8')
-        ldr_plot_b64 = base64.b64encode(ldr_plot.getvalue()).decode('utf-8')
+    points = request.args.get('points', app.config['PLOT_MAX_POINTS'], type=int)
+    mode = request.args.get('mode', app.config['PLOT_DOWNSAMPLE_MODE'])
+    resolution = request.args.get('resolution', app.config['ULTRASOUND_RESOLUTION'])
+    if points is None or points < 0 or mode not in DOWNSAMPLE_MODES or resolution not in ULTRASOUND_SOURCES:
+        return jsonify(error="Invalid points, mode or resolution"), 400
+    points = min(points, app.config['API_MAX_POINTS'])
 
-        # Pass the data to the template
-        return render_template('patient_data.html', 
-                               patient_name=patient_name,
-                               ultrasound_plot=ultrasound_plot_b64, 
-                               ldr_plot=ldr_plot_b64, 
-                               ldr_open_count=ldr_open_count,
-                               battery_data=battery_data,  # Pass the battery data as a list of records
-                               empty_box_status=empty_box_status)  # Corrected name
+    try:
+        day_start, day_end = last_day_range()
+        today_start, today_end = today_range()
+        with db.connection() as conn, stage_timer.stage('sql_ultrasound_series'):
+            timestamps, values = fetch_ultrasound(conn, day_start, day_end, patient_name, resolution)
+
+        timestamps = local_times(timestamps)
+        if points and len(timestamps) > points:
+            timestamps, values = downsample(timestamps, values, points, mode)
+
+        return jsonify(series="ultrasound",
+                       patient=patient_name,
+                       resolution=resolution,
+                       start=to_epoch_ms(today_start),
+                       end=to_epoch_ms(today_end),
+                       t=columnar.to_epoch_ms(timestamps).tolist(),  # Milliseconds since the epoch, Copenhagen wall time
+                       v=np.round(values.astype(np.float64), 2).tolist())  # Distance in cm
 
     except mysql.connector.Error as err:
         logging.error(f"Database Error: {err}")
-        return f"Error: {err}"
+        return jsonify(error=str(err)), 500
 
-    except Exception as e:
-        logging.error(f"Error: {e}")
-        return f"Error: {e}"
+
+@app.route('/api/ldr')
+@app.route('/api/patient/<patient_name>/ldr')
+def api_ldr(patient_name=None):
+    """Return today's LDR openings as an array of timestamps."""
+    if 'username' not in session:
+        return jsonify(error="Not logged in"), 401
+
+    try:
+        today_start, today_end = today_range()
+        with db.connection() as conn, stage_timer.stage('sql_ldr_openings'):
+            timestamps = fetch_ldr_openings(conn, today_start, today_end, patient_name)
+
+        return jsonify(series="ldr",
+                       patient=patient_name,
+                       start=to_epoch_ms(today_start),
+                       end=to_epoch_ms(today_end),
+                       t=columnar.to_epoch_ms(local_times(timestamps)).tolist())
+
+    except mysql.connector.Error as err:
+        logging.error(f"Database Error: {err}")
+        return jsonify(error=str(err)), 500
+
+
+@app.route('/pool_stats')
+def pool_stats():
+    """Report connection pool usage and wait times."""
+    if 'username' not in session:
+        return redirect(url_for('login'))
+    return jsonify(db.get_pool().stats())
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Expose request, stage, pool and cache metrics in the Prometheus text format.
+
+    Not behind the login, since scrapers cannot log in; it carries no patient data.
+    """
+    return Response(registry.render(), mimetype=None, content_type=metrics.CONTENT_TYPE)
+
+
+@app.route('/cache_stats')
+def cache_stats():
+    """Report rendered plot cache size and hit/miss statistics."""
+    if 'username' not in session:
+        return redirect(url_for('login'))
+    return jsonify(plot_cache.stats())
 
 
 if __name__ == "__main__":
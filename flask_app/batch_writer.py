@@ -0,0 +1,214 @@
+import threading
+import time
+
+# INSERT statements for every table the subscriber writes to (rows end with the device id, see devices.py)
+INSERT_QUERIES = {
+    "ldr_data": "INSERT INTO ldr_data (timestamp, value, device_id) VALUES (%s, %s, %s);",
+    "ultrasound_data": "INSERT INTO ultrasound_data (timestamp, value, device_id) VALUES (%s, %s, %s);",
+    "empty_box_status": "INSERT INTO empty_box_status (timestamp, status, distance, device_id) VALUES (%s, %s, %s, %s);",
+    "battery_data": "INSERT INTO battery_data (timestamp, voltage, percentage, device_id) VALUES (%s, %s, %s, %s);",
+}
+
+# Default flush thresholds
+DEFAULT_MAX_ROWS = 500  # Flush once this many rows are buffered in total
+DEFAULT_MAX_DELAY = 2.0  # Flush at least this often (seconds) while rows are buffered
+DEFAULT_MAX_ATTEMPTS = 5  # Flushes a row takes part in before it is dropped, while the database fails
+
+
+class BatchWriter:
+    """Buffer rows per table and write them with one executemany/commit per flush.
+
+    Extra sources (for example rollup aggregators) can be attached with add_source(). A source has a
+    `queries` dict of table -> statement, a pending() method and a drain() method returning
+    {table: rows}; its rows are written in the same transaction as the buffered raw rows.
+
+    When a flush fails, its transaction is rolled back and its rows (including the drained source rows,
+    whose upserts all merge into the stored rows) are written again with the next flush. Rows that failed
+    `max_attempts` flushes are dropped and counted in rows_dropped.
+
+    `on_flush(rows, seconds, error)` is called after every flush that had rows to write; `error` is the
+    exception if the flush failed, otherwise None.
+    """
+
+    def __init__(self, connection, max_rows=DEFAULT_MAX_ROWS, max_delay=DEFAULT_MAX_DELAY, queries=None,
+                 on_flush=None, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self.connection = connection  # Callable returning a context manager that yields a DB-API connection
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.queries = dict(queries or INSERT_QUERIES)
+        self.on_flush = on_flush
+        self.max_attempts = max_attempts
+
+        self._buffers = {table: [] for table in self.queries}
+        self._pending = 0
+        self._oldest = None  # time.monotonic() of the oldest buffered row
+        self._last_flush = time.monotonic()
+        self._sources = []
+        self._retry = []  # [batches, failed attempts] of earlier flushes that failed, oldest first
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+        # Counters
+        self.flush_count = 0
+        self.rows_written = 0
+        self.rows_failed = 0  # Rows in failed flushes (each attempt counts)
+        self.rows_dropped = 0  # Rows given up after max_attempts failed flushes
+        self.flush_errors = 0
+        self.last_flush_rows = 0
+        self.max_flush_rows = 0
+        self.last_flush_seconds = 0.0
+        self.total_flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+
+    def start(self):
+        """Start the background thread that enforces the time threshold."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="batch-writer", daemon=True)
+            self._thread.start()
+        return self
+
+    def add_source(self, source):
+        """Attach a pre-aggregating source whose rows are written on every flush."""
+        with self._lock:
+            self.queries.update(source.queries)
+            for table in source.queries:
+                self._buffers.setdefault(table, [])
+            self._sources.append(source)
+        return source
+
+    def add(self, table_name, values):
+        """Buffer one row; flushes synchronously when the size threshold is hit."""
+        if table_name not in self.queries:
+            raise ValueError(f"No insert query for table '{table_name}'")
+        with self._lock:
+            self._buffers[table_name].append(values)
+            self._pending += 1
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            full = self._pending >= self.max_rows
+        if full:
+            self.flush()
+
+    def flush(self):
+        """Write out every buffered row, one executemany per table and a single commit."""
+        with self._flush_lock:
+            with self._lock:
+                self._last_flush = time.monotonic()
+                if not self._pending and not self._retry and not any(source.pending() for source in self._sources):
+                    return 0
+                new = {table: rows for table, rows in self._buffers.items() if rows}
+                self._buffers = {table: [] for table in self.queries}
+                self._pending = 0
+                self._oldest = None
+                for source in self._sources:
+                    for table, rows in source.drain().items():
+                        if rows:
+                            new.setdefault(table, []).extend(rows)
+                retry, self._retry = self._retry, []
+
+            # Retried rows go first, so rows reach the database in the order they arrived
+            batches = {}
+            for generation, _ in retry + [(new, 0)]:
+                for table, batch in generation.items():
+                    batches.setdefault(table, []).extend(batch)
+            rows = sum(len(batch) for batch in batches.values())
+            started = time.perf_counter()
+            error = None
+            try:
+                with self.connection() as conn:
+                    try:
+                        cur = conn.cursor()
+                        for table_name, batch in batches.items():
+                            cur.executemany(self.queries[table_name], batch)
+                        cur.close()
+                        conn.commit()
+                    except Exception:
+                        self._rollback(conn)
+                        raise
+            except Exception as err:
+                error = err
+                self.rows_failed += rows
+                self.flush_errors += 1
+                self._requeue(retry + [(new, 0)])
+                print(f"MySQL error while flushing {rows} buffered rows: {err}")
+
+            elapsed = time.perf_counter() - started
+            if self.on_flush is not None:
+                self.on_flush(rows, elapsed, error)
+            if error is not None:
+                rows = 0
+            self.flush_count += 1
+            self.rows_written += rows
+            self.last_flush_rows = rows
+            self.max_flush_rows = max(self.max_flush_rows, rows)
+            self.last_flush_seconds = elapsed
+            self.total_flush_seconds += elapsed
+            self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+            if rows:
+                print(f"Flushed {rows} rows in {elapsed * 1000:.1f} ms: "
+                      + ", ".join(f"{table}={len(batch)}" for table, batch in batches.items()))
+            return rows
+
+    def _requeue(self, generations):
+        """Keep the rows of a failed flush for the next one, dropping those out of attempts."""
+        keep = []
+        for batches, attempts in generations:
+            attempts += 1
+            if attempts < self.max_attempts:
+                keep.append((batches, attempts))
+                continue
+            dropped = sum(len(batch) for batch in batches.values())
+            self.rows_dropped += dropped
+            print(f"Dropping {dropped} rows after {attempts} failed flushes")
+        with self._lock:
+            self._retry = keep + self._retry
+
+    @staticmethod
+    def _rollback(conn):
+        try:
+            conn.rollback()
+        except Exception as err:
+            print(f"Rollback after a failed flush failed: {err}")
+
+    def close(self):
+        """Stop the background thread and flush whatever is still buffered."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def stats(self):
+        """Return a snapshot of the writer counters."""
+        with self._lock:
+            pending = self._pending
+            retry = sum(len(batch) for batches, _ in self._retry for batch in batches.values())
+        return {
+            "pending_rows": pending,
+            "retry_rows": retry,
+            "flushes": self.flush_count,
+            "rows_written": self.rows_written,
+            "rows_failed": self.rows_failed,
+            "rows_dropped": self.rows_dropped,
+            "flush_errors": self.flush_errors,
+            "last_flush_rows": self.last_flush_rows,
+            "max_flush_rows": self.max_flush_rows,
+            "avg_flush_rows": self.rows_written / self.flush_count if self.flush_count else 0.0,
+            "last_flush_seconds": self.last_flush_seconds,
+            "max_flush_seconds": self.max_flush_seconds,
+            "avg_flush_seconds": self.total_flush_seconds / self.flush_count if self.flush_count else 0.0,
+        }
+
+    def _run(self):
+        # Wake up often enough to honour max_delay, flush when the oldest row is due
+        interval = min(self.max_delay, 0.5) if self.max_delay > 0 else 0.5
+        while not self._stop.wait(interval):
+            with self._lock:
+                now = time.monotonic()
+                due = self._oldest is not None and now - self._oldest >= self.max_delay
+                if not due and now - self._last_flush >= self.max_delay:
+                    due = bool(self._retry) or any(source.pending() for source in self._sources)
+            if due:
+                self.flush()
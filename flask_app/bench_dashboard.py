@@ -0,0 +1,341 @@
+import argparse
+import collections
+import json
+import os
+import random
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import matplotlib.pyplot as plt
+import numpy as np
+
+import db
+from batch_writer import BatchWriter, INSERT_QUERIES
+from devices import DeviceResolver
+from bench_ingest import DEFAULT_OUTPUT, add_database_arguments, open_database, percentiles, record_results
+from fleet_sim import FIRST_DEVICE_ID
+from latest_state import LATEST_STATE_QUERIES, LatestState
+from rollups import ROLLUP_QUERIES, Rollups
+
+# Dashboard benchmark: seeds a benchmark database with history for a number of devices, then requests
+# home(), patient_data(), fleet() and the patient's plot images through Flask's test client and splits each request
+# into stages:
+#
+#   connection  waiting for a pooled connection
+#   query       cursor execute/fetch calls
+#   render      plot_renderer.render_ultrasound / render_ldr (via render_plot, so it includes the trip to a render
+#               process)
+#   template    render_template (Jinja)
+#   other       the rest of the request (routing, session, view code)
+#
+# In --mode parallel the stages overlap, so they are busy times and "other" is clipped at zero.
+# The "render" section times the plot functions alone, in-process, as a render worker runs them, with the
+# worker's memory after the warm-up and its growth per render.
+# The *_revalidate routes repeat an image request with the ETag of the first response, as a browser does
+# once the image's max-age has passed, and expect a 304.
+#
+#   python bench_dashboard.py --devices 5 --days 7 --reset --iterations 50
+#
+# Results are appended to the same JSON lines file as bench_ingest.py.
+
+STAGES = ("connection", "query", "render", "template")
+
+# Seeded history per device
+SEED_ULTRASOUND_INTERVAL = 10  # Seconds, like final_pub.py's regular distance readings
+SEED_BATTERY_INTERVAL = 300  # Seconds, what the subscriber's deadband heartbeat stores for a steady battery
+SEED_LDR_PER_DAY = 6
+SEED_BOX_CHANGES_PER_DAY = 2
+
+MEMORY_TRACE_RENDERS = 10  # Renders per chart traced with tracemalloc in the render section
+
+
+class StageTimer:
+    """Accumulates wall time per stage for the request in progress."""
+
+    def __init__(self):
+        self.current = collections.defaultdict(float)
+
+    def reset(self):
+        self.current = collections.defaultdict(float)
+
+    def add(self, stage, seconds):
+        self.current[stage] += seconds
+
+    def wrap(self, stage, func):
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(stage, time.perf_counter() - started)
+        return timed
+
+
+class TimedCursor:
+    """Cursor proxy that books execute and fetch calls to the 'query' stage."""
+
+    def __init__(self, cursor, timer):
+        self._cursor = cursor
+        for name in ("execute", "executemany", "fetchone", "fetchmany", "fetchall"):
+            setattr(self, name, timer.wrap("query", getattr(cursor, name)))
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+
+class TimedConnection:
+    def __init__(self, conn, timer):
+        self._conn = conn
+        self._timer = timer
+
+    def cursor(self, *args, **kwargs):
+        return TimedCursor(self._conn.cursor(*args, **kwargs), self._timer)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+# Patch the app module so every stage of a request is timed
+def instrument(app_module, timer):
+    pooled_connection = db.connection
+
+    @contextmanager
+    def timed_connection():
+        started = time.perf_counter()
+        with pooled_connection() as conn:
+            timer.add("connection", time.perf_counter() - started)
+            yield TimedConnection(conn, timer)
+
+    db.connection = timed_connection
+    # The plot functions themselves (plot_renderer's) must stay unwrapped: they are pickled by name for the render
+    # processes
+    app_module.render_plot = timer.wrap("render", app_module.render_plot)
+    app_module.render_template = timer.wrap("template", app_module.render_template)
+
+
+# Fill the benchmark database with `days` of history for `devices` devices, ending now
+def seed(devices, days, tz, seed_value=1):
+    rng = random.Random(seed_value)
+    writer = BatchWriter(db.connection, max_rows=5000)
+    rollups = writer.add_source(Rollups())
+    latest_state = writer.add_source(LatestState())
+    device_resolver = DeviceResolver()
+    end = datetime.now(tz).replace(tzinfo=None, microsecond=0)
+    start = end - timedelta(days=days)
+    seconds = int((end - start).total_seconds())
+    owners = [f"device-{FIRST_DEVICE_ID + i}" for i in range(devices)]
+
+    def add(table, values):
+        row = values[:-1] + (device_resolver.resolve(values[-1]),)
+        rollups.record(table, row)
+        latest_state.record(table, values)
+        writer.add(table, row)
+
+    for owner in owners:
+        distance = rng.uniform(0.5, 2.5)
+        for offset in range(0, seconds, SEED_ULTRASOUND_INTERVAL):
+            distance = min(max(distance + rng.uniform(-0.3, 0.3), 0.5), 4.0)
+            add("ultrasound_data", (start + timedelta(seconds=offset), round(distance, 2), owner))
+
+        voltage = 4.2
+        for offset in range(0, seconds, SEED_BATTERY_INTERVAL):
+            voltage = max(3.0, voltage - rng.uniform(0, 0.002))
+            add("battery_data", (start + timedelta(seconds=offset), round(voltage, 3),
+                                 int((voltage - 3.0) / 1.2 * 100), owner))
+
+        for offset in sorted(rng.randrange(seconds) for _ in range(SEED_LDR_PER_DAY * days)):
+            add("ldr_data", (start + timedelta(seconds=offset), 1, owner))
+
+        empty = False
+        for offset in sorted(rng.randrange(seconds) for _ in range(SEED_BOX_CHANGES_PER_DAY * days)):
+            empty = not empty
+            add("empty_box_status", (start + timedelta(seconds=offset), "empty" if empty else "full",
+                                     3.5 if empty else 1.0, owner))
+    writer.close()
+    return owners, writer.stats()["rows_written"]
+
+
+def benchmark_route(client, app_module, timer, url, iterations, warmup, cold, headers=None, status=200):
+    """Request `url` repeatedly and return per-stage timings in seconds."""
+    samples = collections.defaultdict(list)
+    for i in range(warmup + iterations):
+        if cold:
+            app_module.plot_cache.invalidate()
+        timer.reset()
+        started = time.perf_counter()
+        response = client.get(url, headers=headers)
+        total = time.perf_counter() - started
+        body = response.get_data()
+        if response.status_code != status or body.startswith(b"Error:"):
+            raise RuntimeError(f"{url} failed with {response.status_code}: {body[:200]!r}")
+        if i < warmup:
+            continue
+        for stage in STAGES:
+            samples[stage].append(timer.current[stage])
+        samples["other"].append(max(0.0, total - sum(timer.current.values())))
+        samples["total"].append(total)
+    return samples
+
+
+def peak_memory(client, app_module, url, cold):
+    """Peak Python heap allocation (bytes) of one request, traced separately so timings stay unaffected."""
+    if cold:
+        app_module.plot_cache.invalidate()
+    tracemalloc.start()
+    try:
+        client.get(url)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def resident_memory():
+    """Resident set size of this process in bytes (Linux), or None."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+def benchmark_render(app_module, iterations, warmup):
+    """Time generate_plot/generate_ldr_plot directly in this process, as one render worker runs them.
+
+    Also reports the memory a worker keeps after the warm-up renders and how much it grows per render
+    afterwards (figures that are never released show up there).
+    """
+    start = app_module.today_range()[0]
+    minutes = np.datetime64(start, "s") + np.arange(0, 24 * 3600, 60).astype("timedelta64[s]")
+    distances = (2 + np.sin(np.arange(len(minutes)) / 50)).astype(np.float32)
+    openings = minutes[::180]
+    charts = {
+        "ultrasound": lambda: app_module.generate_plot(minutes, distances),
+        "ldr": lambda: app_module.generate_ldr_plot(openings),
+    }
+    results = {}
+    for name, render in charts.items():
+        for _ in range(warmup):
+            render()
+        rss_before = resident_memory()
+        timings = []
+        for _ in range(iterations):
+            started = time.perf_counter()
+            render()
+            timings.append(time.perf_counter() - started)
+        rss_after = resident_memory()
+
+        # Heap growth is traced separately, since tracing slows rendering down
+        traced = min(iterations, MEMORY_TRACE_RENDERS)
+        tracemalloc.start()
+        traced_before = tracemalloc.get_traced_memory()[0]
+        for _ in range(traced):
+            render()
+        traced_growth = tracemalloc.get_traced_memory()[0] - traced_before
+        tracemalloc.stop()
+        results[name] = dict(percentiles(timings), heap_growth_per_render_bytes=traced_growth / max(traced, 1),
+                             rss_bytes=rss_after,
+                             rss_growth_bytes=None if rss_before is None else rss_after - rss_before)
+    results["open_figures"] = len(plt.get_fignums())
+    return results
+
+
+def run_benchmark(args):
+    import app as app_module
+
+    open_database(args, app_module.app.config['DB_POOL_SIZE'], app_module.app.config['DB_POOL_TIMEOUT'],
+                  list(INSERT_QUERIES) + list(ROLLUP_QUERIES) + list(LATEST_STATE_QUERIES))
+    owners = [f"device-{FIRST_DEVICE_ID + i}" for i in range(args.devices)]
+    seeded_rows = 0
+    if not args.no_seed:
+        started = time.perf_counter()
+        owners, seeded_rows = seed(args.devices, args.days, app_module.DENMARK_TZ, args.seed)
+        print(f"Seeded {seeded_rows} rows for {args.devices} devices x {args.days} days "
+              f"in {time.perf_counter() - started:.1f} s")
+
+    app_module.app.config['CLIENT_SIDE_CHARTS'] = args.charts == "client"
+    app_module.app.config['ULTRASOUND_RESOLUTION'] = args.resolution
+    app_module.app.config['PARALLEL_QUERIES'] = args.mode == "parallel"
+    if args.mode == "serial":
+        app_module.app.config['RENDER_PROCESSES'] = 0
+    elif args.render_processes is not None:
+        app_module.app.config['RENDER_PROCESSES'] = args.render_processes
+    timer = StageTimer()
+    instrument(app_module, timer)
+
+    client = app_module.app.test_client()
+    with client.session_transaction() as sess:
+        sess['username'] = 'bench'
+
+    routes = {"home": "/", "patient_data": f"/patient/{owners[0]}", "fleet": "/fleet"}
+    if args.charts == "server":
+        for plot_type in ("ultrasound", "ldr"):
+            routes[f"{plot_type}_png"] = f"/plot/{owners[0]}/{plot_type}.png"
+    results = {"seeded_rows": seeded_rows}
+    for name, url in routes.items():
+        samples = benchmark_route(client, app_module, timer, url, args.iterations, args.warmup, not args.warm_cache)
+        route = {stage: percentiles(values) for stage, values in samples.items()}
+        route["peak_memory_bytes"] = peak_memory(client, app_module, url, not args.warm_cache)
+        results[name] = route
+        if url.endswith(".png"):
+            etag = client.get(url).headers["ETag"]
+            samples = benchmark_route(client, app_module, timer, url, args.iterations, args.warmup, False,
+                                      headers={"If-None-Match": etag}, status=304)
+            results[f"{name}_revalidate"] = {stage: percentiles(values) for stage, values in samples.items()}
+    results["open_figures"] = len(plt.get_fignums())  # Figures never closed by the plot functions
+    results["plot_cache"] = app_module.plot_cache.stats()
+    results["render"] = benchmark_render(app_module, args.iterations, args.warmup)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the dashboard read path (home and patient pages)")
+    add_database_arguments(parser)
+    parser.add_argument("--devices", type=int, default=5)
+    parser.add_argument("--days", type=int, default=7, help="Days of history to seed per device")
+    parser.add_argument("--no-seed", action="store_true", help="Reuse the data already in the benchmark database")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--iterations", type=int, default=30)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--charts", choices=("server", "client"), default="server",
+                        help="Render PNG plots on the server or leave charts to the browser")
+    parser.add_argument("--resolution", choices=("raw", "minute", "hour"), default="minute",
+                        help="ULTRASOUND_RESOLUTION the dashboard reads at")
+    parser.add_argument("--mode", choices=("serial", "parallel"), default="parallel",
+                        help="Run page queries and plot renders one after another or concurrently")
+    parser.add_argument("--render-processes", type=int, default=None,
+                        help="Render worker processes in parallel mode (0 renders in-process)")
+    parser.add_argument("--warm-cache", action="store_true",
+                        help="Keep the rendered plot cache between requests (default: measure cold renders)")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT, help="Append results here as JSON lines ('' to skip)")
+    args = parser.parse_args()
+
+    results = run_benchmark(args)
+    for name, route in results.items():
+        if not isinstance(route, dict) or "total" not in route:
+            continue
+        if "peak_memory_bytes" in route:
+            print(f"{name}: peak memory {route['peak_memory_bytes'] / 1024 / 1024:.1f} MB")
+        else:
+            print(f"{name}:")
+        for stage in STAGES + ("other", "total"):
+            timings = route[stage]
+            print(f"  {stage:<10} p50 {timings['p50'] * 1000:8.2f} ms  p95 {timings['p95'] * 1000:8.2f} ms  "
+                  f"p99 {timings['p99'] * 1000:8.2f} ms")
+    for name in ("ultrasound", "ldr"):
+        render = results["render"][name]
+        print(f"render {name}: p50 {render['p50'] * 1000:.2f} ms, p95 {render['p95'] * 1000:.2f} ms, "
+              f"heap growth {render['heap_growth_per_render_bytes'] / 1024:.1f} KB/render, "
+              f"RSS {(render['rss_bytes'] or 0) / 1024 / 1024:.1f} MB")
+    print(json.dumps(results, indent=2, default=str))
+
+    if args.output:
+        record_results(args.output, "dashboard", args, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,285 @@
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import mysql.connector
+import paho.mqtt.client as mqtt
+
+import db
+import fleet_sim
+import schema
+
+# Ingest benchmark: replays simulated fleet traffic through final_sub.py's real pipeline, writer and rollups
+# and reports sustained messages/s, submit-to-commit latency percentiles and database rows/s.
+#
+#   python bench_ingest.py --devices 200 --duration 3600 --reset
+#
+# Results are appended as one JSON line per run to --output, so runs can be compared over time.
+
+DEFAULT_DATABASE = "sensor_data_bench"  # Never benchmark against the live database
+DEFAULT_OUTPUT = "bench_results.jsonl"
+
+
+def percentiles(values, prefix=""):
+    """p50/p95/p99/max of a list of durations (seconds)."""
+    values = sorted(values)
+
+    def percentile(p):
+        if not values:
+            return 0.0
+        return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+    return {
+        f"{prefix}p50": percentile(50),
+        f"{prefix}p95": percentile(95),
+        f"{prefix}p99": percentile(99),
+        f"{prefix}max": values[-1] if values else 0.0,
+    }
+
+
+class NullCursor:
+    _device_ids = itertools.count(1)  # Every new device gets its own id, as from the devices table
+
+    def execute(self, query, params=()):
+        self.lastrowid = next(self._device_ids)
+
+    def executemany(self, query, rows):
+        pass
+
+    def close(self):
+        pass
+
+
+class NullConnection:
+    """Accepts every write and discards it (--db null measures parsing and pipeline overhead only)."""
+
+    in_transaction = False
+
+    def cursor(self, *args, **kwargs):
+        return NullCursor()
+
+    def commit(self):
+        pass
+
+
+@contextmanager
+def null_connection():
+    yield NullConnection()
+
+
+class LatencyProbe:
+    """Measures submit-to-commit latency per message.
+
+    A message counts as committed when the first writer flush that started after its handler returned
+    has committed, so the numbers are an upper bound by at most one flush.
+    """
+
+    def __init__(self, pipeline, writer):
+        self._lock = threading.Lock()
+        self._handled = []  # Receive times of messages handled since the last flush started
+        self.latencies = []
+
+        handler = pipeline.handler
+        flush = writer.flush
+
+        def timed_handler(topic, payload, received_at, content_type=None):
+            handler(topic, payload, received_at, content_type)
+            with self._lock:
+                self._handled.append(received_at.timestamp())
+
+        def timed_flush():
+            with self._lock:
+                handled, self._handled = self._handled, []
+            rows = flush()
+            committed = time.time()
+            with self._lock:
+                self.latencies.extend(committed - received for received in handled)
+            return rows
+
+        pipeline.handler = timed_handler
+        writer.flush = timed_flush
+
+    def percentiles(self):
+        return percentiles(self.latencies, "latency_")
+
+
+# Command-line options for the benchmark database, shared with bench_dashboard.py
+def add_database_arguments(parser):
+    parser.add_argument("--db-host", default="localhost")
+    parser.add_argument("--db-port", type=int, default=3306)
+    parser.add_argument("--db-user", default="azureuser")
+    parser.add_argument("--db-password", default="Password1234")
+    parser.add_argument("--database", default=DEFAULT_DATABASE)
+    parser.add_argument("--reset", action="store_true", help="Empty the benchmark tables before the run")
+
+
+# Create and migrate the benchmark database if needed and point the shared pool at it
+def open_database(args, pool_size, timeout, tables):
+    conn = mysql.connector.connect(host=args.db_host, port=args.db_port, user=args.db_user, password=args.db_password)
+    try:
+        cur = conn.cursor()
+        cur.execute(f"CREATE DATABASE IF NOT EXISTS `{args.database}`;")
+        cur.close()
+    finally:
+        conn.close()
+    db.init_pool(pool_size=pool_size, timeout=timeout, host=args.db_host, port=args.db_port, user=args.db_user,
+                 password=args.db_password, database=args.database)
+    schema.migrate()
+    if args.reset:
+        with db.connection() as conn:
+            cur = conn.cursor()
+            for table in tables:
+                cur.execute(f"TRUNCATE TABLE {table};")
+            cur.close()
+
+
+# Point final_sub at the benchmark database, or at the null stand-in
+def setup_database(args, final_sub):
+    if args.db == "null":
+        final_sub.writer.connection = null_connection
+        final_sub.device_resolver.connection = null_connection
+        return
+    open_database(args, final_sub.DB_POOL_SIZE, final_sub.DB_POOL_TIMEOUT, final_sub.writer.queries)
+
+
+# Count the rows the run left in each table (the writer's own count includes rollup upserts)
+def count_rows(final_sub):
+    counts = {}
+    with db.connection() as conn:
+        cur = conn.cursor()
+        for table in final_sub.writer.queries:
+            cur.execute(f"SELECT COUNT(*) FROM {table};")
+            counts[table] = cur.fetchone()[0]
+        cur.close()
+    return counts
+
+
+# Append one benchmark run to the results file as a JSON line
+def record_results(path, benchmark, args, results):
+    record = {"benchmark": benchmark, "time": datetime.now().isoformat(timespec="seconds"),
+              "revision": git_revision(), "args": vars(args), "results": results}
+    with open(path, "a") as output_file:
+        output_file.write(json.dumps(record, default=str) + "\n")
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(args):
+    import final_sub
+
+    setup_database(args, final_sub)
+    pipeline, writer = final_sub.pipeline, final_sub.writer
+    pipeline.workers = args.workers
+    pipeline.report_interval = 0
+    writer.max_rows = args.batch_rows
+    writer.max_delay = args.batch_delay
+    if args.no_deadband:
+        final_sub.deadband.deadbands = {}
+    probe = LatencyProbe(pipeline, writer)
+
+    subscriber = None
+    if args.target == "broker":
+        subscriber = mqtt.Client()
+        subscriber.on_message = final_sub.on_message
+        subscriber.connect(args.broker, args.port, 60)
+        subscriber.subscribe([(topic, args.qos) for topic in final_sub.TOPICS])
+        subscriber.loop_start()
+        send = fleet_sim.broker_sender(args.broker, args.port, args.qos)
+    else:
+        send = fleet_sim.direct_sender(final_sub.on_message)
+
+    # final_sub prints every reading; keep that cost but not the terminal output
+    output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    simulator = fleet_sim.simulator_from_args(args)
+    with output:
+        writer.start()
+        pipeline.start()
+        started = time.monotonic()
+        sent = simulator.run(send, args.duration, args.speed)
+        if subscriber is not None:
+            # Wait for the broker to deliver everything (QoS 0 may lose messages, so do not wait forever)
+            deadline = time.monotonic() + args.drain_timeout
+            while pipeline.received < sent and time.monotonic() < deadline:
+                time.sleep(0.05)
+        sending = time.monotonic() - started
+        pipeline.stop(drain=True, timeout=args.drain_timeout)
+        writer.close()
+        elapsed = time.monotonic() - started
+    if subscriber is not None:
+        subscriber.loop_stop()
+        subscriber.disconnect()
+        send.client.loop_stop()
+        send.client.disconnect()
+
+    pipeline_stats = pipeline.stats()
+    writer_stats = writer.stats()
+    results = {
+        "messages_sent": sent,
+        "messages_processed": pipeline_stats["processed"],
+        "errors": pipeline_stats["errors"],
+        "dropped": pipeline_stats["dropped"],
+        "send_seconds": sending,
+        "elapsed_seconds": elapsed,
+        "messages_per_second": pipeline_stats["processed"] / elapsed if elapsed else 0.0,
+        "rows_written": writer_stats["rows_written"],
+        "rows_failed": writer_stats["rows_failed"],
+        "rows_per_second": writer_stats["rows_written"] / elapsed if elapsed else 0.0,
+        "flushes": writer_stats["flushes"],
+        "avg_flush_seconds": writer_stats["avg_flush_seconds"],
+        "max_flush_seconds": writer_stats["max_flush_seconds"],
+        "queue_lag_p99": pipeline_stats["lag_p99"],
+        "max_queue_depth": pipeline_stats["max_queue_depth"],
+    }
+    results.update(probe.percentiles())
+    if args.db != "null":
+        results["table_rows"] = count_rows(final_sub)
+        results["pool"] = db.get_pool().stats()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark final_sub.py ingest throughput with a simulated fleet")
+    fleet_sim.add_fleet_arguments(parser)
+    parser.add_argument("--target", choices=("direct", "broker"), default="direct",
+                        help="Call on_message directly or go through a local MQTT broker")
+    parser.add_argument("--broker", default="localhost")
+    parser.add_argument("--port", type=int, default=1883)
+    parser.add_argument("--qos", type=int, default=0, choices=(0, 1))
+    parser.add_argument("--db", choices=("mysql", "null"), default="mysql",
+                        help="'null' discards writes, to measure the parsing/pipeline ceiling")
+    add_database_arguments(parser)
+    parser.add_argument("--workers", type=int, default=2, help="Pipeline worker threads")
+    parser.add_argument("--batch-rows", type=int, default=500, help="Writer flush size")
+    parser.add_argument("--batch-delay", type=float, default=2.0, help="Writer flush interval (seconds)")
+    parser.add_argument("--no-deadband", action="store_true", help="Store every reading")
+    parser.add_argument("--drain-timeout", type=float, default=60.0)
+    parser.add_argument("--output", default=DEFAULT_OUTPUT, help="Append results here as JSON lines ('' to skip)")
+    parser.add_argument("--verbose", action="store_true", help="Show the subscriber's per-message output")
+    args = parser.parse_args()
+
+    results = run_benchmark(args)
+    print(f"{results['messages_processed']} messages in {results['elapsed_seconds']:.2f} s: "
+          f"{results['messages_per_second']:.0f} msg/s, {results['rows_per_second']:.0f} rows/s")
+    print(f"Submit-to-commit latency p50 {results['latency_p50'] * 1000:.1f} ms, "
+          f"p95 {results['latency_p95'] * 1000:.1f} ms, p99 {results['latency_p99'] * 1000:.1f} ms")
+    print(json.dumps(results, indent=2, default=str))
+
+    if args.output:
+        record_results(args.output, "ingest", args, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+from datetime import datetime
+
+import numpy as np
+import pytz
+
+# Column kinds understood by fetch_columns() and the NumPy dtype each one becomes
+DTYPES = {
+    "datetime": "datetime64[s]",
+    "float": np.float32,
+    "double": np.float64,
+    "int": np.int64,
+}
+
+
+def _to_array(column, kind):
+    if not column:
+        return np.empty(0, dtype=DTYPES[kind])
+    if isinstance(column[0], bytearray):
+        # The pure-Python connector returns bytearrays from raw cursors; NumPy needs bytes
+        column = [bytes(value) for value in column]
+    # Raw cursors return the server's text representation, which NumPy parses in one pass
+    return np.array(column).astype(DTYPES[kind])
+
+
+def fetch_columns(conn, query, params, kinds):
+    """Run a query and return one NumPy array per selected column.
+
+    `kinds` names the type of each column ('datetime', 'float', 'double' or 'int'). A raw cursor is
+    used, so the connector skips building a datetime/float object for every value.
+    """
+    cursor = conn.cursor(raw=True)
+    try:
+        cursor.execute(query, params)
+        rows = cursor.fetchall()
+    finally:
+        cursor.close()
+    columns = list(zip(*rows)) if rows else [()] * len(kinds)
+    return tuple(_to_array(column, kind) for column, kind in zip(columns, kinds))
+
+
+def _offsets(hours, tz, local):
+    """UTC offsets (as timedelta64[s]) of the given whole hours, interpreted as local time or as UTC."""
+    offsets = []
+    for hour in hours.astype(datetime):
+        if local:
+            offset = tz.localize(hour).utcoffset()
+        else:
+            offset = pytz.utc.localize(hour).astimezone(tz).utcoffset()
+        offsets.append(int(offset.total_seconds()))
+    return np.array(offsets, dtype="timedelta64[s]")
+
+
+def convert_timezone(timestamps, from_tz, to_tz):
+    """Convert naive datetime64 wall-clock times from one timezone to another.
+
+    UTC offsets only change on whole hours, so they are looked up once per distinct hour and then
+    applied to the whole array.
+    """
+    from_tz = pytz.timezone(from_tz) if isinstance(from_tz, str) else from_tz
+    to_tz = pytz.timezone(to_tz) if isinstance(to_tz, str) else to_tz
+    timestamps = np.asarray(timestamps, dtype="datetime64[s]")
+    if from_tz.zone == to_tz.zone or timestamps.size == 0:
+        return timestamps
+
+    utc = timestamps
+    if from_tz.zone != "UTC":
+        hours, inverse = np.unique(utc.astype("datetime64[h]"), return_inverse=True)
+        utc = utc - _offsets(hours, from_tz, local=True)[inverse]
+    if to_tz.zone == "UTC":
+        return utc
+    hours, inverse = np.unique(utc.astype("datetime64[h]"), return_inverse=True)
+    return utc + _offsets(hours, to_tz, local=False)[inverse]
+
+
+def to_epoch_ms(timestamps):
+    """Milliseconds since the epoch for naive datetime64 wall-clock times."""
+    return np.asarray(timestamps).astype("datetime64[ms]").astype(np.int64)
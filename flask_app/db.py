@@ -0,0 +1,215 @@
+import collections
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+import mysql.connector
+from mysql.connector import errors
+
+# Default pool settings
+DEFAULT_POOL_SIZE = 5
+DEFAULT_TIMEOUT = 5.0  # Seconds to wait for a free connection before giving up
+DEFAULT_HEALTH_CHECK_INTERVAL = 30.0  # Ping connections that were idle longer than this (seconds)
+SLOW_WAIT_WARNING = 0.5  # Log a warning when a caller waited longer than this for a connection (seconds)
+
+# Errors that mean the connection itself is unusable and must be replaced
+CONNECTION_ERRORS = (errors.InterfaceError, errors.OperationalError)
+
+
+class PoolTimeout(errors.PoolError):
+    """Raised when no connection became free within the pool timeout."""
+
+
+class ConnectionPool:
+    """Thread-safe pool of MySQL connections with health checks and wait-time statistics."""
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT,
+                 health_check_interval=DEFAULT_HEALTH_CHECK_INTERVAL, **connect_args):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self.connect_args = connect_args
+
+        self._idle = collections.deque()  # (connection, time it was returned)
+        self._created = 0  # Connections currently owned by the pool (idle + in use)
+        self._cond = threading.Condition()
+
+        # Statistics
+        self._waits = collections.deque(maxlen=1000)  # Recent wait times, for percentiles
+        self.acquired = 0
+        self.timeouts = 0
+        self.recycled = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def _connect(self):
+        return mysql.connector.connect(**self.connect_args)
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._created -= 1
+            self.recycled += 1
+            self._cond.notify()
+
+    def _healthy(self, conn, idle_since):
+        if time.monotonic() - idle_since < self.health_check_interval:
+            return True
+        try:
+            conn.ping(reconnect=False)
+            return True
+        except Exception as err:
+            logging.warning(f"Dropping stale pooled connection: {err}")
+            return False
+
+    def acquire(self):
+        """Take a connection from the pool, opening a new one if the pool is not full yet."""
+        started = time.monotonic()
+        deadline = started + self.timeout
+        while True:
+            conn = None
+            with self._cond:
+                while not self._idle and self._created >= self.pool_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.timeouts += 1
+                        raise PoolTimeout(f"No database connection available within {self.timeout:.1f}s "
+                                          f"(pool size {self.pool_size})")
+                    self._cond.wait(remaining)
+                if self._idle:
+                    conn, idle_since = self._idle.pop()
+                else:
+                    self._created += 1
+
+            if conn is not None:
+                if not self._healthy(conn, idle_since):
+                    self._discard(conn)
+                    continue
+            else:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._cond:
+                        self._created -= 1
+                        self._cond.notify()
+                    raise
+
+            self._record_wait(time.monotonic() - started)
+            return conn
+
+    def release(self, conn, broken=False):
+        """Return a connection to the pool, or replace it if it is broken."""
+        if not broken:
+            try:
+                # End any open transaction so the next user does not see a stale snapshot
+                if conn.in_transaction:
+                    conn.rollback()
+            except Exception:
+                broken = True
+        if broken:
+            self._discard(conn)
+            return
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """Context manager that borrows a connection and recycles it if it fails."""
+        conn = self.acquire()
+        broken = False
+        try:
+            yield conn
+        except CONNECTION_ERRORS:
+            broken = True
+            raise
+        finally:
+            self.release(conn, broken=broken)
+
+    def close(self):
+        """Close every idle connection."""
+        with self._cond:
+            idle = list(self._idle)
+            self._idle.clear()
+            self._created -= len(idle)
+        for conn, _ in idle:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def _record_wait(self, waited):
+        with self._cond:
+            self.acquired += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+            self._waits.append(waited)
+        if waited >= SLOW_WAIT_WARNING:
+            logging.warning(f"Waited {waited * 1000:.0f} ms for a database connection "
+                            f"(pool size {self.pool_size})")
+
+    def stats(self):
+        """Return a snapshot of pool usage and wait-time statistics."""
+        with self._cond:
+            waits = sorted(self._waits)
+            idle = len(self._idle)
+            created = self._created
+
+        def percentile(p):
+            if not waits:
+                return 0.0
+            return waits[min(len(waits) - 1, int(p / 100 * len(waits)))]
+
+        return {
+            "pool_size": self.pool_size,
+            "open": created,
+            "idle": idle,
+            "in_use": created - idle,
+            "acquired": self.acquired,
+            "timeouts": self.timeouts,
+            "recycled": self.recycled,
+            "wait_avg": self.total_wait / self.acquired if self.acquired else 0.0,
+            "wait_p50": percentile(50),
+            "wait_p95": percentile(95),
+            "wait_p99": percentile(99),
+            "wait_max": self.max_wait,
+        }
+
+
+# Process-wide pool, set up once by each entry point with init_pool()
+_pool = None
+
+
+def init_pool(pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT,
+              health_check_interval=DEFAULT_HEALTH_CHECK_INTERVAL, **connect_args):
+    """Create the shared connection pool."""
+    global _pool
+    if _pool is not None:
+        _pool.close()
+    _pool = ConnectionPool(pool_size=pool_size, timeout=timeout,
+                           health_check_interval=health_check_interval, **connect_args)
+    return _pool
+
+
+def get_pool():
+    if _pool is None:
+        raise RuntimeError("Database pool is not initialised; call db.init_pool() first")
+    return _pool
+
+
+def connection():
+    """Borrow a connection from the shared pool (use as a context manager)."""
+    return get_pool().connection()
+
+
+def connect():
+    """Open a connection outside the pool, with the pool's settings. The caller closes it.
+
+    For work that holds a connection for minutes, such as streaming an export, which would otherwise
+    keep a pool slot away from the dashboard.
+    """
+    return mysql.connector.connect(**get_pool().connect_args)
@@ -0,0 +1,65 @@
+import collections
+import threading
+
+# Default heartbeat: store a row at least this often per device and table, even if nothing changed
+DEFAULT_HEARTBEAT = 300.0  # Seconds
+
+
+class DeadbandFilter:
+    """Change-only storage: drop readings that stay within a deadband of the last stored reading.
+
+    Rows use the subscriber's insert layout (timestamp, reading..., device_owner). `deadbands` maps a
+    table name to one threshold per reading column; tables without an entry are always stored.
+    """
+
+    def __init__(self, deadbands, heartbeat=DEFAULT_HEARTBEAT):
+        self.deadbands = dict(deadbands)
+        self.heartbeat = heartbeat
+        self._last_stored = {}  # (table, device_owner) -> (timestamp, readings)
+        self._last_seen = {}  # (table, device_owner) -> (timestamp, readings)
+        self._lock = threading.Lock()
+
+        # Statistics per table
+        self.stored = collections.Counter()
+        self.suppressed = collections.Counter()
+
+    def should_store(self, table_name, values):
+        """Return True if the row moved beyond the deadband or the heartbeat is due."""
+        thresholds = self.deadbands.get(table_name)
+        if thresholds is None:
+            return True
+        timestamp, readings, device_owner = values[0], values[1:-1], values[-1]
+        key = (table_name, device_owner)
+
+        with self._lock:
+            self._last_seen[key] = (timestamp, readings)
+            previous = self._last_stored.get(key)
+            store = (
+                previous is None
+                or (timestamp - previous[0]).total_seconds() >= self.heartbeat
+                or any(abs(float(value) - float(last)) > threshold
+                       for value, last, threshold in zip(readings, previous[1], thresholds))
+            )
+            if store:
+                self._last_stored[key] = (timestamp, readings)
+                self.stored[table_name] += 1
+            else:
+                self.suppressed[table_name] += 1
+            return store
+
+    def last_seen(self, table_name, device_owner):
+        """Return (timestamp, readings) of the newest reading received, stored or not."""
+        with self._lock:
+            return self._last_seen.get((table_name, device_owner))
+
+    def stats(self):
+        with self._lock:
+            return {
+                table: {
+                    "stored": self.stored[table],
+                    "suppressed": self.suppressed[table],
+                    "suppressed_ratio": (self.suppressed[table] / (self.stored[table] + self.suppressed[table])
+                                         if self.stored[table] + self.suppressed[table] else 0.0),
+                }
+                for table in self.deadbands
+            }
@@ -0,0 +1,64 @@
+import threading
+
+import db
+
+# The raw tables reference devices by a small integer id (schema migration 6) instead of repeating the owner
+# name in every row and index entry. Ids are assigned by the devices table the first time an owner is seen
+# and never change, so the subscriber caches them for its lifetime.
+
+# Upsert returning the owner's id whether or not the row already existed
+CREATE_QUERY = ("INSERT INTO devices (device_owner) VALUES (%s) "
+                "ON DUPLICATE KEY UPDATE id = LAST_INSERT_ID(id);")
+
+
+class DeviceResolver:
+    """Maps device owner names to device ids, creating the devices row on first sight.
+
+    After load(), only an owner never seen before costs a database round trip.
+    """
+
+    def __init__(self, connection=None):
+        self.connection = connection or db.connection
+        self._ids = {}  # device_owner -> id
+        self._lock = threading.Lock()
+
+        # Counters
+        self.misses = 0  # Owners that were not cached (one round trip each)
+
+    def load(self):
+        """Cache every known device. Returns the number of devices."""
+        with self.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT device_owner, id FROM devices;")
+            rows = cur.fetchall()
+            cur.close()
+        with self._lock:
+            self._ids.update(rows)
+        return len(rows)
+
+    def resolve(self, device_owner):
+        """Return the id of `device_owner`."""
+        device_id = self._ids.get(device_owner)
+        if device_id is None:
+            device_id = self._create(device_owner)
+        return device_id
+
+    def stats(self):
+        with self._lock:
+            return {"devices": len(self._ids), "misses": self.misses}
+
+    def _create(self, device_owner):
+        # Serialized: an unknown owner arriving on several workers at once is created only once
+        with self._lock:
+            device_id = self._ids.get(device_owner)
+            if device_id is not None:
+                return device_id
+            with self.connection() as conn:
+                cur = conn.cursor()
+                cur.execute(CREATE_QUERY, (device_owner,))
+                device_id = cur.lastrowid
+                cur.close()
+                conn.commit()
+            self._ids[device_owner] = device_id
+            self.misses += 1
+            return device_id
@@ -0,0 +1,84 @@
+import numpy as np
+
+# Supported downsampling modes
+MODES = ("lttb", "minmax")
+DEFAULT_MODE = "lttb"
+
+
+def _numeric(x):
+    """Return x as float64 for geometry (datetime64 and datetime objects become epoch seconds)."""
+    x = np.asarray(x)
+    if np.issubdtype(x.dtype, np.datetime64):
+        return x.astype("datetime64[us]").astype(np.int64) / 1e6
+    if x.dtype == object:
+        return np.array([value.timestamp() for value in x], dtype=np.float64)
+    return x.astype(np.float64)
+
+
+def lttb_indices(x, y, threshold):
+    """Pick `threshold` indices with Largest-Triangle-Three-Buckets. x must be sorted ascending."""
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    # The first and last points are always kept; the rest are split into threshold - 2 buckets
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    # Average point of every bucket, used as the third triangle corner for the bucket before it
+    counts = np.diff(edges)
+    avg_x = np.add.reduceat(x[1:n - 1], edges[:-1] - 1) / counts
+    avg_y = np.add.reduceat(y[1:n - 1], edges[:-1] - 1) / counts
+    avg_x = np.append(avg_x, x[-1])
+    avg_y = np.append(avg_y, y[-1])
+
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+    a = 0
+    for bucket in range(threshold - 2):
+        lo, hi = edges[bucket], edges[bucket + 1]
+        cx, cy = avg_x[bucket + 1], avg_y[bucket + 1]
+        # Twice the triangle area between the previous pick, each candidate and the next bucket's average
+        area = np.abs((x[a] - cx) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (cy - y[a]))
+        a = lo + int(np.argmax(area))
+        selected[bucket + 1] = a
+    return selected
+
+
+def minmax_indices(y, threshold):
+    """Keep the minimum and maximum of each bucket (about `threshold` indices in total, in order)."""
+    n = len(y)
+    if threshold >= n or threshold < 4:
+        return np.arange(n)
+
+    buckets = threshold // 2
+    bucket_of = (np.arange(n) * buckets) // n
+    # Sort by (bucket, value): the first entry of each bucket is its min, the last its max
+    order = np.lexsort((y, bucket_of))
+    starts = np.searchsorted(bucket_of[order], np.arange(buckets), side="left")
+    ends = np.searchsorted(bucket_of[order], np.arange(buckets), side="right") - 1
+    picked = np.concatenate(([0, n - 1], order[starts], order[ends]))
+    return np.unique(picked)
+
+
+def downsample(x, y, threshold, mode=DEFAULT_MODE):
+    """Reduce a series to about `threshold` points while keeping its visual shape and spikes.
+
+    Returns (x, y) as NumPy arrays sorted by x. Series that are already small enough are only sorted.
+    """
+    if mode not in MODES:
+        raise ValueError(f"Unknown downsampling mode '{mode}', expected one of {MODES}")
+    x = np.asarray(x)
+    y = np.asarray(y, dtype=np.float64)
+    if len(x) == 0:
+        return x, y
+
+    xn = _numeric(x)
+    if len(xn) > 1 and np.any(np.diff(xn) < 0):
+        order = np.argsort(xn, kind="stable")
+        x, y, xn = x[order], y[order], xn[order]
+
+    if mode == "lttb":
+        idx = lttb_indices(xn, y, threshold)
+    else:
+        idx = minmax_indices(y, threshold)
+    return x[idx], y[idx]
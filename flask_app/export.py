@@ -0,0 +1,125 @@
+import csv
+import io
+import json
+
+# Exportable series: table and (column, output name, kind) of every exported column, in order. The owner
+# name comes from the devices table, joined on the raw table's device_id.
+EXPORT_SERIES = {
+    "ultrasound": ("ultrasound_data", (("timestamp", "timestamp", "text"), ("value", "distance", "float"),
+                                       ("devices.device_owner", "device_owner", "text"))),
+    "ldr": ("ldr_data", (("timestamp", "timestamp", "text"), ("value", "value", "int"),
+                         ("devices.device_owner", "device_owner", "text"))),
+    "box": ("empty_box_status", (("timestamp", "timestamp", "text"), ("status", "status", "text"),
+                                 ("distance", "distance", "float"), ("devices.device_owner", "device_owner", "text"))),
+    "battery": ("battery_data", (("timestamp", "timestamp", "text"), ("voltage", "voltage", "float"),
+                                 ("percentage", "percentage", "int"),
+                                 ("devices.device_owner", "device_owner", "text"))),
+}
+
+FORMATS = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+}
+
+# Defaults
+DEFAULT_FETCH_ROWS = 2000  # Rows per fetchmany() round trip, and per chunk sent to the client
+DEFAULT_WRITE_TIMEOUT = 600  # Seconds the server waits on a slow client before giving up on the result
+
+# Raw cursors return the server's text form of every value; NDJSON turns numbers back into numbers
+CONVERTERS = {
+    "text": lambda value: bytes(value).decode("utf-8"),
+    "float": float,
+    "int": int,
+}
+
+
+def export_query(series, where):
+    """SELECT for one series, in timestamp order (the (device_id, timestamp) and timestamp indexes).
+
+    STRAIGHT_JOIN keeps the raw table as the driving table, so rows still stream in index order and each
+    one looks its owner up by primary key.
+    """
+    table, columns = EXPORT_SERIES[series]
+    return (f"SELECT {', '.join(column for column, _, _ in columns)} FROM {table} "
+            f"STRAIGHT_JOIN devices ON devices.id = {table}.device_id WHERE {where} ORDER BY {table}.timestamp;")
+
+
+class QueryStream:
+    """Iterates over the rows of one query in chunks, read from an unbuffered cursor.
+
+    The server sends rows as they are fetched, so neither the connector nor the worker ever holds more
+    than one chunk. The stream owns `conn` and closes it when closed.
+    """
+
+    def __init__(self, conn, query, params, fetch_rows=DEFAULT_FETCH_ROWS, write_timeout=DEFAULT_WRITE_TIMEOUT):
+        self.conn = conn
+        self.fetch_rows = fetch_rows
+        self.rows = 0
+        try:
+            if write_timeout:
+                cursor = conn.cursor()
+                cursor.execute("SET SESSION net_write_timeout = %s;", (write_timeout,))
+                cursor.close()
+            self._cursor = conn.cursor(raw=True, buffered=False)
+            self._cursor.execute(query, params)
+        except Exception:
+            self.close()
+            raise
+
+    def __iter__(self):
+        while self.conn is not None:
+            rows = self._cursor.fetchmany(self.fetch_rows)
+            if not rows:
+                return
+            self.rows += len(rows)
+            yield rows
+
+    def close(self):
+        """Close the connection; an unread result is discarded along with it."""
+        conn, self.conn = self.conn, None
+        if conn is not None:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+
+def csv_chunks(stream, series):
+    """Yield a header line, then one block of CSV lines per chunk of rows.
+
+    Closes the stream when done, or when the generator is closed early because the client went away.
+    """
+    _, columns = EXPORT_SERIES[series]
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(name for _, name, _ in columns)
+    try:
+        yield buffer.getvalue()
+        for rows in stream:
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerows([None if value is None else bytes(value).decode("utf-8") for value in row]
+                             for row in rows)
+            yield buffer.getvalue()
+    finally:
+        stream.close()
+
+
+def ndjson_chunks(stream, series):
+    """Yield one block of JSON lines (one object per row) per chunk of rows; closes the stream like csv_chunks()."""
+    _, columns = EXPORT_SERIES[series]
+    fields = [(name, CONVERTERS[kind]) for _, name, kind in columns]
+    try:
+        for rows in stream:
+            yield "".join(json.dumps({name: None if value is None else convert(value)
+                                      for (name, convert), value in zip(fields, row)},
+                                     separators=(",", ":")) + "\n"
+                          for row in rows)
+    finally:
+        stream.close()
+
+
+CHUNKS = {
+    "csv": csv_chunks,
+    "ndjson": ndjson_chunks,
+}
@@ -1,11 +1,22 @@
 import time
-import network
-from machine import Pin, ADC
-from umqtt.simple import MQTTClient
 import json
-import machine
-import ntptime
-import ussl  # Import the ssl module to enable TLS/SSL
+import random
+import wire_format  # Binary payload format shared with the subscriber (copy wire_format.py to the device)
+
+try:
+    import machine
+    import network
+    import ntptime
+    import ussl  # Import the ssl module to enable TLS/SSL
+    import uasyncio as asyncio
+    from machine import Pin, ADC
+    from umqtt.simple import MQTTClient
+    ON_DEVICE = True
+except ImportError:
+    # Not on the ESP32: run the same tasks under CPython against simulated sensors and broker
+    import asyncio
+    import sim_hardware
+    ON_DEVICE = False
 
 # Wi-Fi credentials
 SSID = "JESPERSPC"
@@ -22,64 +33,184 @@ MQTT_TOPIC_BATTERY = "battery/percentage"
 
 # Define device owner (patient name or device owner)
 DEVICE_OWNER = "Anna"  # Change this variable to the desired device owner
+DEVICE_ID = 1  # Small numeric id sent in binary payloads; final_sub.py DEVICE_IDS maps it back to the owner
+
+# Payload encoding: "binary" (compact wire_format payloads) or "json"
+WIRE_FORMAT = "binary"
 
 # HC-SR04 GPIO Pins (Ultrasound Sensor)
 TRIG_PIN = 5
 ECHO_PIN = 17
-trigger = machine.Pin(TRIG_PIN, machine.Pin.OUT)
-echo = machine.Pin(ECHO_PIN, machine.Pin.IN)
 
 # LDR Sensor Pin (Light Dependent Resistor)
 LDR_PIN = 35
 THRESHOLD = 1000
-ldr = ADC(Pin(LDR_PIN))
-ldr.atten(ADC.ATTN_11DB)
 
 # Battery ADC Pin
 BATTERY_ADC_PIN = 34
-adc = ADC(Pin(BATTERY_ADC_PIN))
-adc.atten(ADC.ATTN_11DB)
-adc.width(ADC.WIDTH_12BIT)
 
 # LED GPIO Pins
 GREEN_LED_PIN = 14
 RED_LED_PIN = 15
-green_led = Pin(GREEN_LED_PIN, Pin.OUT)
-red_led = Pin(RED_LED_PIN, Pin.OUT)
-
-# Initialize LEDs to off
-green_led.value(0)
-red_led.value(0)
 
 # Battery characteristics
 MAX_VOLTAGE = 4.2
 MIN_VOLTAGE = 3.0
 VOLTAGE_DIVIDER_RATIO = 2
 
+# Distance (cm) above which the box counts as empty
+EMPTY_BOX_DISTANCE = 2.9
+
+# Sampling rate of each sensor task, in seconds. Each task keeps its own rate whatever the network does.
+ULTRASOUND_INTERVAL = 1.0
+DISTANCE_PUBLISH_INTERVAL = 10  # Seconds between regular distance readings
+LDR_INTERVAL = 0.5
+BATTERY_INTERVAL = 2.0
+
+# Publish task: how often it wakes up and how many messages it sends before yielding to the sensors
+PUBLISH_INTERVAL = 0.2
+PUBLISH_BURST = 5
+OUTBOX_MAX = 200  # Messages kept while the broker is unreachable; the oldest are dropped beyond this
+
+# Reconnect backoff (seconds), doubled after every failed attempt
+RECONNECT_MIN_DELAY = 1
+RECONNECT_MAX_DELAY = 60
+WIFI_CONNECT_TIMEOUT = 15  # Seconds to wait for Wi-Fi before trying again later
+# umqtt.simple connects and publishes on a blocking socket, which stalls every task while it waits. This timeout
+# bounds each socket wait (TCP connect, TLS handshake reads, CONNACK, publish write), so a dead or slow broker
+# costs the sensor tasks at most this long per attempt instead of the OS TCP timeout.
+MQTT_SOCKET_TIMEOUT = 1.0
+TASK_RESTART_DELAY = 1  # Seconds before a task that raised is started again
+
 # State tracking for sensors
 previous_state = False  # To track LDR state (light/dark)
 empty_box_published = False
+time_synced = False
 
 # Time zone offset (e.g., UTC +1 for CET)
 TIMEZONE_OFFSET = 1 * 3600  # Adjust to your timezone offset in seconds (1 hour = 3600 seconds)
 
-# Function to connect to WiFi
-def connect_wifi():
-    wlan = network.WLAN(network.STA_IF)
-    wlan.active(True)
-    wlan.connect(SSID, PASSWORD)
-    while not wlan.isconnected():
-        print("Connecting to WiFi...")
-        time.sleep(1)
-    print("Connected to WiFi")
-    print("IP address:", wlan.ifconfig()[0])
+# Seconds between the device epoch and the Unix epoch (the ESP32 port counts from 2000-01-01)
+EPOCH_OFFSET = 946684800 if time.gmtime(0)[0] == 2000 else 0
+
+# Batched payload mode: collect readings per topic and send them as one message
+BATCH_MODE = True
+BATCH_WINDOW = 30  # Seconds to collect samples before sending a batch
+BATCH_MAX_SAMPLES = 20  # Send early once a batch holds this many samples
+BATCH_TOPICS = (MQTT_TOPIC_DISTANCE, MQTT_TOPIC_BATTERY)  # Box status and LDR events are still sent immediately
+BATCH_FIELDS = {
+    MQTT_TOPIC_DISTANCE: ("distance",),
+    MQTT_TOPIC_BATTERY: ("voltage", "percentage"),
+    MQTT_TOPIC_EMPTY_BOX: ("status", "distance"),
+    MQTT_TOPIC_LDR: ("value",),
+}
+
+# Pending batches: topic -> list of [epoch, value...] samples, and when the first sample was queued
+batches = {}
+batch_started = {}
+
+# Encoded messages waiting for the publish task: list of (topic, message)
+outbox = []
+outbox_dropped = 0
+batches_dropped = 0  # Batches that could not be encoded
+
+
+class DeviceHardware:
+    """Pins, ADCs, Wi-Fi and MQTT client of the ESP32. sim_hardware.py has the CPython stand-in."""
+
+    def __init__(self):
+        self.trigger = Pin(TRIG_PIN, Pin.OUT)
+        self.echo = Pin(ECHO_PIN, Pin.IN)
+
+        self.ldr = ADC(Pin(LDR_PIN))
+        self.ldr.atten(ADC.ATTN_11DB)
+
+        self.adc = ADC(Pin(BATTERY_ADC_PIN))
+        self.adc.atten(ADC.ATTN_11DB)
+        self.adc.width(ADC.WIDTH_12BIT)
+
+        self.green_led = Pin(GREEN_LED_PIN, Pin.OUT)
+        self.red_led = Pin(RED_LED_PIN, Pin.OUT)
+
+        # Initialize LEDs to off
+        self.green_led.value(0)
+        self.red_led.value(0)
+
+        self.wlan = network.WLAN(network.STA_IF)
+
+    # Ultrasound Sensor: Measure Distance (blocks for at most the 30 ms echo timeout)
+    def measure_distance(self):
+        try:
+            self.trigger.value(0)
+            time.sleep_us(2)
+            self.trigger.value(1)
+            time.sleep_us(10)
+            self.trigger.value(0)
+
+            pulse_duration = machine.time_pulse_us(self.echo, 1, 30000)
+            if pulse_duration > 0:
+                distance = (pulse_duration * 0.0343) / 2  # Convert to cm
+                return distance
+            else:
+                print("Warning: No echo received or measurement timed out.")
+                return None
+        except Exception as e:
+            print(f"Error measuring distance: {e}")
+            return None
+
+    def read_ldr(self):
+        return self.ldr.read()
+
+    def read_battery_raw(self):
+        return self.adc.read()
+
+    def set_green_led(self, on):
+        self.green_led.value(1 if on else 0)
+
+    def set_red_led(self, on):
+        self.red_led.value(1 if on else 0)
+
+    def wifi_connected(self):
+        return self.wlan.isconnected()
+
+    def start_wifi(self):
+        self.wlan.active(True)
+        self.wlan.connect(SSID, PASSWORD)
+
+    def ip_address(self):
+        return self.wlan.ifconfig()[0]
+
+    def sync_time(self):
+        ntptime.settime()  # Sync with default NTP server (pool.ntp.org)
+
+    def mqtt_client(self):
+        return MQTTClient(MQTT_CLIENT_ID, MQTT_SERVER, port=MQTT_PORT, ssl=True)  # ssl=True to enable TLS
 
-# Function to connect to MQTT using TLS/SSL
-def connect_mqtt():
-    client = MQTTClient(MQTT_CLIENT_ID, MQTT_SERVER, port=MQTT_PORT, ssl=True)  # ssl=True to enable TLS
+
+# Function to connect to WiFi without blocking the sensor tasks
+async def connect_wifi(hw):
+    if hw.wifi_connected():
+        return True
+    hw.start_wifi()
+    for _ in range(WIFI_CONNECT_TIMEOUT):
+        if hw.wifi_connected():
+            print("Connected to WiFi")
+            print("IP address:", hw.ip_address())
+            return True
+        print("Connecting to WiFi...")
+        await asyncio.sleep(1)
+    print("WiFi not available yet.")
+    return False
+
+# Function to connect to MQTT using TLS/SSL. The connect itself blocks (for at most MQTT_SOCKET_TIMEOUT per
+# socket wait), so yield first to let any sensor task that is due run before the scheduler stalls.
+async def connect_mqtt(hw):
+    client = hw.mqtt_client()
+    await asyncio.sleep(0)
     try:
         print("Connecting to MQTT broker over TLS...")
-        client.connect()
+        # The timeout stays set on the client's socket, so it also bounds every later publish
+        client.connect(timeout=MQTT_SOCKET_TIMEOUT)
         print("Connected to MQTT broker")
         return client
     except Exception as e:
@@ -87,40 +218,29 @@ def connect_mqtt():
         return None
 
 # Function to sync time using NTP
-def sync_time():
+def sync_time(hw):
+    global time_synced
     try:
         print("Syncing time with NTP server...")
-        ntptime.settime()  # Sync with default NTP server (pool.ntp.org)
+        # Samples taken on the old clock go out in their own batches, so no batch spans the step
+        flush_batches(force=True)
+        hw.sync_time()
+        time_synced = True
         print("Time synced successfully.")
     except Exception as e:
         print(f"Error syncing time: {e}")
 
-# Function to get the current time adjusted for the timezone
-def get_current_time():
-    # Get the current time from the ESP32
-    t = time.localtime(time.time() + TIMEZONE_OFFSET)
+# Function to get the time (now or a given epoch) adjusted for the timezone
+def get_current_time(epoch=None):
+    if epoch is None:
+        epoch = get_epoch_time()
+    t = time.localtime(epoch - EPOCH_OFFSET + TIMEZONE_OFFSET)
     # Format as a readable string: [Year, Month, Day, Hour, Minute, Second, Weekday, Yearday]
     return "{:04}-{:02}-{:02} {:02}:{:02}:{:02}".format(t[0], t[1], t[2], t[3], t[4], t[5])
 
-# Ultrasound Sensor: Measure Distance
-def measure_distance():
-    try:
-        trigger.value(0)
-        time.sleep_us(2)
-        trigger.value(1)
-        time.sleep_us(10)
-        trigger.value(0)
-
-        pulse_duration = machine.time_pulse_us(echo, 1, 30000)
-        if pulse_duration > 0:
-            distance = (pulse_duration * 0.0343) / 2  # Convert to cm
-            return distance
-        else:
-            print("Warning: No echo received or measurement timed out.")
-            return None
-    except Exception as e:
-        print(f"Error measuring distance: {e}")
-        return None
+# Function to get the current Unix time in seconds (UTC)
+def get_epoch_time():
+    return int(time.time()) + EPOCH_OFFSET
 
 # Function to calculate battery percentage
 def calculate_battery_percentage(voltage):
@@ -132,114 +252,242 @@ def calculate_battery_percentage(voltage):
         return int(((voltage - MIN_VOLTAGE) / (MAX_VOLTAGE - MIN_VOLTAGE)) * 100)
 
 # Function to read battery voltage
-def read_battery_voltage():
-    raw_value = adc.read()
+def read_battery_voltage(hw):
+    raw_value = hw.read_battery_raw()
     voltage = (raw_value / 4095) * 3.3
     return voltage * VOLTAGE_DIVIDER_RATIO
 
-# Function to publish data
-def publish_data(client, topic, data):
+# Function to put an encoded message in the outbox, dropping the oldest one when it is full
+def enqueue(topic, message):
+    global outbox_dropped
+    if len(outbox) >= OUTBOX_MAX:
+        outbox.pop(0)
+        outbox_dropped += 1
+        print(f"Outbox full, dropped oldest message ({outbox_dropped} dropped so far)")
+    outbox.append((topic, message))
+
+# Function to encode a single reading taken at `epoch` and queue it for publishing
+def publish_data(topic, data, epoch):
+    if WIRE_FORMAT == "binary":
+        # One-sample binary payload: epoch seconds and scaled integers, no owner string or formatted time
+        sample = [epoch] + [data[field] for field in BATCH_FIELDS[topic]]
+        enqueue(topic, wire_format.encode(topic, DEVICE_ID, [sample]))
+        return
+    # Add device_owner (patient name) and the sample time to the data
+    data["device_owner"] = DEVICE_OWNER  # Include DEVICE_OWNER in the payload
+    data["timestamp"] = get_current_time(epoch)
+    enqueue(topic, json.dumps(data))
+
+# Function to encode the batched samples of a topic and queue them. A binary batch that spans a clock
+# step or more than the wire format's window is split into several messages.
+def flush_batch(topic):
+    global batches_dropped
+    samples = batches.pop(topic, None)
+    batch_started.pop(topic, None)
+    if not samples:
+        return
     try:
-        # Add device_owner (patient name) to the data
-        data["device_owner"] = DEVICE_OWNER  # Include DEVICE_OWNER in the payload
-        data["timestamp"] = get_current_time()  # Add current time to the payload
-        message = json.dumps(data)
-        client.publish(topic, message)
-        print(f"Published data to {topic}: {message}")
+        if WIRE_FORMAT == "binary":
+            messages = wire_format.encode_batches(topic, DEVICE_ID, samples)
+        else:
+            payload = {"device_owner": DEVICE_OWNER, "fields": list(BATCH_FIELDS[topic]), "samples": samples}
+            messages = [json.dumps(payload)]
     except Exception as e:
-        print(f"Failed to publish data: {e}")
-
-# Function to handle green LED based on LDR
-def handle_green_led(ldr_value):
-    if ldr_value > THRESHOLD:
-        green_led.value(1)  # Turn on green LED
-    else:
-        green_led.value(0)  # Turn off green LED
-
-# Function to handle red LED based on distance
-def handle_red_led(distance):
-    if distance > 2.9:  # Empty box condition
-        red_led.value(1)  # Turn on red LED
-    else:
-        red_led.value(0)  # Turn off red LED
-
-# Function to monitor LDR sensor
-def monitor_ldr(client):
+        batches_dropped += 1
+        print(f"Dropped a batch of {len(samples)} {topic} samples that could not be encoded: {e}")
+        return
+    for message in messages:
+        enqueue(topic, message)
+
+# Function to queue every batch whose window has passed (or all of them when force is set)
+def flush_batches(force=False):
+    now = time.time()
+    for topic in list(batches):
+        if force or now - batch_started[topic] >= BATCH_WINDOW:
+            flush_batch(topic)
+
+# Function to queue a reading: batched topics are collected, others are queued straight away.
+# Never touches the network, so the sensor tasks can call it at their own rate.
+def send_reading(topic, data):
+    epoch = get_epoch_time()
+    if not BATCH_MODE or topic not in BATCH_TOPICS:
+        try:
+            publish_data(topic, data, epoch)
+        except Exception as e:
+            print(f"Dropped a {topic} reading that could not be encoded: {e}")
+        return
+    sample = [epoch] + [data[field] for field in BATCH_FIELDS[topic]]
+    if topic not in batches:
+        batches[topic] = []
+        batch_started[topic] = time.time()
+    batches[topic].append(sample)
+    if len(batches[topic]) >= BATCH_MAX_SAMPLES:
+        flush_batch(topic)
+
+# Task: ultrasound sensor, red LED, regular distance readings and box status changes
+async def ultrasound_task(hw):
+    global empty_box_published
+    last_regular_publish = time.time()
+    while True:
+        distance = hw.measure_distance()
+        if distance is not None:
+            print(f"Measured Distance: {distance:.2f} cm")
+
+            # Control red LED
+            hw.set_red_led(distance > EMPTY_BOX_DISTANCE)
+
+            # Queue a regular distance reading every DISTANCE_PUBLISH_INTERVAL seconds
+            if time.time() - last_regular_publish >= DISTANCE_PUBLISH_INTERVAL:
+                send_reading(MQTT_TOPIC_DISTANCE, {"distance": distance})
+                last_regular_publish = time.time()
+
+            # Queue box status changes
+            if distance > EMPTY_BOX_DISTANCE and not empty_box_published:
+                send_reading(MQTT_TOPIC_EMPTY_BOX, {"status": "empty", "distance": distance})
+                empty_box_published = True
+                print("Empty box state detected and queued.")
+
+            elif distance <= EMPTY_BOX_DISTANCE and empty_box_published:
+                send_reading(MQTT_TOPIC_EMPTY_BOX, {"status": "full", "distance": distance})
+                empty_box_published = False
+                print("Box is now full. Status updated.")
+        await asyncio.sleep(ULTRASOUND_INTERVAL)
+
+# Task: LDR edge detection and green LED
+async def ldr_task(hw):
     global previous_state
-    ldr_value = ldr.read()
-    print(f"LDR Value: {ldr_value}")
-
-    # Control green LED
-    handle_green_led(ldr_value)
-
-    if ldr_value > THRESHOLD and not previous_state:
-        print("Light detected! Sending data...")
-        ldr_data = {"value": 1}
-        publish_data(client, MQTT_TOPIC_LDR, ldr_data)
-        previous_state = True
-    elif ldr_value <= THRESHOLD and previous_state:
-        print("Darkness detected. Ready for next light detection.")
-        previous_state = False
-    time.sleep(0.5)
-
-# Main function
-def main():
-    connect_wifi()
-    mqtt_client = connect_mqtt()
-
-    if mqtt_client:
-        sync_time()  # Sync time with NTP
-        last_regular_publish = time.time()
-        global empty_box_published
+    while True:
+        ldr_value = hw.read_ldr()
+
+        # Control green LED
+        hw.set_green_led(ldr_value > THRESHOLD)
+
+        if ldr_value > THRESHOLD and not previous_state:
+            print(f"Light detected (LDR {ldr_value})! Queueing event...")
+            send_reading(MQTT_TOPIC_LDR, {"value": 1})
+            previous_state = True
+        elif ldr_value <= THRESHOLD and previous_state:
+            print("Darkness detected. Ready for next light detection.")
+            previous_state = False
+        await asyncio.sleep(LDR_INTERVAL)
+
+# Task: battery voltage and percentage
+async def battery_task(hw):
+    while True:
+        voltage = read_battery_voltage(hw)
+        percentage = calculate_battery_percentage(voltage)
+        print(f"Battery Voltage: {voltage:.2f} V, Battery Percentage: {percentage}%")
+        send_reading(MQTT_TOPIC_BATTERY, {"voltage": voltage, "percentage": percentage})
+        await asyncio.sleep(BATTERY_INTERVAL)
+
+# Function to compute the next reconnect delay: exponential with jitter, so a fleet does not reconnect in step
+def next_backoff(delay):
+    delay = min(delay * 2, RECONNECT_MAX_DELAY)
+    return delay * (0.5 + random.getrandbits(8) / 510)
+
+# Function to close a client that may already be broken
+def close_client(client):
+    try:
+        client.disconnect()
+    except Exception:
+        pass
+
+# Task: (re)connect to Wi-Fi and the broker, then drain the outbox a few messages at a time.
+# A failed or timed-out publish leaves the message at the head of the outbox and triggers a reconnect.
+async def publish_task(hw, state):
+    delay = RECONNECT_MIN_DELAY
+    while True:
+        flush_batches()
+
+        if state["client"] is None:
+            client = None
+            if await connect_wifi(hw):
+                client = await connect_mqtt(hw)
+            if client is None:
+                print(f"Broker not reachable, retrying in {delay:.1f} s ({len(outbox)} messages waiting)")
+                await asyncio.sleep(delay)
+                delay = next_backoff(delay)
+                continue
+            state["client"] = client
+            state["connects"] += 1
+            delay = RECONNECT_MIN_DELAY
+            if not time_synced:
+                sync_time(hw)
+
+        sent = 0
+        while outbox and sent < PUBLISH_BURST:
+            # Let the sensor tasks run before every (blocking) publish
+            await asyncio.sleep(0)
+            topic, message = outbox[0]
+            try:
+                state["client"].publish(topic, message)
+            except Exception as e:
+                print(f"Failed to publish data, reconnecting: {e}")
+                close_client(state["client"])
+                state["client"] = None
+                break
+            outbox.pop(0)
+            sent += 1
+            state["published"] += 1
+            print(f"Published {len(message)} bytes to {topic}")
+        await asyncio.sleep(PUBLISH_INTERVAL)
+
+# Task wrapper: restart a task that raised, so one bad reading or batch cannot stop sampling or publishing
+async def supervise(state, name, task, *args):
+    while True:
+        try:
+            await task(*args)
+        except Exception as e:
+            state["restarts"] += 1
+            print(f"{name} task failed, restarting in {TASK_RESTART_DELAY} s: {e}")
+        await asyncio.sleep(TASK_RESTART_DELAY)
+
+# Function to send what is left in the batches and the outbox before exiting
+def drain_outbox(client):
+    flush_batches(force=True)
+    while outbox:
+        topic, message = outbox[0]
         try:
+            client.publish(topic, message)
+        except Exception as e:
+            print(f"Failed to publish data: {e}")
+            return
+        outbox.pop(0)
+
+# Main coroutine: start one task per sensor plus the publish task.
+# `duration` (seconds) stops the tasks again, which is how the simulation is run under CPython.
+async def run(hw, duration=None):
+    state = {"client": None, "connects": 0, "published": 0, "restarts": 0}
+    if await connect_wifi(hw):
+        sync_time(hw)  # Timestamps are taken on the device, so sync before sampling when possible
+
+    tasks = [
+        asyncio.create_task(supervise(state, "Ultrasound", ultrasound_task, hw)),
+        asyncio.create_task(supervise(state, "LDR", ldr_task, hw)),
+        asyncio.create_task(supervise(state, "Battery", battery_task, hw)),
+        asyncio.create_task(supervise(state, "Publish", publish_task, hw, state)),
+    ]
+    try:
+        if duration is None:
             while True:
-                # Ultrasound sensor: measure distance
-                distance = measure_distance()
-                if distance is not None:
-                    print(f"Measured Distance: {distance:.2f} cm")
-
-                    # Control red LED
-                    handle_red_led(distance)
-
-                    # Publish regular distance data every 10 seconds
-                    if time.time() - last_regular_publish >= 10:
-                        sensor_data = {"distance": distance}
-                        publish_data(mqtt_client, MQTT_TOPIC_DISTANCE, sensor_data)
-                        last_regular_publish = time.time()
-
-                    # Publish box status
-                    if distance > 2.9 and not empty_box_published:
-                        empty_box_data = {"status": "empty", "distance": distance}
-                        publish_data(mqtt_client, MQTT_TOPIC_EMPTY_BOX, empty_box_data)
-                        empty_box_published = True
-                        print("Empty box state detected and published.")
-
-                    elif distance <= 2.9 and empty_box_published:
-                        empty_box_data = {"status": "full", "distance": distance}
-                        publish_data(mqtt_client, MQTT_TOPIC_EMPTY_BOX, empty_box_data)
-                        empty_box_published = False
-                        print("Box is now full. Status updated.")
-
-                # LDR sensor: Monitor and publish light detection
-                monitor_ldr(mqtt_client)
-
-                # Battery sensor: Read battery voltage and percentage
-                voltage = read_battery_voltage()
-                percentage = calculate_battery_percentage(voltage)
-                print(f"Battery Voltage: {voltage:.2f} V, Battery Percentage: {percentage}%")
-                battery_data = {"voltage": voltage, "percentage": percentage}
-                publish_data(mqtt_client, MQTT_TOPIC_BATTERY, battery_data)
-
-                # Sleep to avoid rapid sensor polling
-                time.sleep(1)
-
-        except KeyboardInterrupt:
-            print("Exiting...")
-        finally:
-            mqtt_client.disconnect()
+                await asyncio.sleep(60)
+        await asyncio.sleep(duration)
+    finally:
+        for task in tasks:
+            task.cancel()
+        if state["client"] is not None:
+            drain_outbox(state["client"])
+            close_client(state["client"])
             print("MQTT client disconnected.")
-    else:
-        print("MQTT connection failed. Exiting.")
+    return state
+
+# Main function
+def main():
+    hw = DeviceHardware() if ON_DEVICE else sim_hardware.SimulatedHardware()
+    try:
+        asyncio.run(run(hw))
+    except KeyboardInterrupt:
+        print("Exiting...")
 
 if __name__ == "__main__":
     main()
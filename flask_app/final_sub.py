@@ -1,113 +1,204 @@
-import mysql.connector
 from datetime import datetime
 import json
 import pytz
 import paho.mqtt.client as mqtt
 import ssl
+from batch_writer import BatchWriter
+import db
+import schema
+from rollups import Rollups
+from latest_state import LatestState
+from devices import DeviceResolver
+from pipeline import IngestPipeline
+from deadband import DeadbandFilter
+import wire_format
+import metrics
+import live_events
+import retention
+import alerts
 
-# Database connection setup
-def connect_db():
-    return mysql.connector.connect(
-        host="localhost",
-        user="azureuser",  # Your MySQL username
-        password="Password1234",  # Your MySQL password
-        database="sensor_data"  # Your MySQL database name
-    )
+# Buffered writer settings: flush after this many rows or this many seconds, whichever comes first
+BATCH_MAX_ROWS = 500
+BATCH_MAX_DELAY = 2.0
 
-# Callback function for incoming MQTT messages
+# Ingest pipeline settings: the MQTT thread only enqueues, worker threads parse and persist
+PIPELINE_WORKERS = 2
+PIPELINE_QUEUE_SIZE = 10000
+PIPELINE_POLICY = "block"  # "block", "drop_oldest" or "spill" (to PIPELINE_SPILL_PATH) when the queue is full
+PIPELINE_SPILL_PATH = "ingest_spill.jsonl"
+PIPELINE_REPORT_INTERVAL = 60.0  # Seconds between printed pipeline stats
+
+# Change-only storage: thresholds per reading column (in insert order) and the heartbeat interval
+DEADBANDS = {
+    "ultrasound_data": (0.2,),  # Distance in cm
+    "battery_data": (0.05, 1),  # Voltage in V, percentage
+}
+DEADBAND_HEARTBEAT = 300.0  # Store at least one row per device and table this often (seconds)
+
+# Timezone the readings are stored in
+DENMARK_TZ = pytz.timezone("Europe/Copenhagen")
+
+# Publish every stored reading on live_events.EVENTS_TOPIC (same broker) for the dashboard's live updates.
+# Batches are signed with LIVE_EVENTS_SECRET, which must match the dashboard's; the broker ACL should let only
+# this subscriber write the topic and only the dashboard read it (see live_events.py)
+LIVE_EVENTS = True
+LIVE_EVENTS_INTERVAL = 0.5  # Seconds between event batches
+LIVE_EVENTS_SECRET = "your_live_events_secret"  # Replace with a real secret, shared with the dashboard
+
+# Raw history retention: daily partitions are created ahead of time, and partitions older than RETENTION_DAYS
+# are archived to gzip'd CSV files in RETENTION_ARCHIVE_DIR and dropped (None keeps everything)
+RETENTION_DAYS = 90
+RETENTION_ARCHIVE_DIR = "archive"
+RETENTION_INTERVAL = 6 * 3600  # Seconds between retention runs
+
+# Alert rules evaluated on every reading (None disables a rule); alerts are mailed in batches by a
+# background sender, at most ALERT_RATE_LIMIT[0] emails per ALERT_RATE_LIMIT[1] seconds
+ALERTS = True
+ALERT_RULES = {
+    "battery_below": 20,  # Percent
+    "box_empty_minutes": 60,
+    "ldr_open_by": "12:00",  # Local time by which the box should have been opened every day
+    "silent_minutes": 30,  # No message from a device for this long
+}
+ALERT_SMTP = {
+    "host": "localhost",  # Replace with your SMTP server
+    "port": 25,
+    "sender": "alerts@localhost",  # Replace with your email
+    "recipients": ["recipient_email@gmail.com"],  # Replace with recipient's email
+    "username": None,
+    "password": None,
+    "starttls": False,
+}
+ALERT_BATCH_DELAY = 30.0  # Seconds to collect alerts into one email
+ALERT_RATE_LIMIT = (10, 3600)
+
+# Prometheus metrics listener (GET http://<host>:METRICS_PORT/metrics); 0 disables it
+METRICS_PORT = 9108
+
+# Connection pool settings
+DB_POOL_SIZE = 3
+DB_POOL_TIMEOUT = 10.0  # Seconds to wait for a free connection
+
+# Database connection setup (shared connection pool)
+db.init_pool(
+    pool_size=DB_POOL_SIZE,
+    timeout=DB_POOL_TIMEOUT,
+    host="localhost",
+    user="azureuser",  # Your MySQL username
+    password="Password1234",  # Your MySQL password
+    database="sensor_data"  # Your MySQL database name
+)
+
+# Callback function for incoming MQTT messages (runs on the MQTT network thread, so it only enqueues)
 def on_message(client, userdata, message):
+    # MQTT 5 brokers can carry the payload content type; with MQTT 3.1.1 the payload is sniffed instead
+    content_type = getattr(getattr(message, "properties", None), "ContentType", None)
+    pipeline.submit(message.topic, message.payload, content_type)
+
+# Topics the subscriber stores
+TOPICS = ("sensor/ldr", "esp32/ultrasound_data", "esp32/empty_box_status", "battery/percentage")
+
+# Owners of the device ids carried by binary payloads (final_pub.py DEVICE_ID). These are the publishers'
+# hardware ids; the database keys rows by its own ids from the devices table (see device_resolver)
+DEVICE_IDS = {
+    1: "Anna",
+    2: "Rune",
+}
+
+# Device clocks before this epoch second (2001-09-09) have not been synced with NTP yet
+MIN_VALID_EPOCH = 1000000000
+
+# Parse one message and buffer its rows (runs on a pipeline worker thread)
+def process_message(topic, payload, received_at, content_type=None):
+    if topic not in TOPICS:
+        MESSAGES.inc(topic="other")
+        print("Unrecognized message format or topic.")
+        return
+    MESSAGES.inc(topic=topic)
+
+    if wire_format.is_binary(payload, content_type):
+        # Compact binary payload: scaled integers and epoch seconds, the owner comes from the device id
+        try:
+            payload_topic, device_id, samples = wire_format.decode(payload)
+        except ValueError:
+            PARSE_ERRORS.inc(topic=topic)
+            raise
+        if payload_topic != topic:
+            raise ValueError(f"Binary payload for {payload_topic} received on {topic}")
+        device_owner = DEVICE_IDS.get(device_id, f"device-{device_id}")
+        print(f"Received {len(samples)} binary samples on {topic} from device {device_id} ({device_owner})")
+        for epoch, reading in samples:
+            reading["device_owner"] = device_owner
+            handle_reading(topic, reading, sample_time(epoch, received_at))
+        return
+
+    # Decode the received MQTT message (errors propagate to the pipeline, which logs and counts them)
     try:
-        # Decode the received MQTT message
-        received_data = message.payload.decode()
-
-        # Set the time zone to Denmark (Copenhagen)
-        denmark_tz = pytz.timezone("Europe/Copenhagen")
-        timestamp = datetime.now(denmark_tz)  # Use datetime object with Denmark's timezone
-
-        if message.topic == "sensor/ldr":
-            print(f"Received message on {message.topic}: {received_data}")
-            data = json.loads(received_data)
-            print(f"Parsed data: {data}")
-
-            if data.get("value") == 1:  # Check if value is 1
-                print(f"Light detected at {timestamp}")
-                create_table("ldr_data", """
-                    CREATE TABLE IF NOT EXISTS ldr_data (
-                        id INT AUTO_INCREMENT PRIMARY KEY,
-                        timestamp DATETIME NOT NULL,
-                        value INT NOT NULL,
-                        device_owner VARCHAR(255) NOT NULL
-                    );
-                """)
-                # Insert data including device owner
-                insert_data("ldr_data", (timestamp, data.get("value"), get_device_owner(data)))
-            else:
-                print("LDR value is not 1, skipping insertion.")
-
-        elif message.topic == "esp32/ultrasound_data":
-            print(f"Received message on {message.topic}: {received_data}")
-            data = json.loads(received_data)
-
-            if "distance" in data:
-                distance = data["distance"]
-                print(f"Parsed Distance: {distance}, Timestamp: {timestamp}")
-                create_table("ultrasound_data", """
-                    CREATE TABLE IF NOT EXISTS ultrasound_data (
-                        id INT AUTO_INCREMENT PRIMARY KEY,
-                        timestamp DATETIME NOT NULL,
-                        value FLOAT NOT NULL,
-                        device_owner VARCHAR(255) NOT NULL
-                    );
-                """)
-                # Insert data including device owner
-                insert_data("ultrasound_data", (timestamp, distance, get_device_owner(data)))
-
-        elif message.topic == "esp32/empty_box_status":
-            print(f"Received message on {message.topic}: {received_data}")
-            data = json.loads(received_data)
-
-            if "status" in data:
-                status = data["status"]
-                distance = data.get("distance", None)
-                print(f"Parsed Empty Box Status: {status}, Distance: {distance}, Timestamp: {timestamp}")
-                create_table("empty_box_status", """
-                    CREATE TABLE IF NOT EXISTS empty_box_status (
-                        id INT AUTO_INCREMENT PRIMARY KEY,
-                        timestamp DATETIME NOT NULL,
-                        status VARCHAR(10) NOT NULL,
-                        distance FLOAT,
-                        device_owner VARCHAR(255) NOT NULL
-                    );
-                """)
-                # Insert data including device owner
-                insert_data("empty_box_status", (timestamp, status, distance, get_device_owner(data)))
-
-        elif message.topic == "battery/percentage":
-            print(f"Received message on {message.topic}: {received_data}")
-
-            # Extract the voltage and percentage from the message
-            data = json.loads(received_data)
-            voltage = float(data.get("voltage", 0.0))  # Convert voltage to float
-            percentage = int(data.get("percentage", 0))  # Convert percentage to int
-
-            print(f"Received data: Voltage = {voltage} V, Percentage = {percentage}% at {timestamp}")
-            create_table("battery_data", """
-                CREATE TABLE IF NOT EXISTS battery_data (
-                    id INT AUTO_INCREMENT PRIMARY KEY,
-                    timestamp DATETIME NOT NULL,
-                    voltage FLOAT NOT NULL,
-                    percentage INT NOT NULL,
-                    device_owner VARCHAR(255) NOT NULL
-                );
-            """)
-            # Insert data including device owner
-            insert_data("battery_data", (timestamp, voltage, percentage, get_device_owner(data)))
+        received_data = payload.decode()
+        data = json.loads(received_data)
+    except ValueError:  # Also covers UnicodeDecodeError and JSONDecodeError
+        PARSE_ERRORS.inc(topic=topic)
+        raise
+    print(f"Received message on {topic}: {received_data}")
 
+    if isinstance(data, dict) and "samples" in data:
+        # Batched payload: many (timestamp, value...) samples in one message, bulk-inserted via the writer
+        for reading, timestamp in decode_batch(data, received_at):
+            handle_reading(topic, reading, timestamp)
+    else:
+        # Single reading, timestamped with the time of receipt in Denmark's timezone
+        handle_reading(topic, data, received_at)
+
+# Expand a batched payload into (reading, timestamp) pairs
+def decode_batch(data, received_at):
+    fields = data.get("fields", [])
+    device_owner = get_device_owner(data)
+    for sample in data["samples"]:
+        reading = dict(zip(fields, sample[1:]))
+        reading["device_owner"] = device_owner
+        yield reading, sample_time(sample[0], received_at)
+
+# Convert a device epoch timestamp to Denmark's timezone
+def sample_time(epoch, received_at):
+    if isinstance(epoch, (int, float)) and epoch >= MIN_VALID_EPOCH:
+        return datetime.fromtimestamp(epoch, DENMARK_TZ)
+    return received_at  # Device clock not synced, fall back to the time of receipt
+
+# Buffer the rows for one decoded reading
+def handle_reading(topic, data, timestamp):
+    if topic == "sensor/ldr":
+        print(f"Parsed data: {data}")
+
+        if data.get("value") == 1:  # Check if value is 1
+            print(f"Light detected at {timestamp}")
+            # Insert data including device owner
+            insert_data("ldr_data", (timestamp, data.get("value"), get_device_owner(data)))
         else:
-            print("Unrecognized message format or topic.")
+            print("LDR value is not 1, skipping insertion.")
 
-    except Exception as e:
-        print(f"Error processing message: {e}")
+    elif topic == "esp32/ultrasound_data":
+        if "distance" in data:
+            distance = data["distance"]
+            print(f"Parsed Distance: {distance}, Timestamp: {timestamp}")
+            # Insert data including device owner
+            insert_data("ultrasound_data", (timestamp, distance, get_device_owner(data)))
+
+    elif topic == "esp32/empty_box_status":
+        if "status" in data:
+            status = data["status"]
+            distance = data.get("distance", None)
+            print(f"Parsed Empty Box Status: {status}, Distance: {distance}, Timestamp: {timestamp}")
+            # Insert data including device owner
+            insert_data("empty_box_status", (timestamp, status, distance, get_device_owner(data)))
+
+    elif topic == "battery/percentage":
+        # Extract the voltage and percentage from the message
+        voltage = float(data.get("voltage", 0.0))  # Convert voltage to float
+        percentage = int(data.get("percentage", 0))  # Convert percentage to int
+
+        print(f"Received data: Voltage = {voltage} V, Percentage = {percentage}% at {timestamp}")
+        # Insert data including device owner
+        insert_data("battery_data", (timestamp, voltage, percentage, get_device_owner(data)))
 
 # Function to extract device_owner from the message data
 def get_device_owner(data):
@@ -117,40 +208,128 @@ def get_device_owner(data):
     else:
         return "Unknown"  # Default value if no owner is found
 
-# Ensure the table exists
-def create_table(table_name, create_query):
-    try:
-        conn = connect_db()
-        cur = conn.cursor()
-        cur.execute(create_query)
-        conn.commit()
-        conn.close()
-        print(f"Table '{table_name}' checked/created.")
-    except mysql.connector.Error as err:
-        print(f"MySQL error while creating table '{table_name}': {err}")
+# Metrics exposed on METRICS_PORT
+registry = metrics.Registry()
+MESSAGES = registry.counter("subscriber_messages_total", "MQTT messages processed, by topic", ("topic",))
+PARSE_ERRORS = registry.counter("subscriber_parse_errors_total", "Messages that could not be decoded, by topic",
+                                ("topic",))
+ROWS_BUFFERED = registry.counter("subscriber_rows_buffered_total", "Rows handed to the batch writer, by table",
+                                 ("table",))
+FLUSH_SECONDS = registry.histogram("subscriber_db_flush_seconds",
+                                   "Time to insert and commit one batch of rows (insert latency)")
+FLUSH_ROWS = registry.counter("subscriber_db_rows_written_total", "Rows (including rollup upserts) committed")
+DB_ERRORS = registry.counter("subscriber_db_errors_total", "Failed batch flushes")
+DB_ROWS_FAILED = registry.counter("subscriber_db_rows_failed_total", "Rows in failed batch flushes (retried)")
+
+# Record every batch flush in the metrics
+def record_flush(rows, seconds, error):
+    FLUSH_SECONDS.observe(seconds)
+    if error is None:
+        FLUSH_ROWS.inc(rows)
+    else:
+        DB_ERRORS.inc()
+        DB_ROWS_FAILED.inc(rows)
+
+# Buffered writer shared by all message handlers (rows are flushed in batches)
+writer = BatchWriter(db.connection, max_rows=BATCH_MAX_ROWS, max_delay=BATCH_MAX_DELAY, on_flush=record_flush)
+
+# Per-minute/hour/day aggregates maintained as rows arrive, written together with the raw rows
+rollups = writer.add_source(Rollups())
+
+# Newest reading of every kind per device (device_latest_state), upserted once per device and flush
+latest_state = writer.add_source(LatestState())
+
+# Owner name -> devices.id for the raw rows, cached; an owner seen for the first time gets its row created
+device_resolver = DeviceResolver()
+
+# Bounded queue + worker threads between MQTT receipt and database work
+pipeline = IngestPipeline(process_message,
+                          workers=PIPELINE_WORKERS,
+                          max_queue=PIPELINE_QUEUE_SIZE,
+                          policy=PIPELINE_POLICY,
+                          spill_path=PIPELINE_SPILL_PATH,
+                          report_interval=PIPELINE_REPORT_INTERVAL,
+                          tz=DENMARK_TZ)
+
+# Drops battery/ultrasound readings that did not move beyond the deadband (rollups still see every reading)
+deadband = DeadbandFilter(DEADBANDS, heartbeat=DEADBAND_HEARTBEAT)
+
+# Stored readings for live dashboards, published in small batches once connected to the broker
+events = live_events.EventPublisher(LIVE_EVENTS_SECRET, interval=LIVE_EVENTS_INTERVAL, tz=DENMARK_TZ)
+
+# Partition maintenance and retention, run in the background while the subscriber is up
+retention_job = retention.RetentionJob(interval=RETENTION_INTERVAL, retention_days=RETENTION_DAYS,
+                                       archive_dir=RETENTION_ARCHIVE_DIR, tz=DENMARK_TZ)
+
+# Alert emails, sent from a background thread so a slow mail server never holds up ingestion
+notifier = alerts.Notifier(alerts.smtp_sender(**ALERT_SMTP), batch_delay=ALERT_BATCH_DELAY,
+                           rate_limit=ALERT_RATE_LIMIT)
+
+# Alert rules, updated with every reading (before the deadband, like the rollups)
+alert_engine = alerts.AlertEngine(notifier.submit, tz=DENMARK_TZ, **ALERT_RULES)
+
+# Pipeline, writer, deadband and pool state, read when the metrics are scraped
+registry.gauge("subscriber_queue_depth", "Messages waiting in the ingest queue",
+               func=lambda: pipeline.stats()["queue_depth"])
+registry.gauge("subscriber_queue_lag_seconds", "Recent time messages spent queued before processing",
+               ("quantile",), func=lambda: {q: pipeline.stats()[f"lag_p{q}"] for q in (50, 95, 99)})
+registry.counter("subscriber_dropped_total", "Messages dropped because the ingest queue was full",
+                 func=lambda: pipeline.stats()["dropped"])
+registry.counter("subscriber_handler_errors_total", "Messages whose processing raised an error",
+                 func=lambda: pipeline.stats()["errors"])
+registry.gauge("subscriber_writer_pending_rows", "Rows buffered and not yet flushed",
+               func=lambda: writer.stats()["pending_rows"])
+registry.gauge("subscriber_writer_retry_rows", "Rows of failed flushes waiting to be written again",
+               func=lambda: writer.stats()["retry_rows"])
+registry.counter("subscriber_db_rows_dropped_total", "Rows dropped after repeatedly failed flushes",
+                 func=lambda: writer.stats()["rows_dropped"])
+registry.counter("subscriber_deadband_suppressed_total", "Readings not stored because they stayed in the deadband",
+                 ("table",), func=lambda: {table: stats["suppressed"] for table, stats in deadband.stats().items()})
+registry.counter("subscriber_live_events_published_total", "Live dashboard events published",
+                 func=lambda: events.stats()["published"])
+registry.counter("subscriber_live_events_dropped_total", "Live dashboard events dropped (broker unreachable)",
+                 func=lambda: events.stats()["dropped"])
+registry.counter("subscriber_retention_partitions_dropped_total", "Expired raw partitions archived and dropped",
+                 func=lambda: retention_job.stats()["partitions_dropped"])
+registry.counter("subscriber_retention_errors_total", "Failed retention runs",
+                 func=lambda: retention_job.stats()["errors"])
+registry.counter("subscriber_alerts_total", "Alerts raised, by kind", ("kind",),
+                 func=lambda: alert_engine.stats()["alerts"])
+registry.counter("subscriber_alert_notifications_sent_total", "Alerts mailed",
+                 func=lambda: notifier.stats()["sent"])
+registry.counter("subscriber_alert_notifications_dropped_total", "Alerts dropped from a full notification queue",
+                 func=lambda: notifier.stats()["dropped"])
+registry.counter("subscriber_alert_send_errors_total", "Failed alert email sends",
+                 func=lambda: notifier.stats()["errors"])
+registry.counter("subscriber_alert_notifications_failed_total", "Alerts given up on after repeated failed sends",
+                 func=lambda: notifier.stats()["failed"])
+registry.gauge("subscriber_devices_known", "Device owners with a cached device id",
+               func=lambda: device_resolver.stats()["devices"])
+registry.gauge("subscriber_db_pool_in_use", "Pooled database connections in use",
+               func=lambda: db.get_pool().stats()["in_use"])
+registry.gauge("subscriber_db_pool_wait_seconds", "Recent waits for a pooled connection", ("quantile",),
+               func=lambda: {q: db.get_pool().stats()[f"wait_p{q}"] for q in (50, 95, 99)})
 
 # Insert data into a table
 def insert_data(table_name, values):
     try:
-        conn = connect_db()
-        cur = conn.cursor()
-
-        if table_name == "ldr_data":
-            query = "INSERT INTO ldr_data (timestamp, value, device_owner) VALUES (%s, %s, %s);"
-        elif table_name == "ultrasound_data":
-            query = "INSERT INTO ultrasound_data (timestamp, value, device_owner) VALUES (%s, %s, %s);"
-        elif table_name == "empty_box_status":
-            query = "INSERT INTO empty_box_status (timestamp, status, distance, device_owner) VALUES (%s, %s, %s, %s);"
-        elif table_name == "battery_data":
-            query = "INSERT INTO battery_data (timestamp, voltage, percentage, device_owner) VALUES (%s, %s, %s, %s);"
-
-        cur.execute(query, values)
-        conn.commit()
-        print(f"Data inserted into '{table_name}': {values}")
-    except mysql.connector.Error as err:
-        print(f"MySQL error while inserting data into '{table_name}': {err}")
-    finally:
-        conn.close()
+        # The raw tables and the rollups store the device id; the latest state, alerts and deadband work on
+        # owner names
+        row = values[:-1] + (device_resolver.resolve(values[-1]),)
+        rollups.record(table_name, row)
+        latest_state.record(table_name, values)
+        if ALERTS:
+            alert_engine.observe(table_name, values)
+        if not deadband.should_store(table_name, values):
+            print(f"Reading for '{table_name}' within deadband, not stored: {values}")
+            return
+        writer.add(table_name, row)
+        ROWS_BUFFERED.inc(table=table_name)
+        if LIVE_EVENTS:
+            events.add(table_name, values)
+        print(f"Data buffered for '{table_name}': {values}")
+    except ValueError as err:
+        print(f"Error while buffering data for '{table_name}': {err}")
 
 # MQTT Client Setup
 def connect_mqtt():
@@ -179,15 +358,54 @@ def connect_mqtt():
 def on_connect(client, userdata, flags, rc):
     print(f"Connected to MQTT broker with result code: {rc}")
     # Subscribe to topics after connection
-    client.subscribe([("sensor/ldr", 0), ("esp32/ultrasound_data", 0), ("esp32/empty_box_status", 0), ("battery/percentage", 0)])
+    client.subscribe([(topic, 0) for topic in TOPICS])
 
 # Main function to run the subscriber
 def main():
+    # Create/upgrade the tables once at startup instead of on every message
+    schema.migrate()
+    print(f"Loaded the ids of {device_resolver.load()} known devices")
+
     client = connect_mqtt()
     if client:
         # Start listening for messages
         print("Waiting for messages...")
-        client.loop_forever()  # Block and listen for messages
+        writer.start()
+        pipeline.start()
+        if LIVE_EVENTS:
+            events.client = client
+            events.start()
+        retention_job.start()
+        if ALERTS:
+            # Pick up the devices known before a restart, so silent ones are still noticed
+            try:
+                with db.connection() as conn:
+                    print(f"Alert rules loaded the state of {alert_engine.load(conn)} devices")
+            except Exception as err:
+                print(f"Could not load the device states for alerting: {err}")
+            notifier.start()
+            alert_engine.start()
+        if METRICS_PORT:
+            metrics.serve(registry, METRICS_PORT)
+            print(f"Serving metrics on port {METRICS_PORT}")
+        try:
+            client.loop_forever()  # Block and listen for messages
+        except KeyboardInterrupt:
+            print("Exiting...")
+        finally:
+            # Work off the queue, then write out anything still buffered before shutting down
+            pipeline.stop()
+            writer.close()
+            events.close()
+            retention_job.close()
+            alert_engine.close()
+            notifier.close(timeout=alerts.DEFAULT_RETRY_DELAY)
+            print(f"Pipeline stats: {pipeline.stats()}")
+            print(f"Writer stats: {writer.stats()}")
+            print(f"Deadband stats: {deadband.stats()}")
+            print(f"Live event stats: {events.stats()}")
+            print(f"Alert stats: {alert_engine.stats()}, notifications: {notifier.stats()}")
+            print(f"Pool stats: {db.get_pool().stats()}")
 
 if __name__ == "__main__":
     main()
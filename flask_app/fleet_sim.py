@@ -0,0 +1,220 @@
+import argparse
+import heapq
+import json
+import random
+import time
+import types
+
+import paho.mqtt.client as mqtt
+
+import final_pub
+import wire_format
+
+# Emulates a fleet of final_pub.py devices: same topics, same JSON/binary/batched payloads, at configurable
+# rates. Messages can be handed straight to final_sub.on_message (see bench_ingest.py) or published to a broker.
+
+# Defaults taken from the publisher so the simulated load follows it
+DEFAULT_DISTANCE_INTERVAL = final_pub.DISTANCE_PUBLISH_INTERVAL
+DEFAULT_BATTERY_INTERVAL = final_pub.BATTERY_INTERVAL
+DEFAULT_LDR_PER_HOUR = 4.0  # Lid openings per device and hour
+DEFAULT_BOX_PER_HOUR = 1.0  # Box empty/full changes per device and hour
+FIRST_DEVICE_ID = 1000  # Simulated device ids start here so they never collide with final_sub.DEVICE_IDS
+
+
+class SimulatedDevice:
+    """One publisher: sampling schedule, batching and payload encoding of final_pub.py."""
+
+    def __init__(self, device_id, rng, wire="binary", batch=True, distance_interval=DEFAULT_DISTANCE_INTERVAL,
+                 battery_interval=DEFAULT_BATTERY_INTERVAL, ldr_per_hour=DEFAULT_LDR_PER_HOUR,
+                 box_per_hour=DEFAULT_BOX_PER_HOUR):
+        self.device_id = device_id
+        self.owner = f"device-{device_id}"  # What final_sub.py stores for an unknown binary device id
+        self.rng = rng
+        self.wire = wire
+        self.batch = batch
+        self.distance_interval = distance_interval
+        self.battery_interval = battery_interval
+        self.ldr_per_hour = ldr_per_hour
+        self.box_per_hour = box_per_hour
+
+        self.distance = rng.uniform(0.5, 2.5)
+        self.voltage = rng.uniform(3.7, 4.2)
+        self.box_empty = False
+        self._batches = {}  # topic -> [[epoch, value...], ...]
+        self._batch_started = {}
+
+    def first_events(self, start):
+        """(time, kind) of the first event of every kind, staggered so devices do not fire in step."""
+        events = [(start + self.rng.uniform(0, self.distance_interval), "distance"),
+                  (start + self.rng.uniform(0, self.battery_interval), "battery")]
+        for kind, per_hour in (("ldr", self.ldr_per_hour), ("box", self.box_per_hour)):
+            if per_hour > 0:
+                events.append((start + self.rng.expovariate(per_hour / 3600.0), kind))
+        return events
+
+    def fire(self, now, kind):
+        """Run one scheduled event. Returns (next time, messages) where messages are (topic, payload)."""
+        if kind == "distance":
+            self.distance = min(max(self.distance + self.rng.uniform(-0.3, 0.3), 0.5), 4.0)
+            return now + self.distance_interval, self.reading(now, final_pub.MQTT_TOPIC_DISTANCE,
+                                                              {"distance": self.distance})
+        if kind == "battery":
+            self.voltage = max(final_pub.MIN_VOLTAGE, self.voltage - self.rng.uniform(0, 0.0005))
+            data = {"voltage": self.voltage, "percentage": final_pub.calculate_battery_percentage(self.voltage)}
+            return now + self.battery_interval, self.reading(now, final_pub.MQTT_TOPIC_BATTERY, data)
+        if kind == "ldr":
+            return now + self.rng.expovariate(self.ldr_per_hour / 3600.0), \
+                self.reading(now, final_pub.MQTT_TOPIC_LDR, {"value": 1})
+        self.box_empty = not self.box_empty
+        data = {"status": "empty" if self.box_empty else "full", "distance": 3.5 if self.box_empty else 1.0}
+        return now + self.rng.expovariate(self.box_per_hour / 3600.0), \
+            self.reading(now, final_pub.MQTT_TOPIC_EMPTY_BOX, data)
+
+    def reading(self, now, topic, data):
+        """Encode a reading the way final_pub.send_reading() does; batched topics may yield nothing yet."""
+        epoch = int(now)
+        if not self.batch or topic not in final_pub.BATCH_TOPICS:
+            return [(topic, self.encode_single(topic, data, epoch))]
+        samples = self._batches.setdefault(topic, [])
+        self._batch_started.setdefault(topic, now)
+        samples.append([epoch] + [data[field] for field in final_pub.BATCH_FIELDS[topic]])
+        if len(samples) >= final_pub.BATCH_MAX_SAMPLES or now - self._batch_started[topic] >= final_pub.BATCH_WINDOW:
+            return [self.flush(topic)]
+        return []
+
+    def encode_single(self, topic, data, epoch):
+        if self.wire == "binary":
+            sample = [epoch] + [data[field] for field in final_pub.BATCH_FIELDS[topic]]
+            return wire_format.encode(topic, self.device_id, [sample])
+        data = dict(data, device_owner=self.owner, timestamp=final_pub.get_current_time(epoch))
+        return json.dumps(data).encode()
+
+    def flush_all(self):
+        """Encode every pending batch, as final_pub.py does when it shuts down. Returns (topic, payload) pairs."""
+        return [self.flush(topic) for topic in list(self._batches)]
+
+    def flush(self, topic):
+        samples = self._batches.pop(topic)
+        self._batch_started.pop(topic)
+        if self.wire == "binary":
+            return topic, wire_format.encode(topic, self.device_id, samples)
+        payload = {"device_owner": self.owner, "fields": list(final_pub.BATCH_FIELDS[topic]), "samples": samples}
+        return topic, json.dumps(payload).encode()
+
+
+class FleetSimulator:
+    """Merges the event schedules of `devices` simulated publishers into one time-ordered message stream."""
+
+    def __init__(self, devices, seed=None, start=None, **device_args):
+        self.rng = random.Random(seed)
+        self.start = time.time() if start is None else start
+        self.devices = [SimulatedDevice(FIRST_DEVICE_ID + i, self.rng, **device_args) for i in range(devices)]
+
+    def messages(self, duration):
+        """Yield (simulated time, topic, payload) for `duration` simulated seconds.
+
+        Batches still open at the end are sent at the end time, so that short runs measure something and batched
+        and unbatched runs carry the same readings.
+        """
+        heap = []
+        for index, device in enumerate(self.devices):
+            for when, kind in device.first_events(self.start):
+                heapq.heappush(heap, (when, index, kind))
+        end = self.start + duration
+        while heap and heap[0][0] < end:
+            now, index, kind = heapq.heappop(heap)
+            next_time, messages = self.devices[index].fire(now, kind)
+            heapq.heappush(heap, (next_time, index, kind))
+            for topic, payload in messages:
+                yield now, topic, payload
+        for device in self.devices:
+            for topic, payload in device.flush_all():
+                yield end, topic, payload
+
+    def run(self, send, duration, speed=1.0):
+        """Send every message through send(topic, payload, content_type).
+
+        `speed` is simulated seconds per real second (60 plays an hour of fleet traffic in a minute);
+        0 sends as fast as possible. Returns the number of messages sent.
+        """
+        started = time.monotonic()
+        sent = 0
+        for when, topic, payload in self.messages(duration):
+            if speed > 0:
+                delay = (when - self.start) / speed - (time.monotonic() - started)
+                if delay > 0:
+                    time.sleep(delay)
+            content_type = wire_format.CONTENT_TYPE if wire_format.is_binary(payload) else wire_format.JSON_CONTENT_TYPE
+            send(topic, payload, content_type)
+            sent += 1
+        return sent
+
+
+# Sender that calls a paho on_message callback directly, without a broker
+def direct_sender(on_message):
+    def send(topic, payload, content_type):
+        message = types.SimpleNamespace(topic=topic, payload=payload,
+                                        properties=types.SimpleNamespace(ContentType=content_type))
+        on_message(None, None, message)
+    return send
+
+
+# Sender that publishes to an MQTT broker (plain TCP, for a local test broker)
+def broker_sender(host, port=1883, qos=0):
+    client = mqtt.Client()
+    client.connect(host, port, 60)
+    client.loop_start()
+
+    def send(topic, payload, content_type):
+        client.publish(topic, payload, qos=qos)
+    send.client = client
+    return send
+
+
+# Command-line options shared with bench_ingest.py
+def add_fleet_arguments(parser):
+    parser.add_argument("--devices", type=int, default=10, help="Number of simulated publishers")
+    parser.add_argument("--duration", type=float, default=600, help="Simulated seconds of traffic")
+    parser.add_argument("--speed", type=float, default=0,
+                        help="Simulated seconds per real second (0 = as fast as possible)")
+    parser.add_argument("--wire", choices=("binary", "json"), default=final_pub.WIRE_FORMAT)
+    parser.add_argument("--no-batch", dest="batch", action="store_false", help="Send every reading on its own")
+    parser.add_argument("--distance-interval", type=float, default=DEFAULT_DISTANCE_INTERVAL)
+    parser.add_argument("--battery-interval", type=float, default=DEFAULT_BATTERY_INTERVAL)
+    parser.add_argument("--ldr-per-hour", type=float, default=DEFAULT_LDR_PER_HOUR)
+    parser.add_argument("--box-per-hour", type=float, default=DEFAULT_BOX_PER_HOUR)
+    parser.add_argument("--seed", type=int, default=1)
+
+
+def simulator_from_args(args, start=None):
+    return FleetSimulator(args.devices, seed=args.seed, start=start, wire=args.wire, batch=args.batch,
+                          distance_interval=args.distance_interval, battery_interval=args.battery_interval,
+                          ldr_per_hour=args.ldr_per_hour, box_per_hour=args.box_per_hour)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Publish simulated fleet traffic to an MQTT broker")
+    add_fleet_arguments(parser)
+    parser.add_argument("--broker", default="localhost", help="Broker host")
+    parser.add_argument("--port", type=int, default=1883)
+    parser.add_argument("--qos", type=int, default=0, choices=(0, 1))
+    parser.set_defaults(speed=1.0)  # Real time by default when publishing to a broker
+    args = parser.parse_args()
+
+    send = broker_sender(args.broker, args.port, args.qos)
+    started = time.monotonic()
+    try:
+        sent = simulator_from_args(args).run(send, args.duration, args.speed)
+    except KeyboardInterrupt:
+        sent = None
+    finally:
+        send.client.loop_stop()
+        send.client.disconnect()
+    elapsed = time.monotonic() - started
+    if sent is not None:
+        print(f"Published {sent} messages from {args.devices} devices in {elapsed:.1f} s "
+              f"({sent / elapsed:.1f} msg/s)")
+
+
+if __name__ == "__main__":
+    main()
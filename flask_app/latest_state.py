@@ -0,0 +1,87 @@
+import threading
+
+# Upsert that merges a device's newest readings into its device_latest_state row. Every reading column is
+# assigned before its timestamp column (MySQL applies assignments in order), and only replaced by a reading
+# that is at least as new, so out-of-order batches never move a device back in time.
+LATEST_STATE_QUERIES = {
+    "device_latest_state": """
+        INSERT INTO device_latest_state (device_owner, last_seen, distance, distance_at, box_status, box_distance,
+                                         box_status_at, battery_voltage, battery_percentage, battery_at,
+                                         last_ldr_open_at)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE
+            distance = IF(VALUES(distance_at) >= COALESCE(distance_at, VALUES(distance_at)),
+                          VALUES(distance), distance),
+            distance_at = GREATEST(COALESCE(distance_at, VALUES(distance_at)),
+                                   COALESCE(VALUES(distance_at), distance_at)),
+            box_status = IF(VALUES(box_status_at) >= COALESCE(box_status_at, VALUES(box_status_at)),
+                            VALUES(box_status), box_status),
+            box_distance = IF(VALUES(box_status_at) >= COALESCE(box_status_at, VALUES(box_status_at)),
+                              VALUES(box_distance), box_distance),
+            box_status_at = GREATEST(COALESCE(box_status_at, VALUES(box_status_at)),
+                                     COALESCE(VALUES(box_status_at), box_status_at)),
+            battery_voltage = IF(VALUES(battery_at) >= COALESCE(battery_at, VALUES(battery_at)),
+                                 VALUES(battery_voltage), battery_voltage),
+            battery_percentage = IF(VALUES(battery_at) >= COALESCE(battery_at, VALUES(battery_at)),
+                                    VALUES(battery_percentage), battery_percentage),
+            battery_at = GREATEST(COALESCE(battery_at, VALUES(battery_at)), COALESCE(VALUES(battery_at), battery_at)),
+            last_ldr_open_at = GREATEST(COALESCE(last_ldr_open_at, VALUES(last_ldr_open_at)),
+                                        COALESCE(VALUES(last_ldr_open_at), last_ldr_open_at)),
+            last_seen = GREATEST(last_seen, VALUES(last_seen));
+    """,
+}
+
+# Reading columns per raw table: (timestamp column, reading columns in insert order after the timestamp)
+STATE_COLUMNS = {
+    "ultrasound_data": ("distance_at", ("distance",)),
+    "empty_box_status": ("box_status_at", ("box_status", "box_distance")),
+    "battery_data": ("battery_at", ("battery_voltage", "battery_percentage")),
+    "ldr_data": ("last_ldr_open_at", ()),
+}
+
+# Columns of the upsert after device_owner and last_seen
+COLUMNS = ("distance", "distance_at", "box_status", "box_distance", "box_status_at", "battery_voltage",
+           "battery_percentage", "battery_at", "last_ldr_open_at")
+
+
+class LatestState:
+    """Keep the newest reading of every kind per device; drained into the batch writer on every flush.
+
+    However many readings arrive between two flushes, each device costs one upsert row, so the table
+    stays one row per device and the fleet overview reads it without touching the history.
+    """
+
+    queries = LATEST_STATE_QUERIES
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._devices = {}  # device_owner -> {column: value, "last_seen": timestamp}
+
+    def record(self, table_name, values):
+        """Fold one raw row (as passed to insert_data) into the device's latest state."""
+        if table_name not in STATE_COLUMNS:
+            return
+        if table_name == "ldr_data" and values[1] != 1:
+            return  # Only openings are stored and shown
+        time_column, columns = STATE_COLUMNS[table_name]
+        timestamp = values[0].replace(tzinfo=None)
+        device_owner = values[-1]
+        with self._lock:
+            state = self._devices.setdefault(device_owner, {"last_seen": timestamp})
+            if timestamp > state["last_seen"]:
+                state["last_seen"] = timestamp
+            if state.get(time_column) is None or timestamp >= state[time_column]:
+                state[time_column] = timestamp
+                state.update(zip(columns, values[1:-1]))
+
+    def pending(self):
+        with self._lock:
+            return bool(self._devices)
+
+    def drain(self):
+        """Return one upsert row per device seen since the last drain."""
+        with self._lock:
+            devices, self._devices = self._devices, {}
+        rows = [(owner, state["last_seen"]) + tuple(state.get(column) for column in COLUMNS)
+                for owner, state in devices.items()]
+        return {"device_latest_state": rows}
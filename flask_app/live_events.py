@@ -0,0 +1,333 @@
+import hashlib
+import hmac
+import json
+import queue
+import ssl
+import threading
+import time
+from datetime import datetime
+
+import paho.mqtt.client as mqtt
+
+# Live dashboard events: final_sub.py publishes the readings it stores on EVENTS_TOPIC, the dashboard
+# subscribes once per process and fans them out to its Server-Sent Events connections.
+#
+# The events carry every patient's readings over the broker the devices use, so they must not be readable or
+# writable with a device credential. EVENTS_TOPIC sits outside the device topics; restrict it in the broker's
+# ACL to the subscriber (write) and the dashboard (read), e.g. for Mosquitto:
+#
+#   user <subscriber user>
+#   topic write internal/dashboard/events
+#   user <dashboard user>
+#   topic read internal/dashboard/events
+#
+# Each batch is also signed with HMAC-SHA256 under a secret shared by final_sub.py and the dashboard, and carries
+# its send time: the dashboard drops batches that are unsigned, forged or older than `max_age` (replays), so even
+# a misconfigured ACL cannot inject events into logged-in dashboards.
+
+EVENTS_TOPIC = "internal/dashboard/events"
+
+# Defaults
+DEFAULT_PUBLISH_INTERVAL = 0.5  # Seconds between event batches published by the subscriber
+DEFAULT_MAX_PENDING = 5000  # Events buffered by the subscriber before the oldest are dropped
+DEFAULT_QUEUE_SIZE = 1000  # Event batches queued per SSE connection before a slow viewer loses events
+DEFAULT_MAX_AGE = 60.0  # Seconds a signed batch stays acceptable (delivery delay plus clock skew between hosts)
+
+# Event type and reading fields per table, in insert order (timestamp first, device_owner last)
+TABLE_EVENTS = {
+    "ultrasound_data": ("ultrasound", ("distance",)),
+    "ldr_data": ("ldr", ("value",)),
+    "empty_box_status": ("box", ("status", "distance")),
+    "battery_data": ("battery", ("voltage", "percentage")),
+}
+
+# Epoch used to send wall-clock timestamps to the browser, as in the JSON series API
+EPOCH = datetime(1970, 1, 1)
+
+
+def make_event(table, values, tz=None):
+    """Build the event for one stored row, or None for tables without live events.
+
+    `t` is milliseconds since the epoch in wall-clock time of `tz` (like the series API), `time` is the
+    same instant formatted the way the dashboard tables show it.
+    """
+    if table not in TABLE_EVENTS:
+        return None
+    kind, fields = TABLE_EVENTS[table]
+    timestamp = values[0]
+    if tz is not None and timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(tz)
+    timestamp = timestamp.replace(tzinfo=None, microsecond=0)
+    event = {"type": kind, "owner": values[-1], "t": int((timestamp - EPOCH).total_seconds() * 1000),
+             "time": str(timestamp)}
+    event.update(zip(fields, values[1:-1]))
+    return event
+
+
+def format_sse(event):
+    """Encode one event as a Server-Sent Events message."""
+    return f"event: {event['type']}\ndata: {json.dumps(event, separators=(',', ':'))}\n\n"
+
+
+def _key(secret):
+    if not secret:
+        raise ValueError("Live events need a shared secret")
+    return secret.encode() if isinstance(secret, str) else secret
+
+
+def sign_batch(secret, events, now=None):
+    """Encode a batch of events as the message published on EVENTS_TOPIC: hex HMAC-SHA256, a space, JSON body."""
+    body = json.dumps({"sent": time.time() if now is None else now, "events": events},
+                      separators=(',', ':'), default=str).encode()
+    return hmac.new(_key(secret), body, hashlib.sha256).hexdigest().encode() + b" " + body
+
+
+def verify_batch(secret, payload, max_age=DEFAULT_MAX_AGE, now=None):
+    """Return the events of a message built by sign_batch(), or None if it is unsigned, forged or too old."""
+    signature, _, body = bytes(payload).partition(b" ")
+    expected = hmac.new(_key(secret), body, hashlib.sha256).hexdigest().encode()
+    if not hmac.compare_digest(signature, expected):
+        return None
+    try:
+        batch = json.loads(body)
+        sent, events = float(batch["sent"]), batch["events"]
+    except (ValueError, TypeError, KeyError):
+        return None
+    if abs((time.time() if now is None else now) - sent) > max_age or not isinstance(events, list):
+        return None
+    return [event for event in events if isinstance(event, dict)]
+
+
+def mqtt_client(host, port, tls=False, username=None, password=None):
+    """Connect (asynchronously) to the broker that carries the events; the caller starts the loop."""
+    client = mqtt.Client()
+    if tls:
+        client.tls_set(cert_reqs=ssl.CERT_NONE, tls_version=ssl.PROTOCOL_TLSv1_2)
+        client.tls_insecure_set(True)
+    if username:
+        client.username_pw_set(username=username, password=password)
+    client.connect_async(host, port, 60)
+    return client
+
+
+class EventPublisher:
+    """Collects the rows the subscriber stores and publishes them as signed batches (sign_batch()), one batch
+    per interval.
+
+    Events are best effort: while no client is set or the broker is unreachable, at most `max_pending`
+    events are kept and the oldest are dropped first.
+    """
+
+    def __init__(self, secret, client=None, topic=EVENTS_TOPIC, interval=DEFAULT_PUBLISH_INTERVAL,
+                 max_pending=DEFAULT_MAX_PENDING, tz=None):
+        self._key = _key(secret)
+        self.client = client
+        self.topic = topic
+        self.interval = interval
+        self.max_pending = max_pending
+        self.tz = tz
+
+        self._pending = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+        # Counters
+        self.published = 0
+        self.batches = 0
+        self.dropped = 0
+
+    def start(self):
+        """Start the background thread that publishes the buffered events."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="event-publisher", daemon=True)
+            self._thread.start()
+        return self
+
+    def add(self, table, values):
+        """Buffer the event for one stored row."""
+        event = make_event(table, values, self.tz)
+        if event is None:
+            return
+        with self._lock:
+            self._pending.append(event)
+            excess = len(self._pending) - self.max_pending
+            if excess > 0:
+                del self._pending[:excess]
+                self.dropped += excess
+
+    def flush(self):
+        """Publish the buffered events as one message. Returns the number of events sent."""
+        client = self.client
+        if client is None:
+            return 0
+        with self._lock:
+            events, self._pending = self._pending, []
+        if not events:
+            return 0
+        info = client.publish(self.topic, sign_batch(self._key, events), qos=0)
+        if info.rc != mqtt.MQTT_ERR_SUCCESS:
+            self.dropped += len(events)  # Not connected: live viewers catch up on their next page load
+            return 0
+        self.published += len(events)
+        self.batches += 1
+        return len(events)
+
+    def close(self):
+        """Stop the background thread and publish whatever is still buffered."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def stats(self):
+        with self._lock:
+            pending = len(self._pending)
+        return {"pending": pending, "published": self.published, "batches": self.batches, "dropped": self.dropped}
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.flush()
+            except Exception as err:
+                print(f"Error while publishing live events: {err}")
+
+
+class Subscription:
+    """One SSE connection: a bounded queue of event batches, optionally for a single device owner."""
+
+    def __init__(self, hub, owner=None, max_queue=DEFAULT_QUEUE_SIZE):
+        self.hub = hub
+        self.owner = owner
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.dropped = 0
+
+    def put(self, events):
+        if self.owner is not None:
+            events = [event for event in events if event.get("owner") == self.owner]
+        if not events:
+            return
+        try:
+            self.queue.put_nowait(events)
+        except queue.Full:
+            self.dropped += len(events)  # A viewer that stopped reading must not hold up the others
+
+    def get(self, timeout):
+        """Wait up to `timeout` seconds for events and return all that are queued (empty list on timeout)."""
+        try:
+            events = list(self.queue.get(timeout=timeout))
+        except queue.Empty:
+            return []
+        while True:
+            try:
+                events.extend(self.queue.get_nowait())
+            except queue.Empty:
+                return events
+
+    def close(self):
+        self.hub.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class EventHub:
+    """Receives event batches from the broker on one MQTT connection and fans them out to subscriptions.
+
+    Only batches signed with `secret` and at most `max_age` seconds old are accepted; anything else is
+    counted as invalid and dropped. The cost per viewer is one queue put per event batch that concerns it,
+    independent of how often the dashboard would otherwise have been reloaded.
+    """
+
+    def __init__(self, client_factory, secret, topic=EVENTS_TOPIC, max_queue=DEFAULT_QUEUE_SIZE,
+                 max_age=DEFAULT_MAX_AGE):
+        self.client_factory = client_factory  # Callable returning a paho client (see mqtt_client)
+        self._key = _key(secret)
+        self.topic = topic
+        self.max_queue = max_queue
+        self.max_age = max_age
+
+        self._subscriptions = set()
+        self._lock = threading.Lock()
+        self._client = None
+
+        # Counters
+        self.received = 0
+        self.invalid = 0
+        self.connected = False
+
+    def start(self):
+        """Connect to the broker and start its network thread (paho reconnects on its own)."""
+        with self._lock:
+            if self._client is not None:
+                return self
+            client = self._client = self.client_factory()
+        client.on_connect = self._on_connect
+        client.on_disconnect = self._on_disconnect
+        client.on_message = self._on_message
+        client.loop_start()
+        return self
+
+    def stop(self):
+        with self._lock:
+            client, self._client = self._client, None
+        if client is not None:
+            client.loop_stop()
+            client.disconnect()
+
+    def subscribe(self, owner=None):
+        subscription = Subscription(self, owner, self.max_queue)
+        with self._lock:
+            self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def publish(self, events):
+        """Hand a batch of events to every subscription (also used directly in tests and benchmarks)."""
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            subscription.put(events)
+        self.received += len(events)
+
+    def stats(self):
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        return {"connected": self.connected, "subscribers": len(subscriptions), "received": self.received,
+                "invalid": self.invalid, "dropped": sum(subscription.dropped for subscription in subscriptions)}
+
+    def _on_connect(self, client, userdata, flags, rc):
+        self.connected = rc == 0
+        if self.connected:
+            client.subscribe(self.topic, qos=0)
+
+    def _on_disconnect(self, client, userdata, rc):
+        self.connected = False
+
+    def _on_message(self, client, userdata, message):
+        events = verify_batch(self._key, message.payload, self.max_age)
+        if events is None:
+            self.invalid += 1  # Not from the subscriber (or replayed): never reaches a dashboard
+            return
+        self.publish(events)
+
+
+# Body of a Server-Sent Events response: event batches for `owner` (all devices if None) as they arrive,
+# and a keepalive comment when nothing arrived for `keepalive` seconds
+def stream(hub, owner=None, keepalive=15.0, retry_ms=5000):
+    # Subscribe only once the response is being sent, so a stream that never starts leaves nothing behind
+    with hub.subscribe(owner) as subscription:
+        yield f"retry: {retry_ms}\n\n"
+        while True:
+            events = subscription.get(timeout=keepalive)
+            if events:
+                yield "".join(format_sse(event) for event in events)
+            else:
+                yield ": keepalive\n\n"  # Keeps proxies from closing an idle connection and detects gone viewers
@@ -0,0 +1,261 @@
+import math
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Prometheus text exposition format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Default histogram buckets in seconds, from 1 ms to 10 s
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if value == -math.inf:
+        return "-Inf"
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+class Metric:
+    """Base class: a named metric with a fixed set of label names."""
+
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError(f"Metric {self.name} expects labels {self.labels}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def samples(self):
+        """Yield (sample name, [(label, value), ...], value)."""
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name, documentation, labels=()):
+        super().__init__(name, documentation, labels)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            yield self.name, list(zip(self.labels, key)), value
+
+
+class Gauge(Metric):
+    """Gauge set directly, or read from `func` at scrape time.
+
+    `func` returns a number, or a dict mapping a label value (a tuple for several labels) to a number.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labels=(), func=None):
+        super().__init__(name, documentation, labels)
+        self.func = func
+        self._values = {}
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def samples(self):
+        if self.func is None:
+            with self._lock:
+                values = dict(self._values)
+        else:
+            try:
+                result = self.func()
+            except Exception:
+                return  # A failing source (e.g. pool not initialised) must not break the whole scrape
+            if not isinstance(result, dict):
+                values = {(): result}
+            else:
+                values = {key if isinstance(key, tuple) else (key,): value for key, value in result.items()}
+        for key, value in sorted(values.items()):
+            if value is not None:
+                yield self.name, list(zip(self.labels, key)), value
+
+
+class CallbackCounter(Gauge):
+    """Counter whose value is kept elsewhere (for example in a component's stats()) and read at scrape time."""
+
+    kind = "counter"
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._values = {}  # label key -> [bucket counts..., sum, count]
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[i] += 1
+                    break
+            entry[-2] += value
+            entry[-1] += 1
+
+    def samples(self):
+        with self._lock:
+            values = {key: list(entry) for key, entry in self._values.items()}
+        for key, entry in sorted(values.items()):
+            labels = list(zip(self.labels, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets, entry):
+                cumulative += count
+                yield self.name + "_bucket", labels + [("le", _format_value(bound))], cumulative
+            yield self.name + "_sum", labels, entry[-2]
+            yield self.name + "_count", labels, entry[-1]
+
+
+class Registry:
+    """The metrics of one process, rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if any(existing.name == metric.name for existing in self._metrics):
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labels=(), func=None):
+        if func is not None:
+            return self.register(CallbackCounter(name, documentation, labels, func))
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name, documentation, labels=(), func=None):
+        return self.register(Gauge(name, documentation, labels, func))
+
+    def histogram(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {_escape(metric.documentation)}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+class StageTimer:
+    """Times named stages of a request.
+
+    Every stage is observed in `histogram` (labels: endpoint, stage). Between begin() and end() on the same
+    thread the stages are also collected, so a slow request can be logged with its breakdown.
+    """
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self._local = threading.local()
+
+    def begin(self, endpoint):
+        self._local.endpoint = endpoint or ""
+        self._local.stages = []
+
+    def end(self):
+        """Stop tracking this thread's request and return its [(stage, seconds), ...]."""
+        stages = getattr(self._local, "stages", None) or []
+        self._local.stages = None
+        self._local.endpoint = ""
+        return stages
+
+    def context(self):
+        """The request being tracked on this thread, to hand to worker threads with attach()."""
+        return getattr(self._local, "endpoint", ""), getattr(self._local, "stages", None)
+
+    @contextmanager
+    def attach(self, context):
+        """Book the stages of a worker thread to the request that submitted the work."""
+        self._local.endpoint, self._local.stages = context
+        try:
+            yield
+        finally:
+            self._local.endpoint, self._local.stages = "", None
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started)
+
+    def record(self, name, seconds):
+        """Book a stage timed elsewhere, for example in a worker process."""
+        self.histogram.observe(seconds, endpoint=getattr(self._local, "endpoint", ""), stage=name)
+        stages = getattr(self._local, "stages", None)
+        if stages is not None:
+            stages.append((name, seconds))
+
+
+def serve(registry, port, host=""):
+    """Serve GET /metrics from a daemon thread (for processes without a web server)."""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # Scrapes every few seconds would drown the subscriber's own output
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True)
+    thread.start()
+    return server
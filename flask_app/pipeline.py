@@ -0,0 +1,249 @@
+import base64
+import collections
+import json
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+# What to do when the queue is full
+POLICIES = ("block", "drop_oldest", "spill")
+
+# Defaults
+DEFAULT_WORKERS = 2
+DEFAULT_QUEUE_SIZE = 10000
+DEFAULT_BLOCK_TIMEOUT = 5.0  # Seconds the "block" policy waits before dropping the message
+DEFAULT_SPILL_PATH = "ingest_spill.jsonl"
+REPLAY_SUFFIX = ".replay"  # The spill file is renamed to this while it is being replayed
+DEFAULT_REPORT_INTERVAL = 60.0  # Seconds between printed pipeline stats (0 disables)
+
+_STOP = object()
+
+
+class IngestPipeline:
+    """Bounded queue between the MQTT network thread and a pool of worker threads.
+
+    The MQTT callback only calls submit(); workers call handler(topic, payload, received_at, content_type)
+    where received_at is the wall-clock time the message arrived (so queueing lag never shifts timestamps)
+    and content_type is the MQTT 5 content type, if any.
+    """
+
+    def __init__(self, handler, workers=DEFAULT_WORKERS, max_queue=DEFAULT_QUEUE_SIZE, policy="block",
+                 block_timeout=DEFAULT_BLOCK_TIMEOUT, spill_path=DEFAULT_SPILL_PATH,
+                 report_interval=DEFAULT_REPORT_INTERVAL, tz=None):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown backpressure policy '{policy}', expected one of {POLICIES}")
+        self.handler = handler
+        self.workers = workers
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.spill_path = spill_path
+        self.report_interval = report_interval
+        self.tz = tz  # Timezone for received_at (None for naive local time)
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._threads = []
+        self._stop = threading.Event()
+        self._spill_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._started = time.monotonic()
+
+        # Metrics
+        self.received = 0
+        self.processed = 0
+        self.errors = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.replayed = 0
+        self.max_depth = 0
+        # Spilled messages left by an earlier run, also one that crashed while replaying, are replayed first
+        self._spill_pending = os.path.exists(spill_path) or os.path.exists(spill_path + REPLAY_SUFFIX)
+        self._lags = collections.deque(maxlen=1000)  # Recent queue lags in seconds, for percentiles
+        self._max_lag = 0.0
+        self._per_topic = collections.Counter()
+        self._per_topic_window = collections.Counter()
+        self._window_started = time.monotonic()
+        self._last_rates = {}
+
+    def start(self):
+        """Start the worker threads (and the spill replay / reporting thread)."""
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"ingest-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        self._monitor = threading.Thread(target=self._monitor_loop, name="ingest-monitor", daemon=True)
+        self._monitor.start()
+        return self
+
+    def submit(self, topic, payload, content_type=None):
+        """Enqueue a raw message. Never parses or touches the database, so it is safe on the MQTT thread."""
+        item = (topic, bytes(payload), datetime.now(self.tz), time.monotonic(), content_type)
+        with self._stats_lock:
+            self.received += 1
+
+        if self.policy == "block":
+            try:
+                self._queue.put(item, timeout=self.block_timeout)
+            except queue.Full:
+                self._count_drop()
+                print(f"Ingest queue full for {self.block_timeout}s, dropped message on {topic}")
+                return False
+        elif self.policy == "drop_oldest":
+            while True:
+                try:
+                    self._queue.put_nowait(item)
+                    break
+                except queue.Full:
+                    try:
+                        self._queue.get_nowait()
+                        self._queue.task_done()
+                        self._count_drop()
+                    except queue.Empty:
+                        pass
+        else:  # spill
+            with self._spill_lock:
+                # Keep arrival order: once spilling started, new messages go behind the spilled ones
+                if self._spill_pending or not self._offer(item):
+                    self._write_spill(item)
+
+        depth = self._queue.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+        return True
+
+    def stop(self, drain=True, timeout=30.0):
+        """Stop the workers, by default after the queue has been worked off."""
+        if drain:
+            deadline = time.monotonic() + timeout
+            while (self._queue.unfinished_tasks or self._spill_pending) and time.monotonic() < deadline:
+                time.sleep(0.05)
+        self._stop.set()
+        for _ in self._threads:
+            self._queue.put(_STOP)
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def stats(self):
+        """Return queue depth, lag and throughput metrics."""
+        with self._stats_lock:
+            lags = sorted(self._lags)
+            per_topic = dict(self._per_topic)
+            rates = dict(self._last_rates)
+
+        def percentile(p):
+            if not lags:
+                return 0.0
+            return lags[min(len(lags) - 1, int(p / 100 * len(lags)))]
+
+        elapsed = max(time.monotonic() - self._started, 1e-9)
+        return {
+            "policy": self.policy,
+            "workers": self.workers,
+            "queue_depth": self._queue.qsize(),
+            "queue_capacity": self._queue.maxsize,
+            "max_queue_depth": self.max_depth,
+            "received": self.received,
+            "processed": self.processed,
+            "errors": self.errors,
+            "dropped": self.dropped,
+            "spilled": self.spilled,
+            "replayed": self.replayed,
+            "lag_p50": percentile(50),
+            "lag_p95": percentile(95),
+            "lag_p99": percentile(99),
+            "lag_max": self._max_lag,
+            "messages_per_second": self.processed / elapsed,
+            "per_topic_total": per_topic,
+            "per_topic_per_second": rates,  # Over the last report interval
+        }
+
+    def _count_drop(self):
+        with self._stats_lock:
+            self.dropped += 1
+
+    def _offer(self, item):
+        try:
+            self._queue.put_nowait(item)
+            return True
+        except queue.Full:
+            return False
+
+    def _write_spill(self, item):
+        """Append a message to the spill file (called with _spill_lock held)."""
+        topic, payload, received_at, _, content_type = item
+        record = {"topic": topic, "payload": base64.b64encode(payload).decode("ascii"),
+                  "received_at": received_at.isoformat(), "content_type": content_type}
+        with open(self.spill_path, "a") as spill_file:
+            spill_file.write(json.dumps(record) + "\n")
+        self._spill_pending = True
+        with self._stats_lock:
+            self.spilled += 1
+
+    def _replay_spill(self):
+        """Move spilled messages back into the queue once it has room again.
+
+        The spill file is renamed before it is replayed, so new spills start a fresh file. A replay file
+        that is still there (the process stopped while replaying) is replayed before the spill file; its
+        messages may then be handled twice, but none is lost.
+        """
+        with self._spill_lock:
+            if not self._spill_pending or self._queue.qsize() > self._queue.maxsize // 2:
+                return
+            replay_path = self.spill_path + REPLAY_SUFFIX
+            if not os.path.exists(replay_path):
+                if not os.path.exists(self.spill_path):
+                    self._spill_pending = False
+                    return
+                os.replace(self.spill_path, replay_path)
+            self._spill_pending = os.path.exists(self.spill_path)
+        with open(replay_path) as replay_file:
+            for line in replay_file:
+                record = json.loads(line)
+                item = (record["topic"], base64.b64decode(record["payload"]),
+                        datetime.fromisoformat(record["received_at"]), time.monotonic(), record.get("content_type"))
+                self._queue.put(item)  # Blocks until there is room; the workers are draining
+                with self._stats_lock:
+                    self.replayed += 1
+        os.remove(replay_path)
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                self._queue.task_done()
+                return
+            topic, payload, received_at, enqueued, content_type = item
+            lag = time.monotonic() - enqueued
+            try:
+                self.handler(topic, payload, received_at, content_type)
+                failed = False
+            except Exception as e:
+                failed = True
+                print(f"Error processing message on {topic}: {e}")
+            finally:
+                self._queue.task_done()
+            with self._stats_lock:
+                self.processed += 1
+                self.errors += failed
+                self._lags.append(lag)
+                self._max_lag = max(self._max_lag, lag)
+                self._per_topic[topic] += 1
+                self._per_topic_window[topic] += 1
+
+    def _monitor_loop(self):
+        last_report = time.monotonic()
+        while not self._stop.wait(0.5):
+            if self._spill_pending:
+                self._replay_spill()
+            now = time.monotonic()
+            window = max(now - self._window_started, 1e-9)
+            if window >= max(self.report_interval, 1.0):
+                with self._stats_lock:
+                    self._last_rates = {topic: count / window for topic, count in self._per_topic_window.items()}
+                    self._per_topic_window.clear()
+                    self._window_started = now
+            if self.report_interval and now - last_report >= self.report_interval:
+                last_report = now
+                print(f"Ingest pipeline stats: {self.stats()}")
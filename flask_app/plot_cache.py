@@ -0,0 +1,90 @@
+import threading
+from collections import OrderedDict
+
+# Default limits
+DEFAULT_MAX_ENTRIES = 128
+DEFAULT_MAX_BYTES = 32 * 1024 * 1024  # 32 MB of rendered images
+
+
+class PlotCache:
+    """Bounded LRU cache of rendered plots keyed by (plot type, device owner, data version).
+
+    Storing a new version of a plot drops the older versions for the same plot type and owner,
+    so stale images never linger once new data has landed.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # (plot_type, owner, version) -> image
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        # Statistics
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, plot_type, owner, version):
+        """Return the cached image, or None on a miss."""
+        key = (plot_type, owner, version)
+        with self._lock:
+            image = self._entries.get(key)
+            if image is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return image
+
+    def put(self, plot_type, owner, version, image):
+        """Store a rendered image, replacing older versions of the same plot."""
+        size = len(image)
+        if size > self.max_bytes:
+            return  # Never cache something that would evict everything else
+        key = (plot_type, owner, version)
+        with self._lock:
+            self._drop_matching(plot_type, owner)
+            self._entries[key] = image
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+                self.evictions += 1
+
+    def get_or_render(self, plot_type, owner, version, render):
+        """Return the cached image, calling render() to build and store it on a miss."""
+        image = self.get(plot_type, owner, version)
+        if image is None:
+            image = render()
+            self.put(plot_type, owner, version, image)
+        return image
+
+    def invalidate(self, plot_type=None, owner=None):
+        """Drop cached plots; None matches every plot type or owner."""
+        with self._lock:
+            self._drop_matching(plot_type, owner)
+
+    def _drop_matching(self, plot_type, owner):
+        stale = [key for key in self._entries
+                 if (plot_type is None or key[0] == plot_type) and (owner is None or key[1] == owner)]
+        for key in stale:
+            self._bytes -= len(self._entries.pop(key))
+        self.invalidations += len(stale)
+
+    def stats(self):
+        """Return a snapshot of cache size and hit/miss counters."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
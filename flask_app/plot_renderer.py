@@ -0,0 +1,129 @@
+import threading
+import time
+from io import BytesIO
+
+import matplotlib.dates as mdates
+import matplotlib.image as mimage
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+from columnar import convert_timezone
+from downsample import downsample
+
+# Server-side chart rendering straight on the Agg backend, without pyplot's global figure registry.
+# Every chart is built once per thread (so once per render worker process) and reused: a render only swaps
+# the line data and the x-limits, then writes the canvas out as PNG.
+# Renders report how long drawing and PNG encoding took, since they usually run in a render worker process
+# whose own metrics are never scraped; the caller records them.
+# render_ultrasound() and render_ldr() are what the dashboard submits to its render worker processes. Workers
+# import them by module name, so this module (and what it imports) must stay free of Flask, DB and mail code:
+# everything they need from the dashboard's config arrives as arguments.
+
+# Default figure geometry
+DEFAULT_FIGSIZE = (8, 4)  # Inches
+DEFAULT_DPI = 100
+
+
+class ChartTemplate:
+    """One pre-configured figure: axes, labels, date formatter and locator, and a single line artist.
+
+    Not thread-safe; use one per thread (see get_chart()).
+    """
+
+    def __init__(self, title, ylabel, tick_hours, style, ylim=None, xlabel='Time of Day',
+                 figsize=DEFAULT_FIGSIZE, dpi=DEFAULT_DPI):
+        self.ylim = ylim
+        self.figure = Figure(figsize=figsize, dpi=dpi)
+        self.canvas = FigureCanvasAgg(self.figure)
+        self.ax = self.figure.add_subplot()
+        self.line, = self.ax.plot([], [], **style)
+
+        self.ax.set_title(title)
+        self.ax.set_xlabel(xlabel)
+        self.ax.set_ylabel(ylabel)
+        self.ax.xaxis.set_major_formatter(mdates.DateFormatter('%H:%M'))
+        self.ax.xaxis.set_major_locator(mdates.HourLocator(interval=tick_hours))
+        self.ax.tick_params(axis='x', labelrotation=45)
+
+        # Lay the figure out once, leaving room for y tick labels up to four characters wide ("1000", "2.50");
+        # y keeps autoscaling per render unless the chart fixes it
+        self.ax.set_xlim(0, 1)
+        self.ax.set_ylim(*(ylim or (0, 1000)), auto=ylim is None)
+        self.figure.tight_layout()
+
+    def render(self, x, y, xlim):
+        """Draw the line (x: datetime64 array, y: numbers) with the x-axis set to `xlim`.
+
+        Returns (PNG BytesIO, [('plot_draw', seconds), ('png_encode', seconds)]).
+        """
+        x = mdates.date2num(np.asarray(x, dtype='datetime64[us]')) if len(x) else np.empty(0)
+        self.line.set_data(x, np.asarray(y, dtype=np.float64))
+        self.ax.set_xlim(mdates.date2num(xlim[0]), mdates.date2num(xlim[1]))
+        if self.ylim is not None:
+            self.ax.set_ylim(*self.ylim)
+        elif len(x):
+            self.ax.relim()
+            self.ax.autoscale_view(scalex=False)
+        else:
+            self.ax.set_ylim(0, 1, auto=True)
+
+        img = BytesIO()
+        try:
+            started = time.perf_counter()
+            self.canvas.draw()
+            drawn = time.perf_counter()
+        finally:
+            # Do not keep the last series alive between renders
+            self.line.set_data([], [])
+        # What print_png() does after drawing: the rasterized canvas to PNG
+        mimage.imsave(img, self.canvas.buffer_rgba(), format='png', origin='upper', dpi=self.figure.dpi)
+        encoded = time.perf_counter()
+        img.seek(0)
+        return img, [('plot_draw', drawn - started), ('png_encode', encoded - drawn)]
+
+
+# Chart templates by name: keyword arguments of ChartTemplate
+CHARTS = {
+    'ultrasound': dict(title='Ultrasound Sensor Data', ylabel='Distance (cm)', tick_hours=2,
+                       style=dict(marker='o', linestyle='-', color='b')),
+    'ldr': dict(title='LDR Data - Open Times', ylabel='Detection', tick_hours=1, ylim=(0, 1.2),
+                style=dict(marker='o', linestyle='', color='b', label='LDR Openings')),
+}
+
+_local = threading.local()
+
+
+def get_chart(name):
+    """Return this thread's template for chart `name`, building it on first use."""
+    charts = getattr(_local, 'charts', None)
+    if charts is None:
+        charts = _local.charts = {}
+    chart = charts.get(name)
+    if chart is None:
+        chart = charts[name] = ChartTemplate(**CHARTS[name])
+    return chart
+
+
+def render(name, x, y, xlim):
+    """Render chart `name` with this thread's template; returns (PNG BytesIO, stage timings)."""
+    return get_chart(name).render(x, y, xlim)
+
+
+def render_ultrasound(timestamps, values, xlim, from_tz, to_tz, max_points, mode):
+    """Render the ultrasound chart from stored timestamps (datetime64) and distances.
+
+    The timestamps are converted from `from_tz` to `to_tz` wall-clock time and the series is downsampled to
+    `max_points` with downsample mode `mode`; returns (PNG BytesIO, stage timings).
+    """
+    timestamps = convert_timezone(timestamps, from_tz, to_tz)
+    # Roughly one point per pixel, keeping spikes such as box-empty transitions
+    if len(timestamps):
+        timestamps, values = downsample(timestamps, values, max_points, mode)
+    return render('ultrasound', timestamps, values, xlim)
+
+
+def render_ldr(timestamps, xlim, from_tz, to_tz):
+    """Render the LDR chart: a dot at each opening time (datetime64, converted from `from_tz` to `to_tz`)."""
+    timestamps = convert_timezone(timestamps, from_tz, to_tz)
+    return render('ldr', timestamps, np.ones(len(timestamps)), xlim)
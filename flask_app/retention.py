@@ -0,0 +1,263 @@
+import argparse
+import csv
+import gzip
+import os
+import threading
+from datetime import datetime, timedelta
+
+import pytz
+
+import db
+
+# Retention for the raw tables, which schema migration 5 partitions by day on timestamp:
+#
+#   - ensure_partitions() keeps daily partitions created a few days ahead, splitting them off the empty
+#     catch-all p_future partition, so new rows always land in their own day (splitting an empty partition
+#     is a metadata change; rows that did reach p_future are given their own days, at the cost of a copy)
+#   - expire() exports every partition that lies entirely before the retention cutoff to a gzip'd CSV file
+#     and then drops it, which is a metadata operation instead of a DELETE scan over the table
+#
+# Range queries on timestamp only touch the partitions they cover, and each partition has its own, bounded
+# index trees. Run it from the subscriber (RetentionJob) or from cron:
+#
+#   python retention.py --retention-days 90 --dry-run
+
+PARTITIONED_TABLES = ("ldr_data", "ultrasound_data", "empty_box_status", "battery_data")
+FUTURE_PARTITION = "p_future"  # VALUES LESS THAN (MAXVALUE); kept empty by ensure_partitions()
+
+# Defaults
+DEFAULT_RETENTION_DAYS = 90
+DEFAULT_DAYS_AHEAD = 7  # Daily partitions created ahead of today
+MAX_BACKFILL_DAYS = 1000  # Existing history gets at most this many daily partitions; older rows share the first
+DEFAULT_ARCHIVE_DIR = "archive"
+DEFAULT_INTERVAL = 6 * 3600  # Seconds between RetentionJob runs
+ARCHIVE_FETCH_ROWS = 5000  # Rows fetched per round trip while exporting a partition
+
+# Named lock held while maintaining partitions, so a cron run and the subscriber never overlap
+RETENTION_LOCK = "sensor_data_retention"
+
+DENMARK_TZ = pytz.timezone("Europe/Copenhagen")  # Timezone of the stored timestamps
+
+
+def partition_name(day):
+    return f"p{day:%Y%m%d}"
+
+
+def _text(value):
+    return value.decode() if isinstance(value, (bytes, bytearray)) else value
+
+
+def daily_partitions(first_day, last_day):
+    """Return [(partition name, exclusive upper bound)] for one partition per day from first_day to last_day.
+
+    Days before last_day - MAX_BACKFILL_DAYS (stray rows from a device clock that was never set, say) are
+    folded into the first partition, which has no lower bound anyway.
+    """
+    day = max(first_day, last_day - timedelta(days=MAX_BACKFILL_DAYS))
+    partitions = []
+    while day <= last_day:
+        partitions.append((partition_name(day), day + timedelta(days=1)))
+        day += timedelta(days=1)
+    return partitions
+
+
+def partition_definitions(partitions):
+    """PARTITION clauses for daily_partitions() followed by the catch-all p_future."""
+    definitions = [f"PARTITION {name} VALUES LESS THAN ('{bound:%Y-%m-%d}')" for name, bound in partitions]
+    definitions.append(f"PARTITION {FUTURE_PARTITION} VALUES LESS THAN (MAXVALUE)")
+    return ", ".join(definitions)
+
+
+def list_partitions(cur, table):
+    """Return [(partition name, exclusive upper bound as a date, or None for MAXVALUE)] in order."""
+    cur.execute("SELECT PARTITION_NAME, PARTITION_DESCRIPTION FROM INFORMATION_SCHEMA.PARTITIONS "
+                "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s ORDER BY PARTITION_ORDINAL_POSITION;",
+                (table,))
+    partitions = []
+    for name, description in cur.fetchall():
+        name, description = _text(name), _text(description)
+        if name is None:
+            raise RuntimeError(f"Table {table} is not partitioned (schema migration 5 not applied?)")
+        if description is None or description.upper() == "MAXVALUE":
+            partitions.append((name, None))
+        else:
+            partitions.append((name, datetime.strptime(description.strip("'")[:10], "%Y-%m-%d").date()))
+    return partitions
+
+
+def ensure_partitions(cur, table, today, days_ahead=DEFAULT_DAYS_AHEAD, dry_run=False):
+    """Split daily partitions up to `days_ahead` days after `today` off p_future. Returns the new names.
+
+    p_future only holds rows when no run created their day in time (no run for more than `days_ahead`
+    days, or no daily partitions at all). Those rows get daily partitions from their first day on, so they
+    expire with their own day, and the REORGANIZE copies them; rows dated after the new partitions stay.
+    """
+    bounds = [bound for _, bound in list_partitions(cur, table) if bound is not None]
+    first = max(bounds) if bounds else today
+    until = today + timedelta(days=days_ahead)
+    cur.execute(f"SELECT MIN(timestamp), COUNT(*) FROM {table} PARTITION ({FUTURE_PARTITION}) "
+                f"WHERE timestamp < %s;", (until + timedelta(days=1),))
+    oldest, rows = cur.fetchone()
+    if rows:
+        first = min(first, oldest.date())
+        print(f"{table}: moving {rows} rows out of {FUTURE_PARTITION} into daily partitions")
+    new = daily_partitions(first, until)
+    if new and not dry_run:
+        cur.execute(f"ALTER TABLE {table} REORGANIZE PARTITION {FUTURE_PARTITION} INTO "
+                    f"({partition_definitions(new)});")
+    return [name for name, _ in new]
+
+
+def archive_partition(conn, table, partition, archive_dir):
+    """Export one partition to <archive_dir>/<table>/<table>-<partition>.csv.gz. Returns (path, rows).
+
+    Rows only carry device ids, so each is exported with its device_owner from the devices table, which
+    keeps an archive readable on its own. The file is written under a temporary name and renamed when
+    complete, so a crash never leaves a truncated archive behind that looks finished.
+    """
+    directory = os.path.join(archive_dir, table)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{table}-{partition}.csv.gz")
+    partial = path + ".partial"
+    rows = 0
+    cur = conn.cursor()
+    try:
+        cur.execute(f"SELECT {table}.*, devices.device_owner FROM {table} PARTITION ({partition}) "
+                    f"LEFT JOIN devices ON devices.id = {table}.device_id ORDER BY {table}.timestamp;")
+        with gzip.open(partial, "wt", newline="") as archive:
+            writer = csv.writer(archive)
+            writer.writerow(column[0] for column in cur.description)
+            while True:
+                batch = cur.fetchmany(ARCHIVE_FETCH_ROWS)
+                if not batch:
+                    break
+                writer.writerows(batch)
+                rows += len(batch)
+    finally:
+        cur.close()
+    os.replace(partial, path)
+    return path, rows
+
+
+def expire(conn, table, cutoff, archive_dir, dry_run=False):
+    """Archive and drop every partition whose rows are all older than `cutoff` (a date).
+
+    Returns [(partition, archive path, rows)]. A partition is only dropped after its archive is complete.
+    """
+    cur = conn.cursor()
+    try:
+        expired = [name for name, bound in list_partitions(cur, table) if bound is not None and bound <= cutoff]
+        done = []
+        for name in expired:
+            if dry_run:
+                done.append((name, None, None))
+                continue
+            path, rows = archive_partition(conn, table, name, archive_dir)
+            cur.execute(f"ALTER TABLE {table} DROP PARTITION {name};")
+            print(f"Archived {rows} rows of {table} partition {name} to {path} and dropped the partition")
+            done.append((name, path, rows))
+        return done
+    finally:
+        cur.close()
+
+
+def run(connection=None, retention_days=DEFAULT_RETENTION_DAYS, days_ahead=DEFAULT_DAYS_AHEAD,
+        archive_dir=DEFAULT_ARCHIVE_DIR, tables=PARTITIONED_TABLES, tz=DENMARK_TZ, today=None, dry_run=False):
+    """Create the partitions ahead of time and expire old ones on every table.
+
+    Returns {table: {"created": [...], "expired": [...]}}, or None if another run holds the lock.
+    `retention_days` None keeps history forever (partitions are still created).
+    """
+    connection = connection or db.connection
+    today = today or datetime.now(tz).date()
+    results = {}
+    with connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT GET_LOCK(%s, 0);", (RETENTION_LOCK,))
+        if cur.fetchone()[0] != 1:
+            print("Retention run skipped: another run is in progress")
+            return None
+        try:
+            for table in tables:
+                created = ensure_partitions(cur, table, today, days_ahead, dry_run)
+                expired = []
+                if retention_days is not None:
+                    expired = expire(conn, table, today - timedelta(days=retention_days), archive_dir, dry_run)
+                results[table] = {"created": created, "expired": expired}
+        finally:
+            cur.execute("SELECT RELEASE_LOCK(%s);", (RETENTION_LOCK,))
+            cur.fetchone()
+            cur.close()
+    return results
+
+
+class RetentionJob:
+    """Runs run() in a background thread at startup and then every `interval` seconds."""
+
+    def __init__(self, interval=DEFAULT_INTERVAL, **run_args):
+        self.interval = interval
+        self.run_args = run_args
+        self._stop = threading.Event()
+        self._thread = None
+
+        # Counters
+        self.runs = 0
+        self.errors = 0
+        self.partitions_dropped = 0
+        self.rows_archived = 0
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="retention", daemon=True)
+            self._thread.start()
+        return self
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def run_once(self):
+        results = run(**self.run_args)
+        self.runs += 1
+        for table_result in (results or {}).values():
+            for _, _, rows in table_result["expired"]:
+                self.partitions_dropped += 1
+                self.rows_archived += rows or 0
+        return results
+
+    def stats(self):
+        return {"runs": self.runs, "errors": self.errors, "partitions_dropped": self.partitions_dropped,
+                "rows_archived": self.rows_archived}
+
+    def _run(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception as err:
+                self.errors += 1
+                print(f"Error in retention run: {err}")
+            if self._stop.wait(self.interval):
+                return
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Create daily partitions and archive and drop expired ones")
+    parser.add_argument("--retention-days", type=int, default=DEFAULT_RETENTION_DAYS,
+                        help="Keep this many days of raw history (0 keeps everything)")
+    parser.add_argument("--days-ahead", type=int, default=DEFAULT_DAYS_AHEAD)
+    parser.add_argument("--archive-dir", default=DEFAULT_ARCHIVE_DIR)
+    parser.add_argument("--dry-run", action="store_true", help="Only report what would be created and dropped")
+    args = parser.parse_args()
+
+    import final_sub  # noqa: F401  (sets up the database pool with the subscriber's credentials)
+    results = run(retention_days=args.retention_days or None, days_ahead=args.days_ahead,
+                  archive_dir=args.archive_dir, dry_run=args.dry_run)
+    for table, result in (results or {}).items():
+        print(f"{table}: created {', '.join(result['created']) or 'no partitions'}; "
+              f"expired {', '.join(name for name, _, _ in result['expired']) or 'no partitions'}")
+
+
+if __name__ == "__main__":
+    main()
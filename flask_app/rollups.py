@@ -0,0 +1,138 @@
+import threading
+
+# Upserts that merge a pre-aggregated bucket into the stored rollup row
+ROLLUP_QUERIES = {
+    "ultrasound_rollup_minute": """
+        INSERT INTO ultrasound_rollup_minute (device_id, bucket, min_value, max_value, sum_value, sample_count)
+        VALUES (%s, %s, %s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE
+            min_value = LEAST(min_value, VALUES(min_value)),
+            max_value = GREATEST(max_value, VALUES(max_value)),
+            sum_value = sum_value + VALUES(sum_value),
+            sample_count = sample_count + VALUES(sample_count);
+    """,
+    "ultrasound_rollup_hour": """
+        INSERT INTO ultrasound_rollup_hour (device_id, bucket, min_value, max_value, sum_value, sample_count)
+        VALUES (%s, %s, %s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE
+            min_value = LEAST(min_value, VALUES(min_value)),
+            max_value = GREATEST(max_value, VALUES(max_value)),
+            sum_value = sum_value + VALUES(sum_value),
+            sample_count = sample_count + VALUES(sample_count);
+    """,
+    "ldr_rollup_hour": """
+        INSERT INTO ldr_rollup_hour (device_id, bucket, open_count)
+        VALUES (%s, %s, %s)
+        ON DUPLICATE KEY UPDATE open_count = open_count + VALUES(open_count);
+    """,
+    "ldr_rollup_day": """
+        INSERT INTO ldr_rollup_day (device_id, bucket, open_count)
+        VALUES (%s, %s, %s)
+        ON DUPLICATE KEY UPDATE open_count = open_count + VALUES(open_count);
+    """,
+    # The "last" columns are assigned before last_timestamp, because MySQL applies assignments in order
+    "battery_rollup_hour": """
+        INSERT INTO battery_rollup_hour (device_id, bucket, last_timestamp, last_voltage, last_percentage,
+                                         min_voltage, min_percentage)
+        VALUES (%s, %s, %s, %s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE
+            last_voltage = IF(VALUES(last_timestamp) >= last_timestamp, VALUES(last_voltage), last_voltage),
+            last_percentage = IF(VALUES(last_timestamp) >= last_timestamp, VALUES(last_percentage), last_percentage),
+            last_timestamp = GREATEST(last_timestamp, VALUES(last_timestamp)),
+            min_voltage = LEAST(min_voltage, VALUES(min_voltage)),
+            min_percentage = LEAST(min_percentage, VALUES(min_percentage));
+    """,
+}
+
+
+def minute_bucket(timestamp):
+    return timestamp.replace(second=0, microsecond=0, tzinfo=None)
+
+
+def hour_bucket(timestamp):
+    return timestamp.replace(minute=0, second=0, microsecond=0, tzinfo=None)
+
+
+def day_bucket(timestamp):
+    return timestamp.date()
+
+
+class Rollups:
+    """Pre-aggregate ingested rows per device and bucket; drained into the batch writer on every flush.
+
+    Rows end in the device id, as stored in the raw tables. Buckets use the same Copenhagen wall-clock
+    time as the raw rows.
+    """
+
+    queries = ROLLUP_QUERIES
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._ultrasound = {"ultrasound_rollup_minute": {}, "ultrasound_rollup_hour": {}}
+        self._ldr = {"ldr_rollup_hour": {}, "ldr_rollup_day": {}}
+        self._battery = {}
+
+    def record(self, table_name, values):
+        """Fold one raw row (as passed to insert_data) into the rollups."""
+        if table_name == "ultrasound_data":
+            self.record_ultrasound(*values)
+        elif table_name == "ldr_data":
+            timestamp, value, device_id = values
+            if value == 1:
+                self.record_ldr_opening(timestamp, device_id)
+        elif table_name == "battery_data":
+            self.record_battery(*values)
+
+    def record_ultrasound(self, timestamp, value, device_id):
+        value = float(value)
+        with self._lock:
+            for table, bucket in (("ultrasound_rollup_minute", minute_bucket(timestamp)),
+                                  ("ultrasound_rollup_hour", hour_bucket(timestamp))):
+                agg = self._ultrasound[table].get((device_id, bucket))
+                if agg is None:
+                    self._ultrasound[table][(device_id, bucket)] = [value, value, value, 1]
+                else:
+                    agg[0] = min(agg[0], value)
+                    agg[1] = max(agg[1], value)
+                    agg[2] += value
+                    agg[3] += 1
+
+    def record_ldr_opening(self, timestamp, device_id):
+        with self._lock:
+            for table, bucket in (("ldr_rollup_hour", hour_bucket(timestamp)),
+                                  ("ldr_rollup_day", day_bucket(timestamp))):
+                key = (device_id, bucket)
+                self._ldr[table][key] = self._ldr[table].get(key, 0) + 1
+
+    def record_battery(self, timestamp, voltage, percentage, device_id):
+        timestamp = timestamp.replace(tzinfo=None)
+        key = (device_id, hour_bucket(timestamp))
+        with self._lock:
+            agg = self._battery.get(key)
+            if agg is None:
+                self._battery[key] = [timestamp, voltage, percentage, voltage, percentage]
+            else:
+                if timestamp >= agg[0]:
+                    agg[0], agg[1], agg[2] = timestamp, voltage, percentage
+                agg[3] = min(agg[3], voltage)
+                agg[4] = min(agg[4], percentage)
+
+    def pending(self):
+        with self._lock:
+            return bool(self._battery or any(self._ultrasound.values()) or any(self._ldr.values()))
+
+    def drain(self):
+        """Return the aggregated rows per rollup table and start new aggregates."""
+        with self._lock:
+            ultrasound, ldr, battery = self._ultrasound, self._ldr, self._battery
+            self._reset()
+        rows = {}
+        for table, aggs in ultrasound.items():
+            rows[table] = [(device_id, bucket, *agg) for (device_id, bucket), agg in aggs.items()]
+        for table, counts in ldr.items():
+            rows[table] = [(device_id, bucket, count) for (device_id, bucket), count in counts.items()]
+        rows["battery_rollup_hour"] = [(device_id, bucket, *agg) for (device_id, bucket), agg in battery.items()]
+        return rows
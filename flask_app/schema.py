@@ -0,0 +1,362 @@
+import mysql.connector
+from mysql.connector import errorcode
+
+import db
+import retention
+
+# Name of the advisory lock held while migrating, so the dashboard and subscriber never migrate at once
+MIGRATION_LOCK = "sensor_data_schema_migration"
+MIGRATION_LOCK_TIMEOUT = 60  # Seconds
+
+# MySQL errors that mean a migration step was already applied by hand
+ALREADY_APPLIED_ERRORS = (
+    errorcode.ER_DUP_KEYNAME,  # Index already exists
+    errorcode.ER_DUP_FIELDNAME,  # Column already exists
+    errorcode.ER_TABLE_EXISTS_ERROR,
+)
+
+
+def column_exists(cur, table, column):
+    cur.execute("SELECT COUNT(*) FROM INFORMATION_SCHEMA.COLUMNS "
+                "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND COLUMN_NAME = %s;", (table, column))
+    return cur.fetchone()[0] > 0
+
+
+def if_column(table, column, statement, exists=True):
+    """Migration step: run `statement` only while `table` has `column` (or, with exists=False, lacks it)."""
+    def step(cur):
+        if column_exists(cur, table, column) == exists:
+            cur.execute(statement)
+    return step
+
+
+def owner_to_device_id(table, key_change):
+    """Migration steps replacing `table`'s device_owner column by device_id, a reference to devices.
+
+    `key_change` swaps the indexes that contain device_owner for ones on device_id. Once device_owner is
+    gone every step is skipped, so the steps can be repeated after a failure.
+    """
+    return [
+        if_column(table, "device_owner",
+                  f"INSERT IGNORE INTO devices (device_owner) SELECT DISTINCT device_owner FROM {table};"),
+        if_column(table, "device_id", f"ALTER TABLE {table} ADD COLUMN device_id MEDIUMINT UNSIGNED NULL;",
+                  exists=False),
+        if_column(table, "device_owner",
+                  f"UPDATE {table} JOIN devices ON devices.device_owner = {table}.device_owner "
+                  f"SET {table}.device_id = devices.id;"),
+        if_column(table, "device_owner",
+                  f"ALTER TABLE {table} MODIFY device_id MEDIUMINT UNSIGNED NOT NULL, {key_change}, "
+                  f"DROP COLUMN device_owner;"),
+    ]
+
+
+def partition_by_day(table):
+    """Migration step: partition `table` by day on timestamp, one partition per day of existing history."""
+    def step(cur):
+        cur.execute(f"SELECT MIN(timestamp), MAX(timestamp) FROM {table};")
+        first, last = cur.fetchone()
+        days = retention.daily_partitions(first.date(), last.date()) if first is not None else []
+        cur.execute(f"ALTER TABLE {table} PARTITION BY RANGE COLUMNS(timestamp) "
+                    f"({retention.partition_definitions(days)});")
+    return step
+
+
+# Ordered list of (version, description, statements). Never edit an applied migration, add a new one.
+# A statement is SQL, or a function of the cursor for steps that depend on the data.
+MIGRATIONS = [
+    (1, "Create sensor tables", [
+        """
+        CREATE TABLE IF NOT EXISTS ldr_data (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            timestamp DATETIME NOT NULL,
+            value INT NOT NULL,
+            device_owner VARCHAR(255) NOT NULL
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS ultrasound_data (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            timestamp DATETIME NOT NULL,
+            value FLOAT NOT NULL,
+            device_owner VARCHAR(255) NOT NULL
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS empty_box_status (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            timestamp DATETIME NOT NULL,
+            status VARCHAR(10) NOT NULL,
+            distance FLOAT,
+            device_owner VARCHAR(255) NOT NULL
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS battery_data (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            timestamp DATETIME NOT NULL,
+            voltage FLOAT NOT NULL,
+            percentage INT NOT NULL,
+            device_owner VARCHAR(255) NOT NULL
+        );
+        """,
+    ]),
+    (2, "Add (device_owner, timestamp) and timestamp indexes", [
+        "CREATE INDEX idx_ldr_owner_ts ON ldr_data (device_owner, timestamp);",
+        "CREATE INDEX idx_ultrasound_owner_ts ON ultrasound_data (device_owner, timestamp);",
+        "CREATE INDEX idx_box_owner_ts ON empty_box_status (device_owner, timestamp);",
+        "CREATE INDEX idx_battery_owner_ts ON battery_data (device_owner, timestamp);",
+        # The fleet-wide dashboard filters and sorts on timestamp alone
+        "CREATE INDEX idx_ldr_ts ON ldr_data (timestamp);",
+        "CREATE INDEX idx_ultrasound_ts ON ultrasound_data (timestamp);",
+        "CREATE INDEX idx_box_ts ON empty_box_status (timestamp);",
+        "CREATE INDEX idx_battery_ts ON battery_data (timestamp);",
+    ]),
+    (3, "Add per-device rollup tables and backfill them from the raw tables", [
+        """
+        CREATE TABLE IF NOT EXISTS ultrasound_rollup_minute (
+            device_owner VARCHAR(255) NOT NULL,
+            bucket DATETIME NOT NULL,
+            min_value FLOAT NOT NULL,
+            max_value FLOAT NOT NULL,
+            sum_value DOUBLE NOT NULL,
+            sample_count INT NOT NULL,
+            PRIMARY KEY (device_owner, bucket),
+            INDEX idx_ultrasound_minute_bucket (bucket)
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS ultrasound_rollup_hour (
+            device_owner VARCHAR(255) NOT NULL,
+            bucket DATETIME NOT NULL,
+            min_value FLOAT NOT NULL,
+            max_value FLOAT NOT NULL,
+            sum_value DOUBLE NOT NULL,
+            sample_count INT NOT NULL,
+            PRIMARY KEY (device_owner, bucket),
+            INDEX idx_ultrasound_hour_bucket (bucket)
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS ldr_rollup_hour (
+            device_owner VARCHAR(255) NOT NULL,
+            bucket DATETIME NOT NULL,
+            open_count INT NOT NULL,
+            PRIMARY KEY (device_owner, bucket),
+            INDEX idx_ldr_hour_bucket (bucket)
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS ldr_rollup_day (
+            device_owner VARCHAR(255) NOT NULL,
+            bucket DATE NOT NULL,
+            open_count INT NOT NULL,
+            PRIMARY KEY (device_owner, bucket),
+            INDEX idx_ldr_day_bucket (bucket)
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS battery_rollup_hour (
+            device_owner VARCHAR(255) NOT NULL,
+            bucket DATETIME NOT NULL,
+            last_timestamp DATETIME NOT NULL,
+            last_voltage FLOAT NOT NULL,
+            last_percentage INT NOT NULL,
+            min_voltage FLOAT NOT NULL,
+            min_percentage INT NOT NULL,
+            PRIMARY KEY (device_owner, bucket),
+            INDEX idx_battery_hour_bucket (bucket)
+        );
+        """,
+        # Backfill from the raw history so existing days render from the rollups straight away
+        """
+        INSERT IGNORE INTO ultrasound_rollup_minute (device_owner, bucket, min_value, max_value, sum_value, sample_count)
+        SELECT device_owner, DATE_FORMAT(timestamp, '%Y-%m-%d %H:%i:00'), MIN(value), MAX(value), SUM(value), COUNT(*)
+        FROM ultrasound_data
+        GROUP BY device_owner, DATE_FORMAT(timestamp, '%Y-%m-%d %H:%i:00');
+        """,
+        """
+        INSERT IGNORE INTO ultrasound_rollup_hour (device_owner, bucket, min_value, max_value, sum_value, sample_count)
+        SELECT device_owner, DATE_FORMAT(timestamp, '%Y-%m-%d %H:00:00'), MIN(value), MAX(value), SUM(value), COUNT(*)
+        FROM ultrasound_data
+        GROUP BY device_owner, DATE_FORMAT(timestamp, '%Y-%m-%d %H:00:00');
+        """,
+        """
+        INSERT IGNORE INTO ldr_rollup_hour (device_owner, bucket, open_count)
+        SELECT device_owner, DATE_FORMAT(timestamp, '%Y-%m-%d %H:00:00'), COUNT(*)
+        FROM ldr_data WHERE value = 1
+        GROUP BY device_owner, DATE_FORMAT(timestamp, '%Y-%m-%d %H:00:00');
+        """,
+        """
+        INSERT IGNORE INTO ldr_rollup_day (device_owner, bucket, open_count)
+        SELECT device_owner, DATE(timestamp), COUNT(*)
+        FROM ldr_data WHERE value = 1
+        GROUP BY device_owner, DATE(timestamp);
+        """,
+        """
+        INSERT IGNORE INTO battery_rollup_hour (device_owner, bucket, last_timestamp, last_voltage, last_percentage,
+                                                min_voltage, min_percentage)
+        SELECT b.device_owner, h.bucket, b.timestamp, b.voltage, b.percentage, h.min_voltage, h.min_percentage
+        FROM (
+            SELECT device_owner, DATE_FORMAT(timestamp, '%Y-%m-%d %H:00:00') AS bucket, MAX(id) AS last_id,
+                   MIN(voltage) AS min_voltage, MIN(percentage) AS min_percentage
+            FROM battery_data
+            GROUP BY device_owner, DATE_FORMAT(timestamp, '%Y-%m-%d %H:00:00')
+        ) AS h
+        JOIN battery_data AS b ON b.id = h.last_id;
+        """,
+    ]),
+    (4, "Add the per-device latest state table and backfill it from the raw tables", [
+        """
+        CREATE TABLE IF NOT EXISTS device_latest_state (
+            device_owner VARCHAR(255) NOT NULL PRIMARY KEY,
+            last_seen DATETIME NOT NULL,
+            distance FLOAT NULL,
+            distance_at DATETIME NULL,
+            box_status VARCHAR(10) NULL,
+            box_distance FLOAT NULL,
+            box_status_at DATETIME NULL,
+            battery_voltage FLOAT NULL,
+            battery_percentage INT NULL,
+            battery_at DATETIME NULL,
+            last_ldr_open_at DATETIME NULL,
+            INDEX idx_latest_last_seen (last_seen)
+        );
+        """,
+        # Backfill: the newest row (highest id) per device and table, merged into one row per device
+        """
+        INSERT INTO device_latest_state (device_owner, last_seen, distance, distance_at)
+        SELECT u.device_owner, u.timestamp, u.value, u.timestamp
+        FROM (SELECT device_owner, MAX(id) AS last_id FROM ultrasound_data GROUP BY device_owner) AS l
+        JOIN ultrasound_data AS u ON u.id = l.last_id
+        ON DUPLICATE KEY UPDATE distance = VALUES(distance), distance_at = VALUES(distance_at),
+                                last_seen = GREATEST(last_seen, VALUES(last_seen));
+        """,
+        """
+        INSERT INTO device_latest_state (device_owner, last_seen, box_status, box_distance, box_status_at)
+        SELECT b.device_owner, b.timestamp, b.status, b.distance, b.timestamp
+        FROM (SELECT device_owner, MAX(id) AS last_id FROM empty_box_status GROUP BY device_owner) AS l
+        JOIN empty_box_status AS b ON b.id = l.last_id
+        ON DUPLICATE KEY UPDATE box_status = VALUES(box_status), box_distance = VALUES(box_distance),
+                                box_status_at = VALUES(box_status_at),
+                                last_seen = GREATEST(last_seen, VALUES(last_seen));
+        """,
+        """
+        INSERT INTO device_latest_state (device_owner, last_seen, battery_voltage, battery_percentage, battery_at)
+        SELECT b.device_owner, b.timestamp, b.voltage, b.percentage, b.timestamp
+        FROM (SELECT device_owner, MAX(id) AS last_id FROM battery_data GROUP BY device_owner) AS l
+        JOIN battery_data AS b ON b.id = l.last_id
+        ON DUPLICATE KEY UPDATE battery_voltage = VALUES(battery_voltage),
+                                battery_percentage = VALUES(battery_percentage), battery_at = VALUES(battery_at),
+                                last_seen = GREATEST(last_seen, VALUES(last_seen));
+        """,
+        """
+        INSERT INTO device_latest_state (device_owner, last_seen, last_ldr_open_at)
+        SELECT * FROM (SELECT device_owner, MAX(timestamp) AS opened, MAX(timestamp) AS opened_at
+                       FROM ldr_data WHERE value = 1 GROUP BY device_owner) AS l
+        ON DUPLICATE KEY UPDATE last_ldr_open_at = VALUES(last_ldr_open_at),
+                                last_seen = GREATEST(last_seen, VALUES(last_seen));
+        """,
+    ]),
+    # Rebuilds the raw tables once. A partitioned table's primary key must contain the partitioning column,
+    # and ids become BIGINT since history is no longer deleted row by row. Existing history gets one
+    # partition per day, so it expires day by day; retention.ensure_partitions() adds the days from then on
+    # by splitting the empty catch-all p_future partition.
+    (5, "Partition the raw tables by timestamp", [
+        "ALTER TABLE ldr_data MODIFY id BIGINT NOT NULL AUTO_INCREMENT, DROP PRIMARY KEY, "
+        "ADD PRIMARY KEY (id, timestamp);",
+        "ALTER TABLE ultrasound_data MODIFY id BIGINT NOT NULL AUTO_INCREMENT, DROP PRIMARY KEY, "
+        "ADD PRIMARY KEY (id, timestamp);",
+        "ALTER TABLE empty_box_status MODIFY id BIGINT NOT NULL AUTO_INCREMENT, DROP PRIMARY KEY, "
+        "ADD PRIMARY KEY (id, timestamp);",
+        "ALTER TABLE battery_data MODIFY id BIGINT NOT NULL AUTO_INCREMENT, DROP PRIMARY KEY, "
+        "ADD PRIMARY KEY (id, timestamp);",
+        partition_by_day("ldr_data"),
+        partition_by_day("ultrasound_data"),
+        partition_by_day("empty_box_status"),
+        partition_by_day("battery_data"),
+    ]),
+    # Replaces the owner name repeated in every raw row and (device_owner, timestamp) index entry with a
+    # 3-byte id into the new devices table. Each table gets its owners added to devices, its ids filled in,
+    # and then swaps the column and index in one ALTER; every step checks the columns first, so a run that
+    # failed halfway can simply be repeated.
+    (6, "Move device owners to a devices table with integer ids", [
+        """
+        CREATE TABLE IF NOT EXISTS devices (
+            id MEDIUMINT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY,
+            device_owner VARCHAR(255) NOT NULL,
+            created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE KEY uq_devices_owner (device_owner)
+        );
+        """,
+        *owner_to_device_id("ldr_data", "DROP INDEX idx_ldr_owner_ts, "
+                            "ADD INDEX idx_ldr_device_ts (device_id, timestamp)"),
+        *owner_to_device_id("ultrasound_data", "DROP INDEX idx_ultrasound_owner_ts, "
+                            "ADD INDEX idx_ultrasound_device_ts (device_id, timestamp)"),
+        *owner_to_device_id("empty_box_status", "DROP INDEX idx_box_owner_ts, "
+                            "ADD INDEX idx_box_device_ts (device_id, timestamp)"),
+        *owner_to_device_id("battery_data", "DROP INDEX idx_battery_owner_ts, "
+                            "ADD INDEX idx_battery_device_ts (device_id, timestamp)"),
+    ]),
+    # The same for the rollups, which hold a row per device and bucket (1440 a day per device in the minute
+    # rollup the dashboard reads by default) and are filtered by device like the raw tables.
+    # device_latest_state keeps its owner key: it has one row per device, and the fleet page and the alert
+    # engine use the owner name.
+    (7, "Key the rollup tables by device id", [
+        step
+        for table in ("ultrasound_rollup_minute", "ultrasound_rollup_hour", "ldr_rollup_hour", "ldr_rollup_day",
+                      "battery_rollup_hour")
+        for step in owner_to_device_id(table, "DROP PRIMARY KEY, ADD PRIMARY KEY (device_id, bucket)")
+    ]),
+]
+
+
+def current_version(cur):
+    """Return the highest applied schema version (0 for a fresh database)."""
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INT PRIMARY KEY,
+            description VARCHAR(255) NOT NULL,
+            applied_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+        );
+    """)
+    cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version;")
+    return cur.fetchone()[0]
+
+
+def migrate():
+    """Apply every pending migration. Safe to call on every startup."""
+    with db.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT GET_LOCK(%s, %s);", (MIGRATION_LOCK, MIGRATION_LOCK_TIMEOUT))
+        if cur.fetchone()[0] != 1:
+            raise RuntimeError("Timed out waiting for the schema migration lock")
+        try:
+            version = current_version(cur)
+            for target, description, statements in MIGRATIONS:
+                if target <= version:
+                    continue
+                print(f"Applying schema migration {target}: {description}")
+                for statement in statements:
+                    try:
+                        if callable(statement):
+                            statement(cur)
+                        else:
+                            cur.execute(statement)
+                    except mysql.connector.Error as err:
+                        if err.errno not in ALREADY_APPLIED_ERRORS:
+                            raise
+                        print(f"Skipping already applied step ({err.msg})")
+                cur.execute("INSERT INTO schema_version (version, description) VALUES (%s, %s);",
+                            (target, description))
+                conn.commit()
+                version = target
+            print(f"Database schema is at version {version}.")
+            return version
+        finally:
+            cur.execute("SELECT RELEASE_LOCK(%s);", (MIGRATION_LOCK,))
+            cur.fetchone()
+
+
+if __name__ == "__main__":
+    import final_sub  # noqa: F401  (sets up the database pool with the subscriber's credentials)
+    migrate()
@@ -0,0 +1,105 @@
+import random
+import time
+
+# Stand-in for final_pub.DeviceHardware so the publisher's tasks can run under CPython.
+# Nothing here is copied to the ESP32.
+
+
+class SimulatedMQTTClient:
+    """In-memory replacement for umqtt.simple.MQTTClient.
+
+    connect() blocks for `connect_latency` seconds, like a TLS handshake, and publish() for `latency`
+    seconds, like a synchronous TLS write. Both give up with OSError ETIMEDOUT once they have blocked for the
+    socket timeout passed to connect(), as the real client's socket does. publish() also raises OSError while
+    the simulated broker is down or at random with `failure_rate`.
+    """
+
+    def __init__(self, hardware, latency=0.0, failure_rate=0.0, connect_latency=0.0):
+        self.hardware = hardware
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.connect_latency = connect_latency
+        self.timeout = None
+        self.connected = False
+
+    def _block(self, seconds):
+        if self.timeout is not None and seconds > self.timeout:
+            time.sleep(self.timeout)
+            self.connected = False
+            raise OSError("ETIMEDOUT")
+        if seconds:
+            time.sleep(seconds)
+
+    def connect(self, clean_session=True, timeout=None):
+        self.timeout = timeout
+        if not self.hardware.broker_up:
+            raise OSError("ECONNREFUSED")
+        self._block(self.connect_latency)
+        self.connected = True
+
+    def publish(self, topic, message):
+        if not self.connected or not self.hardware.broker_up:
+            raise OSError("ECONNRESET")
+        self._block(self.latency)
+        if self.failure_rate and self.hardware.rng.random() < self.failure_rate:
+            self.connected = False
+            raise OSError("ETIMEDOUT")
+        self.hardware.published.append((time.time(), topic, message))
+
+    def disconnect(self):
+        self.connected = False
+
+
+class SimulatedHardware:
+    """Simulated pill box: the box slowly empties and is refilled, the lid opens now and then and the
+    battery drains. Every sensor read is recorded in `samples` so sampling rates can be checked."""
+
+    def __init__(self, seed=None, publish_latency=0.0, publish_failure_rate=0.0, connect_latency=0.0):
+        self.rng = random.Random(seed)
+        self.publish_latency = publish_latency
+        self.publish_failure_rate = publish_failure_rate
+        self.connect_latency = connect_latency
+        self.broker_up = True
+        self.wifi_up = True
+        self.published = []  # (time, topic, message) of every message the broker accepted
+        self.samples = {"ultrasound": [], "ldr": [], "battery": []}  # Sensor -> read times
+        self.leds = {"green": 0, "red": 0}
+        self._distance = 1.0
+        self._battery_raw = 2600
+
+    def measure_distance(self):
+        self.samples["ultrasound"].append(time.time())
+        self._distance += self.rng.uniform(0.0, 0.1)
+        if self._distance > 4.0:
+            self._distance = 1.0  # Refilled
+        return self._distance
+
+    def read_ldr(self):
+        self.samples["ldr"].append(time.time())
+        return 3000 if self.rng.random() < 0.05 else 200
+
+    def read_battery_raw(self):
+        self.samples["battery"].append(time.time())
+        self._battery_raw = max(0, self._battery_raw - self.rng.randint(0, 2))
+        return self._battery_raw
+
+    def set_green_led(self, on):
+        self.leds["green"] = 1 if on else 0
+
+    def set_red_led(self, on):
+        self.leds["red"] = 1 if on else 0
+
+    def wifi_connected(self):
+        return self.wifi_up
+
+    def start_wifi(self):
+        pass
+
+    def ip_address(self):
+        return "127.0.0.1"
+
+    def sync_time(self):
+        pass  # The host clock is already in sync
+
+    def mqtt_client(self):
+        return SimulatedMQTTClient(self, self.publish_latency, self.publish_failure_rate, self.connect_latency)
@@ -0,0 +1,54 @@
+// Draw the dashboard charts in the browser from the JSON series API.
+// Timestamps arrive as milliseconds since the epoch in Copenhagen wall time; Plotly dates are timezone-naive.
+(function () {
+    var HOUR = 3600 * 1000;
+    var CONFIG = {responsive: true, displaylogo: false};
+
+    function layout(title, data, yTitle, tickHours) {
+        return {
+            title: {text: title},
+            margin: {l: 60, r: 20, t: 50, b: 60},
+            xaxis: {
+                title: {text: 'Time of Day'},
+                type: 'date',
+                range: [data.start, data.end],
+                tickformat: '%H:%M',
+                dtick: tickHours * HOUR,
+                tickangle: -45
+            },
+            yaxis: {title: {text: yTitle}}
+        };
+    }
+
+    function drawUltrasound(el, data) {
+        var trace = {x: data.t, y: data.v, type: 'scattergl', mode: 'lines+markers',
+                     line: {color: 'blue'}, marker: {color: 'blue', size: 4}, name: 'Distance'};
+        Plotly.newPlot(el, [trace], layout('Ultrasound Sensor Data', data, 'Distance (cm)', 2), CONFIG);
+    }
+
+    function drawLdr(el, data) {
+        var trace = {x: data.t, y: data.t.map(function () { return 1; }), type: 'scatter', mode: 'markers',
+                     marker: {color: 'blue', size: 8}, name: 'LDR Openings'};
+        var chartLayout = layout('LDR Data - Open Times', data, 'Detection', 1);
+        chartLayout.yaxis.range = [0, 1.2];
+        Plotly.newPlot(el, [trace], chartLayout, CONFIG);
+    }
+
+    var DRAW = {ultrasound: drawUltrasound, ldr: drawLdr};
+
+    document.querySelectorAll('[data-series-url]').forEach(function (el) {
+        fetch(el.dataset.seriesUrl, {credentials: 'same-origin'})
+            .then(function (response) {
+                if (!response.ok) {
+                    throw new Error('HTTP ' + response.status);
+                }
+                return response.json();
+            })
+            .then(function (data) {
+                DRAW[el.dataset.chart](el, data);
+            })
+            .catch(function (err) {
+                el.textContent = 'Could not load chart data (' + err.message + ').';
+            });
+    });
+})();
@@ -0,0 +1,78 @@
+// Append new readings from the live update stream (Server-Sent Events) to the dashboard's charts and tables.
+// Event times arrive as milliseconds since the epoch in Copenhagen wall time, like the JSON series API.
+(function () {
+    var script = document.currentScript;
+    if (!window.EventSource || !script || !script.dataset.eventsUrl) {
+        return;
+    }
+    var MAX_CHART_POINTS = 5000;  // Oldest points are dropped from a chart beyond this
+    var pending = {ultrasound: [], ldr: [], box: [], battery: []};
+    var scheduled = false;
+
+    // Plotly sets el.data once the chart's initial series has been drawn
+    function drawnChart(name) {
+        var el = document.querySelector('[data-chart="' + name + '"]');
+        return el && el.data ? el : null;
+    }
+
+    function extendChart(name, events, value) {
+        var el = drawnChart(name);
+        if (!el || !events.length) {
+            return;
+        }
+        var update = {x: [events.map(function (e) { return e.t; })], y: [events.map(value)]};
+        Plotly.extendTraces(el, update, [0], MAX_CHART_POINTS);
+    }
+
+    function prependRows(id, rows) {
+        var body = document.getElementById(id);
+        if (!body || !rows.length) {
+            return;
+        }
+        body.querySelectorAll('td[colspan]').forEach(function (td) {
+            td.parentNode.remove();  // "No data available" placeholder
+        });
+        rows.forEach(function (cells) {
+            var tr = document.createElement('tr');
+            cells.forEach(function (text) {
+                var td = document.createElement('td');
+                td.textContent = text;
+                tr.appendChild(td);
+            });
+            body.insertBefore(tr, body.firstChild);
+        });
+        var maxRows = parseInt(body.dataset.maxRows, 10);
+        while (maxRows && body.rows.length > maxRows) {
+            body.deleteRow(body.rows.length - 1);
+        }
+    }
+
+    // Apply everything that arrived since the last frame at once, so a burst costs one redraw per chart
+    function apply() {
+        scheduled = false;
+        var batch = pending;
+        pending = {ultrasound: [], ldr: [], box: [], battery: []};
+
+        extendChart('ultrasound', batch.ultrasound, function (e) { return Math.round(e.distance * 100) / 100; });
+        extendChart('ldr', batch.ldr, function () { return 1; });
+        var count = document.getElementById('ldr-open-count');
+        if (count && batch.ldr.length) {
+            count.textContent = (parseInt(count.textContent, 10) || 0) + batch.ldr.length;
+        }
+        prependRows('box-status-rows', batch.box.map(function (e) { return [e.time, e.status]; }));
+        prependRows('battery-rows', batch.battery.map(function (e) {
+            return [e.time, e.voltage, e.percentage + '%'];
+        }));
+    }
+
+    var source = new EventSource(script.dataset.eventsUrl, {withCredentials: true});
+    Object.keys(pending).forEach(function (type) {
+        source.addEventListener(type, function (message) {
+            pending[type].push(JSON.parse(message.data));
+            if (!scheduled) {
+                scheduled = true;
+                window.requestAnimationFrame(apply);
+            }
+        });
+    });
+})();
@@ -0,0 +1,220 @@
+import smtplib
+import socketserver
+import threading
+import time
+from datetime import datetime, timedelta
+from email import message_from_string
+
+import pytest
+
+import alerts
+
+
+class SMTPStubHandler(socketserver.StreamRequestHandler):
+    """Just enough SMTP for smtplib: accepts every message, refuses recipients containing "invalid"."""
+
+    def reply(self, line):
+        self.wfile.write((line + "\r\n").encode())
+
+    def handle(self):
+        self.reply("220 stub")
+        recipients = []
+        while True:
+            line = self.rfile.readline().decode()
+            if not line:
+                return
+            command = line[:4].upper()
+            if command in ("EHLO", "HELO"):
+                self.reply("250 stub")
+            elif command == "RCPT":
+                if "invalid" in line:
+                    self.reply("550 No such user")
+                else:
+                    recipients.append(line.split(":", 1)[1].strip().strip("<>"))
+                    self.reply("250 OK")
+            elif command == "DATA":
+                self.reply("354 Go ahead")
+                lines = []
+                while True:
+                    data = self.rfile.readline().decode()
+                    if data in (".\r\n", ".\n", ""):
+                        break
+                    lines.append(data)
+                self.server.messages.append((recipients, message_from_string("".join(lines))))
+                recipients = []
+                self.reply("250 OK")
+            elif command == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("250 OK")
+
+
+class SMTPStub(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), SMTPStubHandler)
+        self.messages = []  # (recipients, email.message.Message)
+
+
+@pytest.fixture
+def smtp():
+    server = SMTPStub()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("timed out")
+        time.sleep(0.01)
+
+
+def alert(owner, message="Battery low", at=datetime(2024, 5, 1, 9, 30)):
+    return alerts.Alert(alerts.BATTERY_LOW, owner, at, message)
+
+
+def send_each(port):
+    """Notifier `send` mailing every notification (recipient, text) separately, like the dashboard's outbox."""
+    def send(batch):
+        with smtplib.SMTP("127.0.0.1", port, timeout=5) as connection:
+            for recipient, text in batch:
+                connection.sendmail("dashboard@example.com", [recipient], f"Subject: {text}\r\n\r\n{text}\r\n")
+    return send
+
+
+def test_smtp_sender_delivers_a_batch_as_one_email(smtp):
+    send = alerts.smtp_sender("127.0.0.1", smtp.server_address[1], "alerts@example.com", ["nurse@example.com"])
+    send([alert("Anna"), alert("Bo", "Box empty")])
+    assert len(smtp.messages) == 1
+    recipients, message = smtp.messages[0]
+    assert recipients == ["nurse@example.com"]
+    assert message["Subject"] == "2 sensor alerts for Anna, Bo"
+    assert "Anna  Battery low" in message.get_payload() and "Bo  Box empty" in message.get_payload()
+
+
+def test_notifier_batches_a_burst(smtp):
+    send = alerts.smtp_sender("127.0.0.1", smtp.server_address[1], "alerts@example.com", ["nurse@example.com"])
+    notifier = alerts.Notifier(send, batch_delay=0.2, retry_delay=0.01).start()
+    try:
+        for owner in ("Anna", "Bo", "Cy"):
+            notifier.submit(alert(owner))
+        wait_for(lambda: notifier.stats()["sent"] == 3)
+    finally:
+        notifier.close(timeout=5)
+    assert len(smtp.messages) == 1
+    assert notifier.stats()["batches"] == 1
+
+
+def test_notifier_rate_limit_holds_back_a_second_send(smtp):
+    send = alerts.smtp_sender("127.0.0.1", smtp.server_address[1], "alerts@example.com", ["nurse@example.com"])
+    notifier = alerts.Notifier(send, batch_delay=0, rate_limit=(1, 60)).start()
+    try:
+        notifier.submit(alert("Anna"))
+        wait_for(lambda: notifier.stats()["sent"] == 1)
+        notifier.submit(alert("Bo"))
+        time.sleep(0.2)
+        assert notifier.stats()["pending"] == 1
+    finally:
+        notifier.close(timeout=5)
+    # close() sends what is left, ignoring the rate limit
+    assert notifier.stats()["sent"] == 2
+
+
+def test_undeliverable_notification_is_dead_lettered_and_the_rest_flows(smtp):
+    dead = []
+    notifier = alerts.Notifier(send_each(smtp.server_address[1]), batch_delay=0.1, retry_delay=0.01,
+                               max_attempts=3, dead_letter=dead.extend).start()
+    try:
+        notifier.submit(("anna@example.com", "first"))
+        notifier.submit(("invalid@example.com", "bounces"))
+        notifier.submit(("bo@example.com", "second"))
+        wait_for(lambda: dead and notifier.stats()["pending"] == 0)
+        notifier.submit(("cy@example.com", "later"))
+        wait_for(lambda: notifier.stats()["sent"] == 3)
+    finally:
+        notifier.close(timeout=5)
+    assert dead == [("invalid@example.com", "bounces")]
+    stats = notifier.stats()
+    assert stats["failed"] == 1 and stats["errors"] == 3
+    delivered = [recipients[0] for recipients, _ in smtp.messages]
+    assert {"bo@example.com", "cy@example.com"} <= set(delivered)
+    assert "invalid@example.com" not in delivered
+
+
+def test_notifier_retries_while_the_server_is_down():
+    calls = []
+
+    def send(batch):
+        calls.append(list(batch))
+        if len(calls) < 3:
+            raise OSError("Connection refused")
+
+    notifier = alerts.Notifier(send, batch_delay=0, retry_delay=0.01, max_attempts=5).start()
+    try:
+        notifier.submit("only")
+        wait_for(lambda: notifier.stats()["sent"] == 1)
+    finally:
+        notifier.close(timeout=5)
+    assert calls == [["only"]] * 3
+    assert notifier.stats()["failed"] == 0
+
+
+def notifier_threads():
+    return sum(thread.name == "notifier" for thread in threading.enumerate())
+
+
+def test_start_is_idempotent():
+    running = notifier_threads()
+    notifier = alerts.Notifier(lambda batch: None)
+    threads = [threading.Thread(target=notifier.start) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    try:
+        assert notifier_threads() == running + 1
+    finally:
+        notifier.close(timeout=5)
+
+
+def engine(raised, **rules):
+    return alerts.AlertEngine(raised.append, **rules)
+
+
+def test_battery_alerts_once_until_it_recovers():
+    raised = []
+    rules = engine(raised, battery_below=20, battery_rearm=5)
+    now = datetime(2024, 5, 1, 9, 0)
+    for percentage in (19, 18, 22, 26, 10):
+        rules.observe("battery_data", (now, 3.5, percentage, "Anna"))
+    assert [a.kind for a in raised] == [alerts.BATTERY_LOW, alerts.BATTERY_LOW]
+
+
+def test_box_empty_for_too_long():
+    raised = []
+    rules = engine(raised, box_empty_minutes=60, silent_minutes=None, ldr_open_by=None)
+    start = datetime(2024, 5, 1, 9, 0)
+    rules.observe("empty_box_status", (start, "empty", 4.0, "Anna"))
+    rules.check(start + timedelta(minutes=59))
+    assert not raised
+    rules.check(start + timedelta(minutes=61))
+    rules.check(start + timedelta(minutes=90))
+    assert [a.kind for a in raised] == [alerts.BOX_EMPTY]
+
+
+def test_silent_device_and_missed_opening():
+    raised = []
+    rules = engine(raised, silent_minutes=30, ldr_open_by="12:00", box_empty_minutes=None)
+    rules.observe("ldr_data", (datetime(2024, 5, 1, 8, 0), 1, "Anna"))
+    rules.check(datetime(2024, 5, 1, 8, 45))
+    assert [a.kind for a in raised] == [alerts.SILENT]
+    rules.check(datetime(2024, 5, 2, 12, 5))
+    assert [a.kind for a in raised] == [alerts.SILENT, alerts.LDR_NOT_OPENED]
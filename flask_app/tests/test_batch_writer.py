@@ -0,0 +1,138 @@
+from contextlib import contextmanager
+from datetime import datetime
+
+import pytest
+
+from batch_writer import BatchWriter
+
+
+class FakeDatabase:
+    """Records committed rows per table; the next `failures` transactions fail at commit."""
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.committed = {}
+        self.rollbacks = 0
+
+    @contextmanager
+    def connection(self):
+        yield FakeConnection(self)
+
+
+class FakeConnection:
+    def __init__(self, database):
+        self.database = database
+        self.statements = []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        if self.database.failures:
+            self.database.failures -= 1
+            raise ConnectionError("server has gone away")
+        for query, rows in self.statements:
+            table = query.split()[2]
+            self.database.committed.setdefault(table, []).extend(rows)
+
+    def rollback(self):
+        self.database.rollbacks += 1
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def executemany(self, query, rows):
+        self.conn.statements.append((query, list(rows)))
+
+    def close(self):
+        pass
+
+
+class CountingSource:
+    """Writer source with one aggregate row per drain, like the rollups."""
+
+    queries = {"counts": "INSERT INTO counts (n) VALUES (%s) ON DUPLICATE KEY UPDATE n = n + VALUES(n);"}
+
+    def __init__(self):
+        self.count = 0
+
+    def record(self):
+        self.count += 1
+
+    def pending(self):
+        return self.count > 0
+
+    def drain(self):
+        count, self.count = self.count, 0
+        return {"counts": [(count,)] if count else []}
+
+
+def row(i):
+    return datetime(2026, 10, 18, 12, 0, i), i, 1
+
+
+@pytest.fixture
+def flushes():
+    return []
+
+
+def make_writer(database, flushes, **kwargs):
+    return BatchWriter(database.connection, max_rows=1000, on_flush=lambda *args: flushes.append(args), **kwargs)
+
+
+def test_flush_writes_buffered_rows_in_one_transaction(flushes):
+    database = FakeDatabase()
+    writer = make_writer(database, flushes)
+    for i in range(3):
+        writer.add("ultrasound_data", row(i))
+
+    assert writer.flush() == 3
+    assert database.committed == {"ultrasound_data": [row(0), row(1), row(2)]}
+    assert writer.flush() == 0
+    assert writer.stats()["rows_written"] == 3
+
+
+def test_failed_flush_keeps_rows_and_source_aggregates_for_the_next_one(flushes):
+    database = FakeDatabase(failures=2)
+    writer = make_writer(database, flushes)
+    source = writer.add_source(CountingSource())
+    writer.add("ldr_data", row(0))
+    source.record()
+
+    assert writer.flush() == 0
+    writer.add("ldr_data", row(1))
+    source.record()
+    assert writer.flush() == 0
+    assert writer.stats()["retry_rows"] == 4
+    assert writer.flush() == 4
+
+    # Oldest rows first, and both drained aggregates merge into the stored counts
+    assert database.committed == {"ldr_data": [row(0), row(1)], "counts": [(1,), (1,)]}
+    assert database.rollbacks == 2
+    stats = writer.stats()
+    assert (stats["rows_written"], stats["rows_failed"], stats["rows_dropped"], stats["retry_rows"]) == (4, 6, 0, 0)
+    assert [error is not None for _, _, error in flushes] == [True, True, False]
+
+
+def test_rows_are_dropped_after_max_attempts(flushes):
+    database = FakeDatabase(failures=3)
+    writer = make_writer(database, flushes, max_attempts=2)
+    writer.add("battery_data", (datetime(2026, 10, 18), 3.9, 80, 1))
+    writer.flush()
+    writer.add("battery_data", (datetime(2026, 10, 18, 0, 1), 3.9, 79, 1))
+    writer.flush()  # The first row failed twice and is dropped, the second is kept
+
+    assert writer.stats()["rows_dropped"] == 1
+    assert writer.stats()["retry_rows"] == 1
+    writer.flush()  # The second row fails its second attempt
+    assert writer.stats()["rows_dropped"] == 2
+    assert writer.flush() == 0
+    assert database.committed == {}
+
+
+def test_unknown_table_is_rejected(flushes):
+    writer = make_writer(FakeDatabase(), flushes)
+    with pytest.raises(ValueError):
+        writer.add("no_such_table", row(0))
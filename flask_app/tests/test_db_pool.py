@@ -0,0 +1,145 @@
+import threading
+import time
+
+import pytest
+from mysql.connector import errors
+
+import db
+
+
+class FakeConnection:
+    """Stands in for a mysql.connector connection: counts pings, rollbacks and closes."""
+
+    def __init__(self, number):
+        self.number = number
+        self.in_transaction = False
+        self.alive = True
+        self.pings = 0
+        self.rollbacks = 0
+        self.closed = False
+
+    def ping(self, reconnect=False):
+        self.pings += 1
+        if not self.alive:
+            raise errors.InterfaceError("MySQL server has gone away")
+
+    def rollback(self):
+        self.rollbacks += 1
+        self.in_transaction = False
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def connector(monkeypatch):
+    """Replaces mysql.connector.connect; returns the list of every connection opened."""
+    opened = []
+
+    def connect(**kwargs):
+        opened.append(FakeConnection(len(opened)))
+        return opened[-1]
+
+    monkeypatch.setattr(db.mysql.connector, "connect", connect)
+    return opened
+
+
+def test_connections_are_reused(connector):
+    pool = db.ConnectionPool(pool_size=2, timeout=1)
+    with pool.connection() as first:
+        pass
+    with pool.connection() as second:
+        assert second is first
+    assert len(connector) == 1
+    stats = pool.stats()
+    assert stats["open"] == 1 and stats["idle"] == 1 and stats["in_use"] == 0 and stats["acquired"] == 2
+
+
+def test_release_ends_an_open_transaction(connector):
+    pool = db.ConnectionPool(pool_size=1, timeout=1)
+    with pool.connection() as conn:
+        conn.in_transaction = True
+    assert conn.rollbacks == 1 and not conn.closed
+
+
+def test_broken_connection_is_replaced(connector):
+    pool = db.ConnectionPool(pool_size=1, timeout=1)
+    with pytest.raises(errors.OperationalError):
+        with pool.connection():
+            raise errors.OperationalError("Lost connection to MySQL server during query")
+    assert connector[0].closed
+    with pool.connection() as conn:
+        assert conn is connector[1]
+    assert pool.stats()["recycled"] == 1
+
+
+def test_pool_timeout_when_every_connection_is_in_use(connector):
+    pool = db.ConnectionPool(pool_size=2, timeout=0.1)
+    held = [pool.acquire(), pool.acquire()]
+    started = time.monotonic()
+    with pytest.raises(db.PoolTimeout):
+        pool.acquire()
+    assert time.monotonic() - started >= 0.1
+    assert pool.stats()["timeouts"] == 1 and pool.stats()["in_use"] == 2
+    for conn in held:
+        pool.release(conn)
+
+
+def test_waiter_gets_the_connection_that_is_returned(connector):
+    pool = db.ConnectionPool(pool_size=1, timeout=2)
+    conn = pool.acquire()
+    threading.Timer(0.2, pool.release, (conn,)).start()
+    assert pool.acquire() is conn
+    stats = pool.stats()
+    assert stats["wait_max"] >= 0.2 and stats["wait_p99"] == stats["wait_max"]
+
+
+def test_failed_connect_frees_its_slot(connector, monkeypatch):
+    pool = db.ConnectionPool(pool_size=1, timeout=0.1)
+
+    def refuse(**kwargs):
+        raise errors.InterfaceError("Can't connect to MySQL server")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(db.mysql.connector, "connect", refuse)
+        with pytest.raises(errors.InterfaceError):
+            pool.acquire()
+    assert pool.stats()["open"] == 0
+    pool.release(pool.acquire())
+
+
+def test_idle_connections_are_pinged_and_dead_ones_dropped(connector):
+    pool = db.ConnectionPool(pool_size=2, timeout=1, health_check_interval=0)
+    conn = pool.acquire()
+    pool.release(conn)
+    conn.alive = False
+    replacement = pool.acquire()
+    assert conn.pings == 1 and conn.closed
+    assert replacement is connector[1]
+    pool.release(replacement)
+    assert pool.acquire() is replacement and replacement.pings == 1
+
+
+def test_recently_used_connections_are_not_pinged(connector):
+    pool = db.ConnectionPool(pool_size=1, timeout=1, health_check_interval=60)
+    conn = pool.acquire()
+    pool.release(conn)
+    assert pool.acquire() is conn and conn.pings == 0
+
+
+def test_wait_percentiles(connector):
+    pool = db.ConnectionPool(pool_size=1)
+    for waited in [0.01 * i for i in range(1, 101)]:
+        pool._record_wait(waited)
+    stats = pool.stats()
+    assert stats["wait_p50"] == pytest.approx(0.51)
+    assert stats["wait_p95"] == pytest.approx(0.96)
+    assert stats["wait_p99"] == pytest.approx(1.0)
+    assert stats["wait_max"] == pytest.approx(1.0)
+    assert stats["wait_avg"] == pytest.approx(0.505)
+
+
+def test_shared_pool_must_be_initialised(monkeypatch):
+    monkeypatch.setattr(db, "_pool", None)
+    with pytest.raises(RuntimeError):
+        db.connection()
@@ -0,0 +1,53 @@
+from datetime import datetime, timedelta
+
+from deadband import DeadbandFilter
+
+# The subscriber's configuration (final_sub.DEADBANDS and DEADBAND_HEARTBEAT)
+DEADBANDS = {
+    "ultrasound_data": (0.2,),
+    "battery_data": (0.05, 1),
+}
+HEARTBEAT = 300.0
+
+START = datetime(2024, 5, 1, 9, 0)
+
+
+def filtered(table, readings, owner="Anna", step=10):
+    """Feed one reading per `step` seconds and return which were stored."""
+    deadband = DeadbandFilter(DEADBANDS, heartbeat=HEARTBEAT)
+    return [deadband.should_store(table, (START + timedelta(seconds=i * step),) + tuple(reading) + (owner,))
+            for i, reading in enumerate(readings)]
+
+
+def test_ultrasound_is_stored_once_it_moves_more_than_0_2_cm():
+    stored = filtered("ultrasound_data", [(1.0,), (1.1,), (1.2,), (1.25,), (0.9,), (0.95,)])
+    # 1.25 is 0.25 from the stored 1.0; 0.9 is 0.35 from the stored 1.25
+    assert stored == [True, False, False, True, True, False]
+
+
+def test_battery_is_stored_when_either_voltage_or_percentage_moves():
+    stored = filtered("battery_data", [(3.90, 75), (3.93, 75), (3.96, 75), (3.96, 76), (3.96, 78), (3.90, 78)])
+    # Voltage moves 0.06 (3.96); percentage moves 2 (78); voltage moves 0.06 again (3.90)
+    assert stored == [True, False, True, False, True, True]
+
+
+def test_heartbeat_stores_an_unchanged_reading_every_300_seconds():
+    stored = filtered("ultrasound_data", [(1.0,)] * 7, step=60)
+    assert stored == [True, False, False, False, False, True, False]
+
+
+def test_state_is_kept_per_owner_and_table():
+    deadband = DeadbandFilter(DEADBANDS, heartbeat=HEARTBEAT)
+    assert deadband.should_store("ultrasound_data", (START, 1.0, "Anna"))
+    assert deadband.should_store("ultrasound_data", (START, 1.05, "Bo"))
+    assert deadband.should_store("battery_data", (START, 1.0, 1, "Anna"))
+    later = START + timedelta(seconds=10)
+    assert not deadband.should_store("ultrasound_data", (later, 1.1, "Anna"))
+    assert not deadband.should_store("ultrasound_data", (later, 1.1, "Bo"))
+    assert deadband.last_seen("ultrasound_data", "Anna") == (later, (1.1,))
+    assert deadband.stats()["ultrasound_data"] == {"stored": 2, "suppressed": 2, "suppressed_ratio": 0.5}
+
+
+def test_tables_without_a_deadband_are_always_stored():
+    stored = filtered("ldr_data", [(1,)] * 3)
+    assert stored == [True, True, True]
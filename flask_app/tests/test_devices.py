@@ -0,0 +1,102 @@
+import threading
+import time
+from contextlib import contextmanager
+
+import devices
+
+
+class FakeDatabase:
+    """The devices table: an auto-increment id per owner, upserted the way MySQL runs CREATE_QUERY.
+
+    With `id = LAST_INSERT_ID(id)` in the ON DUPLICATE KEY UPDATE, MySQL reports the existing row's id as
+    lastrowid, so an owner created meanwhile by another process still resolves to its id.
+    """
+
+    def __init__(self, rows=()):
+        self.ids = dict(rows)  # device_owner -> id
+        self.next_id = max(self.ids.values(), default=0) + 1
+        self.queries = []
+        self.commits = 0
+
+    @contextmanager
+    def connection(self):
+        yield FakeConnection(self)
+
+
+class FakeConnection:
+    def __init__(self, database):
+        self.database = database
+
+    def cursor(self):
+        return FakeCursor(self.database)
+
+    def commit(self):
+        self.database.commits += 1
+
+
+class FakeCursor:
+    def __init__(self, database):
+        self.database = database
+        self.lastrowid = None
+        self._rows = None
+
+    def execute(self, query, params=()):
+        database = self.database
+        database.queries.append(query)
+        if query == devices.CREATE_QUERY:
+            owner, = params
+            time.sleep(0.01)  # A round trip, long enough for concurrent resolvers to overlap
+            if owner not in database.ids:
+                database.ids[owner] = database.next_id
+                database.next_id += 1
+            self.lastrowid = database.ids[owner]
+        elif query.startswith("SELECT device_owner, id FROM devices"):
+            self._rows = list(database.ids.items())
+        else:
+            raise AssertionError(f"Unexpected query: {query}")
+
+    def fetchall(self):
+        return self._rows
+
+    def close(self):
+        pass
+
+
+def test_load_caches_every_known_device():
+    database = FakeDatabase({"Anna": 1, "Bo": 2})
+    resolver = devices.DeviceResolver(database.connection)
+    assert resolver.load() == 2
+    assert resolver.resolve("Bo") == 2 and resolver.resolve("Anna") == 1
+    assert len(database.queries) == 1  # Cache hits cost no round trip
+    assert resolver.stats() == {"devices": 2, "misses": 0}
+
+
+def test_new_owner_is_created_once():
+    database = FakeDatabase({"Anna": 1})
+    resolver = devices.DeviceResolver(database.connection)
+    resolver.load()
+    assert resolver.resolve("Cy") == 2
+    assert resolver.resolve("Cy") == 2
+    assert database.queries.count(devices.CREATE_QUERY) == 1 and database.commits == 1
+    assert resolver.stats() == {"devices": 2, "misses": 1}
+
+
+def test_owner_created_by_another_process_gets_its_existing_id():
+    # Not loaded here, but created since by another subscriber: the upsert returns the existing id
+    database = FakeDatabase({"Anna": 1, "Bo": 7})
+    resolver = devices.DeviceResolver(database.connection)
+    assert resolver.resolve("Bo") == 7
+    assert database.ids == {"Anna": 1, "Bo": 7}
+
+
+def test_concurrent_first_sightings_share_one_insert():
+    database = FakeDatabase()
+    resolver = devices.DeviceResolver(database.connection)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(resolver.resolve("Dan"))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [1] * 8
+    assert database.queries.count(devices.CREATE_QUERY) == 1
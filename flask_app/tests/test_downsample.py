@@ -0,0 +1,90 @@
+import numpy as np
+import pytest
+
+from downsample import downsample, lttb_indices, minmax_indices
+
+
+def series(n):
+    x = np.arange(n, dtype=np.float64)
+    return x, np.sin(x / 10)
+
+
+@pytest.mark.parametrize("mode", ["lttb", "minmax"])
+def test_empty_input(mode):
+    x, y = downsample(np.array([], dtype="datetime64[s]"), [], 100, mode)
+    assert len(x) == 0 and len(y) == 0
+
+
+@pytest.mark.parametrize("mode", ["lttb", "minmax"])
+@pytest.mark.parametrize("n", [1, 2, 50, 100])
+def test_fewer_points_than_the_target_are_kept(mode, n):
+    x, y = series(n)
+    dx, dy = downsample(x, y, 100, mode)
+    np.testing.assert_array_equal(dx, x)
+    np.testing.assert_array_equal(dy, y)
+
+
+@pytest.mark.parametrize("mode", ["lttb", "minmax"])
+def test_unsorted_input_is_sorted(mode):
+    x = np.array([3, 1, 2, 0], dtype=np.float64)
+    dx, dy = downsample(x, x * 2, 100, mode)
+    np.testing.assert_array_equal(dx, [0, 1, 2, 3])
+    np.testing.assert_array_equal(dy, [0, 2, 4, 6])
+
+
+def test_unknown_mode():
+    with pytest.raises(ValueError):
+        downsample([1, 2], [1, 2], 10, "average")
+
+
+@pytest.mark.parametrize("n, threshold", [(1000, 100), (1001, 100), (101, 100), (10, 3), (7, 5)])
+def test_lttb_picks_one_point_per_bucket(n, threshold):
+    x, y = series(n)
+    idx = lttb_indices(x, y, threshold)
+    assert len(idx) == threshold
+    assert idx[0] == 0 and idx[-1] == n - 1
+    assert np.all(np.diff(idx) > 0)
+    # Each inner pick comes from its own bucket of the n - 2 inner points
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    for bucket, index in enumerate(idx[1:-1]):
+        assert edges[bucket] <= index < edges[bucket + 1]
+
+
+def test_lttb_below_three_points_keeps_everything():
+    x, y = series(10)
+    np.testing.assert_array_equal(lttb_indices(x, y, 2), np.arange(10))
+
+
+@pytest.mark.parametrize("mode", ["lttb", "minmax"])
+def test_spike_survives(mode):
+    x, y = series(10000)
+    y[4321] = 50.0
+    dx, dy = downsample(x, y, 200, mode)
+    assert 4321.0 in dx and dy.max() == 50.0
+
+
+@pytest.mark.parametrize("n, threshold", [(1000, 100), (1001, 101), (9, 8), (100, 4)])
+def test_minmax_keeps_each_buckets_extremes(n, threshold):
+    rng = np.random.default_rng(1)
+    y = rng.normal(size=n)
+    idx = minmax_indices(y, threshold)
+    assert np.all(np.diff(idx) > 0)
+    assert idx[0] == 0 and idx[-1] == n - 1
+    buckets = threshold // 2
+    assert len(idx) <= 2 * buckets + 2
+    bucket_of = (np.arange(n) * buckets) // n
+    for bucket in range(buckets):
+        members = np.flatnonzero(bucket_of == bucket)
+        assert members[np.argmin(y[members])] in idx
+        assert members[np.argmax(y[members])] in idx
+
+
+def test_minmax_below_four_points_keeps_everything():
+    np.testing.assert_array_equal(minmax_indices(np.zeros(10), 3), np.arange(10))
+
+
+def test_datetime_axis_is_preserved():
+    x = np.datetime64("2026-10-18T00:00") + np.arange(1440).astype("timedelta64[m]")
+    dx, dy = downsample(x, np.arange(1440), 100, "lttb")
+    assert dx.dtype == x.dtype and len(dx) == 100
+    assert dx[0] == x[0] and dx[-1] == x[-1]
@@ -0,0 +1,112 @@
+import csv
+import io
+import json
+
+import pytest
+
+import export
+
+
+class FakeCursor:
+    """Raw, unbuffered cursor: values come back as bytearrays, like the server's text protocol."""
+
+    def __init__(self, rows):
+        self.rows = [[None if value is None else bytearray(str(value), "utf-8") for value in row] for row in rows]
+        self.executed = []
+        self.fetches = 0
+
+    def execute(self, query, params=()):
+        self.executed.append((query, params))
+
+    def fetchmany(self, size):
+        self.fetches += 1
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, rows=()):
+        self.cursor_ = FakeCursor(rows)
+        self.closed = False
+
+    def cursor(self, **kwargs):
+        return self.cursor_
+
+    def close(self):
+        self.closed = True
+
+
+def stream(rows, fetch_rows=2):
+    conn = FakeConnection(rows)
+    return conn, export.QueryStream(conn, "SELECT ...", ("start", "end"), fetch_rows=fetch_rows)
+
+
+BOX_ROWS = [("2024-05-01 09:00:00", "empty", 3.5, "Anna"), ("2024-05-01 10:00:00", "full", 1.0, 'Bo "the, 2nd"'),
+            ("2024-05-01 11:00:00", "empty", None, "Cy\nDan")]
+
+
+def test_stream_fetches_in_chunks_and_counts_rows():
+    conn, rows = stream([(i,) for i in range(5)], fetch_rows=2)
+    assert [len(chunk) for chunk in rows] == [2, 2, 1]
+    assert rows.rows == 5
+    assert conn.cursor_.executed[0] == ("SET SESSION net_write_timeout = %s;", (export.DEFAULT_WRITE_TIMEOUT,))
+    assert conn.cursor_.executed[1] == ("SELECT ...", ("start", "end"))
+
+
+def test_csv_header_escaping_and_one_block_per_chunk():
+    conn, rows = stream(BOX_ROWS, fetch_rows=2)
+    chunks = list(export.csv_chunks(rows, "box"))
+    assert chunks[0] == "timestamp,status,distance,device_owner\r\n"
+    assert len(chunks) == 3  # Header, then chunks of 2 and 1 rows
+    parsed = list(csv.reader(io.StringIO("".join(chunks))))
+    assert parsed[1:] == [["2024-05-01 09:00:00", "empty", "3.5", "Anna"],
+                          ["2024-05-01 10:00:00", "full", "1.0", 'Bo "the, 2nd"'],
+                          ["2024-05-01 11:00:00", "empty", "", "Cy\nDan"]]
+    assert conn.closed
+
+
+def test_ndjson_converts_numbers_and_keeps_nulls():
+    conn, rows = stream(BOX_ROWS, fetch_rows=2)
+    chunks = list(export.ndjson_chunks(rows, "box"))
+    assert len(chunks) == 2 and all(chunk.endswith("\n") for chunk in chunks)
+    lines = "".join(chunks).splitlines()
+    assert [json.loads(line) for line in lines] == [
+        {"timestamp": "2024-05-01 09:00:00", "status": "empty", "distance": 3.5, "device_owner": "Anna"},
+        {"timestamp": "2024-05-01 10:00:00", "status": "full", "distance": 1.0, "device_owner": 'Bo "the, 2nd"'},
+        {"timestamp": "2024-05-01 11:00:00", "status": "empty", "distance": None, "device_owner": "Cy\nDan"},
+    ]
+    assert conn.closed
+
+
+@pytest.mark.parametrize("fmt", sorted(export.CHUNKS))
+def test_stopping_early_closes_the_connection_and_fetches_no_more(fmt):
+    conn, rows = stream([(f"2024-05-01 09:{minute:02}:00", 1, "Anna") for minute in range(10)], fetch_rows=2)
+    chunks = export.CHUNKS[fmt](rows, "ldr")
+    next(chunks)
+    next(chunks)
+    chunks.close()  # The client went away
+    assert conn.closed
+    fetches = conn.cursor_.fetches
+    assert list(rows) == [] and conn.cursor_.fetches == fetches
+
+
+def test_failed_query_closes_the_connection():
+    conn = FakeConnection()
+
+    def execute(query, params=()):
+        raise RuntimeError("Table 'ldr_data' doesn't exist")
+
+    conn.cursor_.execute = execute
+    with pytest.raises(RuntimeError):
+        export.QueryStream(conn, "SELECT ...", ())
+    assert conn.closed
+
+
+def test_export_query_joins_the_owner():
+    query = export.export_query("battery", "battery_data.timestamp >= %s")
+    assert query.startswith("SELECT timestamp, voltage, percentage, devices.device_owner FROM battery_data ")
+    assert "STRAIGHT_JOIN devices ON devices.id = battery_data.device_id" in query
+    assert query.endswith("ORDER BY battery_data.timestamp;")
@@ -0,0 +1,69 @@
+import pytest
+
+import app as app_module
+import db
+
+
+class FakeCursor:
+    def __init__(self, rows):
+        self.rows = list(rows)
+
+    def execute(self, query, params=()):
+        pass
+
+    def fetchmany(self, size):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, rows=()):
+        self.rows = rows
+        self.closed = False
+
+    def cursor(self, **kwargs):
+        return FakeCursor(self.rows)
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def client():
+    app_module.app.config['TESTING'] = True
+    with app_module.app.test_client() as client:
+        with client.session_transaction() as session:
+            session['username'] = 'tester'
+        yield client
+
+
+def free_slots():
+    return app_module._export_slots._value
+
+
+@pytest.mark.parametrize("error", [RuntimeError("pool exhausted"), OSError("connection refused")])
+def test_failed_connect_releases_the_slot(client, monkeypatch, error):
+    def connect():
+        raise error
+
+    monkeypatch.setattr(db, "connect", connect)
+    slots = free_slots()
+    for _ in range(slots + 1):
+        with pytest.raises(type(error)):
+            client.get('/export/ldr.csv?start=2024-05-01&end=2024-05-02')
+    assert free_slots() == slots
+
+
+def test_finished_export_releases_the_slot(client, monkeypatch):
+    conn = FakeConnection([(b'2024-05-01 10:00:00', b'1', b'Anna')])
+    monkeypatch.setattr(db, "connect", lambda: conn)
+    slots = free_slots()
+    response = client.get('/export/ldr.csv?start=2024-05-01&end=2024-05-02')
+    assert response.status_code == 200
+    assert b'Anna' in response.data
+    response.close()
+    assert conn.closed
+    assert free_slots() == slots
@@ -0,0 +1,153 @@
+import asyncio
+import time
+
+import pytest
+
+import final_pub
+import sim_hardware
+import wire_format
+
+JUMP = 800_000_000  # Seconds the clock steps forward when NTP syncs after an unsynced boot
+
+
+@pytest.fixture(autouse=True)
+def publisher(monkeypatch):
+    """Fresh publisher state with intervals short enough to run the scheduler for a few seconds."""
+    monkeypatch.setattr(final_pub, "batches", {})
+    monkeypatch.setattr(final_pub, "batch_started", {})
+    monkeypatch.setattr(final_pub, "outbox", [])
+    monkeypatch.setattr(final_pub, "outbox_dropped", 0)
+    monkeypatch.setattr(final_pub, "batches_dropped", 0)
+    monkeypatch.setattr(final_pub, "time_synced", False)
+    monkeypatch.setattr(final_pub, "previous_state", False)
+    monkeypatch.setattr(final_pub, "empty_box_published", False)
+    monkeypatch.setattr(final_pub, "ULTRASOUND_INTERVAL", 0.05)
+    monkeypatch.setattr(final_pub, "DISTANCE_PUBLISH_INTERVAL", 0.1)
+    monkeypatch.setattr(final_pub, "LDR_INTERVAL", 0.05)
+    monkeypatch.setattr(final_pub, "BATTERY_INTERVAL", 0.1)
+    monkeypatch.setattr(final_pub, "PUBLISH_INTERVAL", 0.05)
+    monkeypatch.setattr(final_pub, "BATCH_WINDOW", 0.5)
+    monkeypatch.setattr(final_pub, "TASK_RESTART_DELAY", 0.05)
+    monkeypatch.setattr(final_pub, "RECONNECT_MIN_DELAY", 0.1)
+    monkeypatch.setattr(final_pub, "WIFI_CONNECT_TIMEOUT", 1)
+
+
+class SteppingHardware(sim_hardware.SimulatedHardware):
+    """Boots with an unsynced clock JUMP seconds behind; sync_time() steps it to the real time."""
+
+    def __init__(self, monkeypatch, **kwargs):
+        super().__init__(seed=1, **kwargs)
+        self.offset = -JUMP
+        monkeypatch.setattr(final_pub, "get_epoch_time", lambda: int(time.time()) + self.offset)
+
+    def sync_time(self):
+        self.offset = 0
+
+
+def sample_times(hw, topic):
+    return [epoch for _, sent_topic, message in hw.published if sent_topic == topic
+            for epoch, _ in wire_format.decode(message)[2]]
+
+
+def test_scheduler_publishes_every_topic():
+    hw = sim_hardware.SimulatedHardware(seed=1)
+    state = asyncio.run(final_pub.run(hw, duration=1.5))
+    topics = {topic for _, topic, _ in hw.published}
+    assert {final_pub.MQTT_TOPIC_DISTANCE, final_pub.MQTT_TOPIC_BATTERY} <= topics
+    assert state["published"] > 0 and state["restarts"] == 0
+    assert not final_pub.outbox and not final_pub.batches
+
+
+def test_sensors_keep_sampling_while_the_broker_is_down():
+    hw = sim_hardware.SimulatedHardware(seed=1)
+    hw.broker_up = False
+    asyncio.run(final_pub.run(hw, duration=1))
+    assert not hw.published
+    assert len(hw.samples["battery"]) >= 5
+    assert final_pub.outbox
+
+
+def test_batch_spanning_a_clock_sync_is_published(monkeypatch):
+    # Wi-Fi comes up only after the first batches are collected on the unsynced clock
+    hw = SteppingHardware(monkeypatch)
+    hw.wifi_up = False
+
+    async def scenario():
+        task = asyncio.create_task(final_pub.run(hw, duration=3))
+        await asyncio.sleep(0.8)
+        hw.wifi_up = True
+        return await task
+
+    state = asyncio.run(scenario())
+    epochs = sample_times(hw, final_pub.MQTT_TOPIC_BATTERY)
+    assert any(epoch < time.time() - JUMP / 2 for epoch in epochs)
+    assert any(epoch > time.time() - 60 for epoch in epochs)
+    assert not final_pub.outbox
+    assert state["restarts"] == 0
+
+
+def test_flush_splits_a_batch_at_a_clock_step():
+    final_pub.batches[final_pub.MQTT_TOPIC_BATTERY] = [[1000, 3.7, 60], [1000 + JUMP, 3.7, 60], [999 + JUMP, 3.6, 50]]
+    final_pub.batch_started[final_pub.MQTT_TOPIC_BATTERY] = time.time()
+    final_pub.flush_batches(force=True)
+    assert len(final_pub.outbox) == 3
+    epochs = [wire_format.decode(message)[2][0][0] for _, message in final_pub.outbox]
+    assert epochs == [1000, 1000 + JUMP, 999 + JUMP]
+
+
+def test_unencodable_batch_is_dropped():
+    final_pub.batches[final_pub.MQTT_TOPIC_DISTANCE] = [[-1, 1.0]]
+    final_pub.batch_started[final_pub.MQTT_TOPIC_DISTANCE] = time.time()
+    final_pub.flush_batches(force=True)
+    assert not final_pub.outbox and not final_pub.batches
+    assert final_pub.batches_dropped == 1
+
+
+def test_failing_task_is_restarted():
+    hw = sim_hardware.SimulatedHardware(seed=1)
+    reads = hw.read_battery_raw
+    calls = []
+
+    def read_battery_raw():
+        calls.append(1)
+        if len(calls) == 2:
+            raise OSError("ADC read failed")
+        return reads()
+
+    hw.read_battery_raw = read_battery_raw
+    state = asyncio.run(final_pub.run(hw, duration=1))
+    assert state["restarts"] == 1
+    assert len(calls) > 3
+    assert state["published"] > 0
+
+
+def test_drain_outbox_sends_pending_batches():
+    hw = sim_hardware.SimulatedHardware(seed=1)
+    client = hw.mqtt_client()
+    client.connect()
+    final_pub.batches[final_pub.MQTT_TOPIC_BATTERY] = [[1000, 3.7, 60], [2000 + JUMP, 3.7, 60]]
+    final_pub.batch_started[final_pub.MQTT_TOPIC_BATTERY] = time.time()
+    final_pub.drain_outbox(client)
+    assert len(hw.published) == 2 and not final_pub.outbox
+
+
+def largest_gap(times):
+    return max(later - earlier for earlier, later in zip(times, times[1:]))
+
+
+@pytest.mark.parametrize("latency", [dict(connect_latency=30), dict(publish_latency=30)])
+def test_a_hung_broker_stalls_sampling_for_at_most_the_socket_timeout(monkeypatch, latency):
+    monkeypatch.setattr(final_pub, "MQTT_SOCKET_TIMEOUT", 0.2)
+    hw = sim_hardware.SimulatedHardware(seed=1, **latency)
+    state = asyncio.run(final_pub.run(hw, duration=1.5))
+    assert not hw.published
+    assert largest_gap(hw.samples["ldr"]) < final_pub.LDR_INTERVAL + final_pub.MQTT_SOCKET_TIMEOUT + 0.1
+    assert len(hw.samples["ldr"]) >= 5
+    assert state["restarts"] == 0
+
+
+def test_slow_publishes_within_the_timeout_go_through(monkeypatch):
+    monkeypatch.setattr(final_pub, "MQTT_SOCKET_TIMEOUT", 0.2)
+    hw = sim_hardware.SimulatedHardware(seed=1, connect_latency=0.1, publish_latency=0.05)
+    state = asyncio.run(final_pub.run(hw, duration=1.5))
+    assert state["connects"] == 1 and state["published"] > 0
@@ -0,0 +1,23 @@
+import fleet_sim
+import wire_format
+
+
+def readings(simulator, duration):
+    """Number of readings per topic in the messages of a run."""
+    counts = {}
+    for _, topic, payload in simulator.messages(duration):
+        counts[topic] = counts.get(topic, 0) + len(wire_format.decode(payload)[2])
+    return counts
+
+
+def test_short_batched_run_sends_its_open_batches():
+    sent = fleet_sim.FleetSimulator(20, seed=1, start=0).run(lambda *message: None, duration=20, speed=0)
+    assert sent >= 20
+
+
+def test_batched_and_unbatched_runs_carry_the_same_readings():
+    simulator = fleet_sim.FleetSimulator(5, seed=1, start=0)
+    batched = readings(simulator, 95)
+    unbatched = readings(fleet_sim.FleetSimulator(5, seed=1, start=0, batch=False), 95)
+    assert batched == unbatched
+    assert not any(device._batches for device in simulator.devices)
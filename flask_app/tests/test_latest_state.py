@@ -0,0 +1,91 @@
+import re
+import sqlite3
+from datetime import datetime
+
+import pytest
+
+from latest_state import COLUMNS, LATEST_STATE_QUERIES, LatestState
+
+T0 = datetime(2024, 5, 1, 9, 0)
+
+
+def at(minute):
+    return T0.replace(minute=minute)
+
+
+class FakeCursor:
+    """Runs the MySQL upsert on an in-memory SQLite table, translated to SQLite's dialect.
+
+    SQLite evaluates every assignment against the old row, while MySQL applies them in order; the query
+    assigns each reading column before its timestamp column, so both give the same result.
+    """
+
+    def __init__(self):
+        self.db = sqlite3.connect(":memory:")
+        self.db.execute("CREATE TABLE device_latest_state (device_owner TEXT PRIMARY KEY, last_seen TEXT NOT NULL, "
+                        + ", ".join(COLUMNS) + ")")
+
+    def executemany(self, query, rows):
+        query = re.sub(r"VALUES\((\w+)\)", r"excluded.\1", query)
+        query = (query.replace("ON DUPLICATE KEY UPDATE", "ON CONFLICT (device_owner) DO UPDATE SET")
+                 .replace("GREATEST(", "MAX(").replace("IF(", "IIF(").replace("%s", "?"))
+        self.db.executemany(query, [[str(value) if isinstance(value, datetime) else value for value in row]
+                                    for row in rows])
+
+    def row(self, owner):
+        cursor = self.db.execute("SELECT * FROM device_latest_state WHERE device_owner = ?", (owner,))
+        names = [column[0] for column in cursor.description]
+        values = cursor.fetchone()
+        return dict(zip(names, values)) if values else None
+
+
+def flush(state, cur):
+    for table, rows in state.drain().items():
+        if rows:
+            cur.executemany(LATEST_STATE_QUERIES[table], rows)
+
+
+@pytest.fixture
+def cur():
+    return FakeCursor()
+
+
+def test_battery_only_reading_keeps_the_box_and_ldr_fields(cur):
+    state = LatestState()
+    state.record("ultrasound_data", (at(0), 1.5, "Anna"))
+    state.record("empty_box_status", (at(1), "empty", 3.5, "Anna"))
+    state.record("ldr_data", (at(2), 1, "Anna"))
+    flush(state, cur)
+
+    state.record("battery_data", (at(5), 3.9, 75, "Anna"))
+    flush(state, cur)
+    row = cur.row("Anna")
+    assert row["battery_voltage"] == 3.9 and row["battery_percentage"] == 75
+    assert row["box_status"] == "empty" and row["box_distance"] == 3.5 and row["box_status_at"] == str(at(1))
+    assert row["distance"] == 1.5 and row["last_ldr_open_at"] == str(at(2))
+    assert row["last_seen"] == str(at(5))
+
+
+def test_older_reading_does_not_move_a_device_back(cur):
+    state = LatestState()
+    state.record("battery_data", (at(10), 3.8, 70, "Anna"))
+    flush(state, cur)
+    state.record("battery_data", (at(5), 3.9, 75, "Anna"))  # Late batch
+    state.record("ldr_data", (at(6), 1, "Anna"))
+    flush(state, cur)
+    row = cur.row("Anna")
+    assert (row["battery_voltage"], row["battery_at"]) == (3.8, str(at(10)))
+    assert row["last_ldr_open_at"] == str(at(6)) and row["last_seen"] == str(at(10))
+
+
+def test_one_row_per_device_and_flush():
+    state = LatestState()
+    for minute in range(5):
+        state.record("ultrasound_data", (at(minute), float(minute), "Anna"))
+    state.record("ldr_data", (at(1), 0, "Bo"))  # Closings are ignored
+    state.record("ldr_data", (at(2), 1, "Bo"))
+    rows = state.drain()["device_latest_state"]
+    assert len(rows) == 2
+    anna = dict(zip(("device_owner", "last_seen") + COLUMNS, rows[0]))
+    assert anna["distance"] == 4.0 and anna["distance_at"] == at(4) and anna["battery_at"] is None
+    assert not state.pending()
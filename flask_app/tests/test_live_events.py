@@ -0,0 +1,71 @@
+import json
+import time
+from datetime import datetime
+from types import SimpleNamespace
+
+import paho.mqtt.client as mqtt
+import pytest
+
+import live_events
+
+SECRET = "test secret"
+
+
+class FakeClient:
+    def __init__(self):
+        self.messages = []
+
+    def publish(self, topic, payload, qos=0):
+        self.messages.append((topic, payload))
+        return SimpleNamespace(rc=mqtt.MQTT_ERR_SUCCESS)
+
+
+def deliver(hub, payload):
+    hub._on_message(None, None, SimpleNamespace(payload=payload))
+
+
+@pytest.fixture
+def hub():
+    return live_events.EventHub(lambda: None, SECRET)
+
+
+def test_published_batches_reach_the_dashboard(hub):
+    client = FakeClient()
+    publisher = live_events.EventPublisher(SECRET, client)
+    publisher.add("battery_data", (datetime(2024, 5, 1, 9, 30), 3.7, 60, "Anna"))
+    publisher.add("ldr_data", (datetime(2024, 5, 1, 9, 31), 1, "Bo"))
+    assert publisher.flush() == 2
+    [(topic, payload)] = client.messages
+    assert topic == live_events.EVENTS_TOPIC and not topic.startswith(("esp32/", "sensor/", "battery/"))
+
+    with hub.subscribe("Anna") as subscription:
+        deliver(hub, payload)
+        events = subscription.get(timeout=0)
+    assert [(event["type"], event["owner"], event["percentage"]) for event in events] == [("battery", "Anna", 60)]
+    assert hub.stats()["received"] == 2 and hub.stats()["invalid"] == 0
+
+
+@pytest.mark.parametrize("payload", [
+    json.dumps([{"type": "battery", "owner": "Anna", "percentage": 0}]).encode(),  # Unsigned
+    live_events.sign_batch("another secret", [{"type": "battery", "owner": "Anna", "percentage": 0}]),
+    live_events.sign_batch(SECRET, [{"type": "ldr", "owner": "Anna"}], now=time.time() - 3600),  # Replayed
+    b"",
+])
+def test_unsigned_forged_or_stale_batches_are_dropped(hub, payload):
+    with hub.subscribe() as subscription:
+        deliver(hub, payload)
+        assert subscription.get(timeout=0) == []
+    assert hub.stats()["invalid"] == 1 and hub.stats()["received"] == 0
+
+
+def test_tampered_batch_is_dropped(hub):
+    payload = live_events.sign_batch(SECRET, [{"type": "battery", "owner": "Anna", "percentage": 60}])
+    deliver(hub, payload.replace(b'"percentage":60', b'"percentage":1'))
+    assert hub.stats()["invalid"] == 1
+
+
+def test_a_secret_is_required():
+    with pytest.raises(ValueError):
+        live_events.EventPublisher("")
+    with pytest.raises(ValueError):
+        live_events.EventHub(lambda: None, None)
@@ -0,0 +1,80 @@
+import threading
+
+import pytest
+
+import metrics
+
+
+def test_histogram_exposition():
+    registry = metrics.Registry()
+    histogram = registry.histogram("request_seconds", "Request duration", ("endpoint",), buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 3.0):
+        histogram.observe(value, endpoint="home")
+    assert registry.render() == (
+        "# HELP request_seconds Request duration\n"
+        "# TYPE request_seconds histogram\n"
+        'request_seconds_bucket{endpoint="home",le="0.1"} 2\n'
+        'request_seconds_bucket{endpoint="home",le="1.0"} 3\n'
+        'request_seconds_bucket{endpoint="home",le="+Inf"} 4\n'
+        'request_seconds_sum{endpoint="home"} 3.65\n'
+        'request_seconds_count{endpoint="home"} 4\n')
+
+
+def test_counters_gauges_and_label_escaping():
+    registry = metrics.Registry()
+    registry.counter("requests_total", "Requests", ("path",)).inc(path='/a"b\\')
+    registry.gauge("depth", "Queue depth", ("quantile",), func=lambda: {50: 1.5, 99: None})
+    registry.gauge("broken", "Source not ready", func=lambda: 1 / 0)
+    lines = registry.render().splitlines()
+    assert 'requests_total{path="/a\\"b\\\\"} 1' in lines
+    assert 'depth{quantile="50"} 1.5' in lines
+    assert not any(line.startswith(("depth{quantile=\"99\"}", "broken ")) for line in lines)
+    assert "# TYPE broken gauge" in lines
+
+
+def test_labels_must_match():
+    histogram = metrics.Registry().histogram("stage_seconds", "Stages", ("endpoint", "stage"))
+    with pytest.raises(ValueError):
+        histogram.observe(1.0, endpoint="home")
+
+
+def test_duplicate_metric_names_are_rejected():
+    registry = metrics.Registry()
+    registry.counter("events_total", "Events")
+    with pytest.raises(ValueError):
+        registry.gauge("events_total", "Events again")
+
+
+def stage_timer():
+    registry = metrics.Registry()
+    return registry, metrics.StageTimer(registry.histogram("stage_seconds", "Stages", ("endpoint", "stage")))
+
+
+def test_stages_of_worker_threads_are_booked_to_the_request():
+    registry, timer = stage_timer()
+    timer.begin("patient_data")
+    context = timer.context()
+
+    def worker():
+        with timer.attach(context):
+            timer.record("sql_battery", 0.2)
+        timer.record("after_detach", 0.1)  # No longer part of the request
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    thread.join()
+    with timer.stage("template"):
+        pass
+    stages = timer.end()
+    assert [name for name, _ in stages] == ["sql_battery", "template"]
+    output = registry.render()
+    assert 'stage_seconds_count{endpoint="patient_data",stage="sql_battery"} 1' in output
+    assert 'stage_seconds_sum{endpoint="patient_data",stage="sql_battery"} 0.2' in output
+    assert 'stage_seconds_count{endpoint="",stage="after_detach"} 1' in output
+
+
+def test_stages_outside_a_request_are_only_observed():
+    registry, timer = stage_timer()
+    timer.record("png_encode", 0.01)
+    assert timer.end() == []
+    assert 'stage_seconds_bucket{endpoint="",stage="png_encode",le="0.01"} 1' in registry.render()
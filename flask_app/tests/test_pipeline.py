@@ -0,0 +1,85 @@
+import base64
+import json
+import threading
+import time
+from datetime import datetime
+
+import pytest
+
+from pipeline import IngestPipeline, REPLAY_SUFFIX
+
+
+def spill_record(payload):
+    return json.dumps({"topic": "sensor/ldr", "payload": base64.b64encode(payload).decode("ascii"),
+                       "received_at": datetime(2026, 10, 18, 12).isoformat(), "content_type": None}) + "\n"
+
+
+class Recorder:
+    def __init__(self):
+        self.payloads = []
+        self.lock = threading.Lock()
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def __call__(self, topic, payload, received_at, content_type):
+        self.gate.wait()
+        with self.lock:
+            self.payloads.append(payload)
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def spill_path(tmp_path):
+    return str(tmp_path / "spill.jsonl")
+
+
+def test_messages_are_handled(spill_path):
+    recorder = Recorder()
+    pipeline = IngestPipeline(recorder, workers=2, spill_path=spill_path, report_interval=0).start()
+    for i in range(100):
+        pipeline.submit("sensor/ldr", b"%d" % i)
+    pipeline.stop()
+    assert sorted(recorder.payloads) == sorted(b"%d" % i for i in range(100))
+    assert pipeline.stats()["processed"] == 100
+
+
+def test_full_queue_spills_in_arrival_order_and_replays(spill_path):
+    recorder = Recorder()
+    recorder.gate.clear()  # Hold the single worker so the queue fills up
+    pipeline = IngestPipeline(recorder, workers=1, max_queue=2, policy="spill", spill_path=spill_path,
+                              report_interval=0).start()
+    for i in range(10):
+        pipeline.submit("sensor/ldr", b"%d" % i)
+    assert pipeline.stats()["spilled"] >= 7
+
+    recorder.gate.set()
+    wait_for(lambda: len(recorder.payloads) == 10)
+    pipeline.stop()
+    assert recorder.payloads == [b"%d" % i for i in range(10)]
+    assert pipeline.stats()["replayed"] == pipeline.stats()["spilled"]
+
+
+def test_leftover_replay_file_is_replayed_before_the_spill_file(spill_path):
+    with open(spill_path + REPLAY_SUFFIX, "w") as replay_file:
+        replay_file.write(spill_record(b"left over") * 2)
+    with open(spill_path, "w") as spill_file:
+        spill_file.write(spill_record(b"spilled"))
+
+    recorder = Recorder()
+    pipeline = IngestPipeline(recorder, workers=1, policy="block", spill_path=spill_path, report_interval=0)
+    pipeline.start()
+    wait_for(lambda: len(recorder.payloads) == 3)
+    pipeline.stop()
+    assert recorder.payloads == [b"left over", b"left over", b"spilled"]
+    assert pipeline.stats()["replayed"] == 3
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        IngestPipeline(lambda *args: None, policy="ignore")
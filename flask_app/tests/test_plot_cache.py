@@ -0,0 +1,64 @@
+from plot_cache import PlotCache
+
+
+def image(size, fill=b"x"):
+    return fill * size
+
+
+def test_byte_cap_evicts_the_least_recently_used():
+    cache = PlotCache(max_entries=10, max_bytes=300)
+    for owner in ("Anna", "Bo", "Cy"):
+        cache.put("ultrasound", owner, 1, image(100))
+    assert cache.get("ultrasound", "Anna", 1) is not None  # Anna is now the most recently used
+    cache.put("ultrasound", "Dan", 1, image(100))
+    assert cache.get("ultrasound", "Bo", 1) is None
+    assert all(cache.get("ultrasound", owner, 1) for owner in ("Anna", "Cy", "Dan"))
+    stats = cache.stats()
+    assert stats["bytes"] == 300 and stats["entries"] == 3 and stats["evictions"] == 1
+
+
+def test_large_image_evicts_as_many_as_needed():
+    cache = PlotCache(max_entries=10, max_bytes=300)
+    for owner in ("Anna", "Bo", "Cy"):
+        cache.put("ldr", owner, 1, image(100))
+    cache.put("ldr", "Dan", 1, image(250))
+    assert cache.stats()["entries"] == 1 and cache.stats()["bytes"] == 250
+    assert cache.stats()["evictions"] == 3
+
+
+def test_image_larger_than_the_cap_is_not_cached():
+    cache = PlotCache(max_entries=10, max_bytes=300)
+    cache.put("ldr", "Anna", 1, image(100))
+    cache.put("ldr", "Bo", 1, image(301))
+    assert cache.get("ldr", "Bo", 1) is None
+    assert cache.get("ldr", "Anna", 1) is not None
+
+
+def test_entry_cap():
+    cache = PlotCache(max_entries=2, max_bytes=1000)
+    for owner in ("Anna", "Bo", "Cy"):
+        cache.put("ldr", owner, 1, image(10))
+    assert cache.get("ldr", "Anna", 1) is None and cache.stats()["entries"] == 2
+
+
+def test_new_version_is_a_miss_and_replaces_the_old_one():
+    cache = PlotCache()
+    cache.put("ultrasound", "Anna", (1, 10), image(100, b"a"))
+    cache.put("ultrasound", "Bo", (1, 10), image(100, b"b"))
+    assert cache.get("ultrasound", "Anna", (1, 11)) is None
+    rendered = []
+    result = cache.get_or_render("ultrasound", "Anna", (1, 11), lambda: rendered.append(1) or image(50, b"c"))
+    assert result == image(50, b"c") and rendered == [1]
+    assert cache.get("ultrasound", "Anna", (1, 10)) is None  # Dropped when the new version was stored
+    assert cache.get("ultrasound", "Bo", (1, 10)) == image(100, b"b")  # Other owners keep theirs
+    stats = cache.stats()
+    assert stats["bytes"] == 150 and stats["invalidations"] == 1
+
+
+def test_invalidate_by_plot_type():
+    cache = PlotCache()
+    cache.put("ultrasound", "Anna", 1, image(10))
+    cache.put("ldr", "Anna", 1, image(10))
+    cache.invalidate("ldr")
+    assert cache.get("ldr", "Anna", 1) is None and cache.get("ultrasound", "Anna", 1) is not None
+    assert cache.stats()["bytes"] == 10
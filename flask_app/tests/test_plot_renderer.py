@@ -0,0 +1,52 @@
+import os
+import subprocess
+import sys
+from datetime import datetime, timedelta
+
+import numpy as np
+
+import metrics
+import plot_renderer
+
+DAY = (datetime(2024, 5, 1), datetime(2024, 5, 2))
+
+
+def minutes(n):
+    return np.datetime64(DAY[0], "s") + np.arange(n).astype("timedelta64[m]")
+
+
+def test_render_returns_png_and_stage_timings():
+    img, stages = plot_renderer.render("ultrasound", minutes(100), np.arange(100.0), DAY)
+    assert img.getvalue().startswith(b"\x89PNG\r\n\x1a\n")
+    assert [name for name, _ in stages] == ["plot_draw", "png_encode"]
+    assert all(seconds >= 0 for _, seconds in stages)
+
+
+def test_render_empty_series():
+    img, _ = plot_renderer.render("ldr", minutes(0), [], DAY)
+    assert img.getvalue().startswith(b"\x89PNG")
+
+
+def test_stage_timer_records_stages_timed_elsewhere():
+    registry = metrics.Registry()
+    timer = metrics.StageTimer(registry.histogram("stage_seconds", "Stages", ("endpoint", "stage")))
+    timer.begin("plot")
+    timer.record("png_encode", 0.25)
+    assert timer.end() == [("png_encode", 0.25)]
+    assert 'stage_seconds_count{endpoint="plot",stage="png_encode"} 1' in registry.render()
+
+
+def test_render_entry_points_convert_and_downsample():
+    img, stages = plot_renderer.render_ultrasound(minutes(2000), np.arange(2000.0), DAY, "UTC", "Europe/Copenhagen",
+                                                  100, "minmax")
+    assert img.getvalue().startswith(b"\x89PNG") and len(stages) == 2
+    img, _ = plot_renderer.render_ldr(minutes(3), DAY, "UTC", "Europe/Copenhagen")
+    assert img.getvalue().startswith(b"\x89PNG")
+
+
+def test_render_workers_do_not_import_the_dashboard():
+    # A render worker unpickles render_ultrasound/render_ldr by importing plot_renderer, and only that
+    code = "import sys, plot_renderer; print(sorted({'app', 'db', 'flask', 'flask_mail', 'alerts'} & set(sys.modules)))"
+    flask_app = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.run([sys.executable, "-c", code], cwd=flask_app, capture_output=True, text=True, check=True)
+    assert output.stdout.strip() == "[]"
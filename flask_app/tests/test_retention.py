@@ -0,0 +1,138 @@
+import csv
+import gzip
+from datetime import date, datetime
+
+import retention
+import schema
+
+
+class FakeCursor:
+    """Answers the partition queries of retention.py from a list of partitions and p_future's rows."""
+
+    def __init__(self, partitions=(), future_rows=(), table_range=(None, None)):
+        self.partitions = list(partitions)  # [(name, bound date or None)]
+        self.future_rows = list(future_rows)  # Timestamps of the rows in p_future
+        self.table_range = table_range
+        self.executed = []
+        self._result = None
+
+    def execute(self, query, params=()):
+        self.executed.append(query)
+        if "INFORMATION_SCHEMA.PARTITIONS" in query:
+            self._result = [(name, "MAXVALUE" if bound is None else f"'{bound:%Y-%m-%d}'")
+                            for name, bound in self.partitions]
+        elif "PARTITION (p_future)" in query:
+            rows = [ts for ts in self.future_rows if ts < datetime.combine(params[0], datetime.min.time())]
+            self._result = [(min(rows) if rows else None, len(rows))]
+        elif query.startswith("SELECT MIN(timestamp), MAX(timestamp)"):
+            self._result = [self.table_range]
+        else:
+            self._result = None
+
+    def fetchall(self):
+        return self._result
+
+    def fetchone(self):
+        return self._result[0]
+
+    def alters(self):
+        return [query for query in self.executed if query.startswith("ALTER")]
+
+
+def test_daily_partitions():
+    assert retention.daily_partitions(date(2024, 5, 1), date(2024, 5, 2)) == [
+        ("p20240501", date(2024, 5, 2)), ("p20240502", date(2024, 5, 3))]
+    assert retention.daily_partitions(date(2024, 5, 2), date(2024, 5, 1)) == []
+
+
+def test_daily_partitions_fold_old_stray_days_into_the_first():
+    partitions = retention.daily_partitions(date(2000, 1, 1), date(2024, 5, 1))
+    assert len(partitions) == retention.MAX_BACKFILL_DAYS + 1
+    assert partitions[-1] == ("p20240501", date(2024, 5, 2))
+
+
+def test_ensure_partitions_splits_an_empty_future_partition():
+    cur = FakeCursor([("p20240501", date(2024, 5, 2)), ("p_future", None)])
+    created = retention.ensure_partitions(cur, "ldr_data", date(2024, 5, 1), days_ahead=2)
+    assert created == ["p20240502", "p20240503"]
+    assert cur.alters() == [
+        "ALTER TABLE ldr_data REORGANIZE PARTITION p_future INTO ("
+        "PARTITION p20240502 VALUES LESS THAN ('2024-05-03'), "
+        "PARTITION p20240503 VALUES LESS THAN ('2024-05-04'), "
+        "PARTITION p_future VALUES LESS THAN (MAXVALUE));"]
+
+
+def test_ensure_partitions_is_a_no_op_when_ahead():
+    cur = FakeCursor([("p20240510", date(2024, 5, 11)), ("p_future", None)])
+    assert retention.ensure_partitions(cur, "ldr_data", date(2024, 5, 1), days_ahead=2) == []
+    assert cur.alters() == []
+
+
+def test_ensure_partitions_gives_history_in_p_future_its_own_days():
+    # Partitioned without daily partitions: the history starts three days before today
+    cur = FakeCursor([("p_future", None)], future_rows=[datetime(2024, 4, 28, 12), datetime(2024, 4, 30, 8)])
+    created = retention.ensure_partitions(cur, "ldr_data", date(2024, 5, 1), days_ahead=1)
+    assert created == ["p20240428", "p20240429", "p20240430", "p20240501", "p20240502"]
+
+
+def test_ensure_partitions_after_a_long_outage():
+    # The last run created partitions up to 2024-05-03; rows of 2024-05-05 onwards sit in p_future
+    cur = FakeCursor([("p20240503", date(2024, 5, 4)), ("p_future", None)],
+                     future_rows=[datetime(2024, 5, 5), datetime(2024, 5, 20), datetime(2030, 1, 1)])
+    created = retention.ensure_partitions(cur, "ldr_data", date(2024, 5, 20), days_ahead=1)
+    assert created[0] == "p20240504" and created[-1] == "p20240521"
+    assert len(created) == 18
+
+
+def test_migration_partitions_existing_history_by_day():
+    cur = FakeCursor(table_range=(datetime(2024, 4, 29, 23), datetime(2024, 5, 1, 1)))
+    schema.partition_by_day("battery_data")(cur)
+    assert cur.alters() == [
+        "ALTER TABLE battery_data PARTITION BY RANGE COLUMNS(timestamp) ("
+        "PARTITION p20240429 VALUES LESS THAN ('2024-04-30'), "
+        "PARTITION p20240430 VALUES LESS THAN ('2024-05-01'), "
+        "PARTITION p20240501 VALUES LESS THAN ('2024-05-02'), "
+        "PARTITION p_future VALUES LESS THAN (MAXVALUE));"]
+
+
+def test_migration_partitions_an_empty_table():
+    cur = FakeCursor()
+    schema.partition_by_day("battery_data")(cur)
+    assert cur.alters() == ["ALTER TABLE battery_data PARTITION BY RANGE COLUMNS(timestamp) "
+                            "(PARTITION p_future VALUES LESS THAN (MAXVALUE));"]
+
+
+class ArchiveCursor:
+    def __init__(self, rows):
+        self.rows = list(rows)
+        self.description = [("id",), ("timestamp",), ("value",), ("device_id",), ("device_owner",)]
+        self.query = None
+
+    def execute(self, query, params=()):
+        self.query = query
+
+    def fetchmany(self, size):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+    def close(self):
+        pass
+
+
+class ArchiveConnection:
+    def __init__(self, cur):
+        self.cur = cur
+
+    def cursor(self):
+        return self.cur
+
+
+def test_archive_carries_the_device_owner(tmp_path):
+    cur = ArchiveCursor([(1, datetime(2024, 5, 1, 8), 1, 3, "Anna"), (2, datetime(2024, 5, 1, 9), 1, 4, None)])
+    path, rows = retention.archive_partition(ArchiveConnection(cur), "ldr_data", "p20240501", str(tmp_path))
+    assert "LEFT JOIN devices ON devices.id = ldr_data.device_id" in cur.query
+    assert rows == 2
+    with gzip.open(path, "rt", newline="") as archive:
+        lines = list(csv.reader(archive))
+    assert lines[0] == ["id", "timestamp", "value", "device_id", "device_owner"]
+    assert lines[1][-2:] == ["3", "Anna"]
@@ -0,0 +1,24 @@
+from datetime import datetime
+
+from rollups import ROLLUP_QUERIES, Rollups
+
+
+def test_rollup_rows_are_keyed_by_device_id():
+    rollups = Rollups()
+    at = datetime(2024, 5, 1, 9, 30, 15)
+    rollups.record("ultrasound_data", (at, 2.0, 7))
+    rollups.record("ultrasound_data", (at.replace(second=45), 4.0, 7))
+    rollups.record("ultrasound_data", (at, 1.0, 8))
+    rollups.record("ldr_data", (at, 1, 7))
+    rollups.record("battery_data", (at, 3.9, 80, 7))
+    rows = rollups.drain()
+    assert sorted(rows["ultrasound_rollup_minute"]) == [
+        (7, datetime(2024, 5, 1, 9, 30), 2.0, 4.0, 6.0, 2), (8, datetime(2024, 5, 1, 9, 30), 1.0, 1.0, 1.0, 1)]
+    assert rows["ldr_rollup_day"] == [(7, at.date(), 1)]
+    assert rows["battery_rollup_hour"] == [(7, datetime(2024, 5, 1, 9), at, 3.9, 80, 3.9, 80)]
+    assert not rollups.pending()
+
+
+def test_rollup_queries_write_device_ids():
+    for query in ROLLUP_QUERIES.values():
+        assert "(device_id, bucket," in query and "device_owner" not in query
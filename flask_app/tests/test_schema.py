@@ -0,0 +1,95 @@
+import re
+
+import pytest
+
+import schema
+
+
+class FakeCursor:
+    """Tracks the columns of each table through the column moves of migrations 6 and 7.
+
+    Statements that name a column the table does not have fail like MySQL's ER_BAD_FIELD_ERROR; `fail_on`
+    makes the first statement containing that text fail once, to interrupt a migration halfway.
+    """
+
+    def __init__(self, tables, fail_on=None):
+        self.columns = {table: {"device_owner"} for table in tables}
+        self.fail_on = fail_on
+        self.executed = []
+        self._result = None
+
+    def execute(self, query, params=()):
+        if "INFORMATION_SCHEMA.COLUMNS" in query:
+            table, column = params
+            self._result = (int(column in self.columns.get(table, ())),)
+            return
+        if self.fail_on and self.fail_on in query:
+            self.fail_on = None
+            raise ConnectionError("Lost connection to MySQL server during query")
+        self.executed.append(query)
+        table = re.search(r"(?:FROM|TABLE(?: IF NOT EXISTS)?|UPDATE) (\w+)", query).group(1)
+        columns = self.columns.setdefault(table, set())
+        if "device_owner" in query and table != "devices" and "device_owner" not in columns:
+            raise LookupError(f"Unknown column 'device_owner' in {table}")
+        if "ADD COLUMN device_id" in query:
+            columns.add("device_id")
+        if "DROP COLUMN device_owner" in query:
+            columns.discard("device_owner")
+
+    def fetchone(self):
+        return self._result
+
+
+def apply(cur, statements):
+    for statement in statements:
+        if callable(statement):
+            statement(cur)
+        else:
+            cur.execute(statement)
+
+
+def migration(version):
+    return next(statements for target, _, statements in schema.MIGRATIONS if target == version)
+
+
+RAW_TABLES = ("ldr_data", "ultrasound_data", "empty_box_status", "battery_data")
+ROLLUP_TABLES = ("ultrasound_rollup_minute", "ultrasound_rollup_hour", "ldr_rollup_hour", "ldr_rollup_day",
+                 "battery_rollup_hour")
+
+
+def test_migration_versions_are_ordered():
+    versions = [version for version, _, _ in schema.MIGRATIONS]
+    assert versions == sorted(set(versions))
+
+
+@pytest.mark.parametrize("version, tables", [(6, RAW_TABLES), (7, ROLLUP_TABLES)])
+def test_owner_columns_are_replaced_by_device_ids(version, tables):
+    cur = FakeCursor(tables)
+    apply(cur, migration(version))
+    for table in tables:
+        assert cur.columns[table] == {"device_id"}
+    assert sum(query.startswith("UPDATE") for query in cur.executed) == len(tables)
+
+
+@pytest.mark.parametrize("interrupted_at", ["UPDATE battery_data", "ALTER TABLE empty_box_status MODIFY",
+                                            "ALTER TABLE battery_data ADD COLUMN"])
+def test_migration_6_can_be_repeated_after_a_failure(interrupted_at):
+    cur = FakeCursor(RAW_TABLES, fail_on=interrupted_at)
+    with pytest.raises(ConnectionError):
+        apply(cur, migration(6))
+    done = list(cur.executed)
+    apply(cur, migration(6))
+    for table in RAW_TABLES:
+        assert cur.columns[table] == {"device_id"}
+    # Tables finished before the failure are left alone on the second run
+    finished = [table for table in RAW_TABLES if any(f"{table} MODIFY" in query for query in done)]
+    assert not any(table in query for table in finished for query in cur.executed[len(done):])
+
+
+def test_migration_6_is_a_no_op_when_applied():
+    cur = FakeCursor(RAW_TABLES)
+    apply(cur, migration(6))
+    applied = len(cur.executed)
+    apply(cur, migration(6))
+    # Only the CREATE TABLE IF NOT EXISTS runs again
+    assert len(cur.executed) == applied + 1
@@ -0,0 +1,116 @@
+import struct
+
+import pytest
+
+import wire_format
+from wire_format import MAX_SAMPLES, MAX_WINDOW, decode, encode, encode_batches, is_binary, split_windows
+
+BASE = 1_700_000_000
+
+SAMPLES = {
+    "esp32/ultrasound_data": ([[BASE, 12.34], [BASE + 5, 0.5]], [{"distance": 12.34}, {"distance": 0.5}]),
+    "esp32/empty_box_status": ([[BASE, "empty", 40.0], [BASE + 1, "full", 3.21]],
+                               [{"status": "empty", "distance": 40.0}, {"status": "full", "distance": 3.21}]),
+    "sensor/ldr": ([[BASE, 1], [BASE + 60, 0]], [{"value": 1}, {"value": 0}]),
+    "battery/percentage": ([[BASE, 3.712, 87]], [{"voltage": 3.712, "percentage": 87}]),
+}
+
+
+@pytest.mark.parametrize("topic", sorted(SAMPLES))
+def test_round_trip(topic):
+    samples, readings = SAMPLES[topic]
+    decoded_topic, device_id, decoded = decode(encode(topic, 7, samples))
+    assert decoded_topic == topic
+    assert device_id == 7
+    assert [epoch for epoch, _ in decoded] == [sample[0] for sample in samples]
+    assert [reading for _, reading in decoded] == readings
+
+
+def test_values_are_clamped_to_their_field():
+    _, _, decoded = decode(encode("esp32/ultrasound_data", 1, [[BASE, -3], [BASE, 10_000]]))
+    assert [reading["distance"] for _, reading in decoded] == [0, 0xFFFF / 100]
+
+
+@pytest.mark.parametrize("offset", [0, 1, MAX_WINDOW])
+def test_offsets_inside_the_window(offset):
+    _, _, decoded = decode(encode("sensor/ldr", 1, [[BASE, 1], [BASE + offset, 0]]))
+    assert decoded[1][0] == BASE + offset
+
+
+@pytest.mark.parametrize("offset", [-1, MAX_WINDOW + 1])
+def test_offsets_outside_the_window_are_rejected(offset):
+    with pytest.raises(ValueError, match="batch window"):
+        encode("sensor/ldr", 1, [[BASE, 1], [BASE + offset, 0]])
+
+
+def test_empty_batch_is_rejected():
+    with pytest.raises(ValueError):
+        encode("sensor/ldr", 1, [])
+
+
+def test_split_windows_keeps_a_window_together():
+    samples = [[BASE, 1], [BASE + 10, 0], [BASE + MAX_WINDOW, 1]]
+    assert split_windows(samples) == [samples]
+    assert split_windows([]) == []
+
+
+def test_split_windows_at_a_backward_clock_step():
+    # Unsynced boot clock, then NTP sets the real time, then the clock steps back before the window start
+    samples = [[10, 1], [20, 0], [BASE, 1], [BASE + 5, 0], [BASE - 1, 1]]
+    assert split_windows(samples) == [samples[:2], samples[2:4], samples[4:]]
+
+
+def test_split_windows_at_a_long_gap():
+    samples = [[BASE, 1], [BASE + MAX_WINDOW + 1, 0], [BASE + MAX_WINDOW + 2, 1]]
+    assert split_windows(samples) == [samples[:1], samples[1:]]
+
+
+def test_split_windows_at_the_sample_limit():
+    samples = [[BASE, 1]] * (MAX_SAMPLES + 1)
+    assert [len(window) for window in split_windows(samples)] == [MAX_SAMPLES, 1]
+
+
+def test_encode_batches_round_trips_across_a_clock_jump():
+    samples = [[10, 1], [BASE, 0], [BASE + 1, 1]]
+    payloads = encode_batches("sensor/ldr", 3, samples)
+    assert len(payloads) == 2
+    epochs = [epoch for payload in payloads for epoch, _ in decode(payload)[2]]
+    assert epochs == [10, BASE, BASE + 1]
+
+
+def test_decode_rejects_a_short_payload():
+    with pytest.raises(ValueError, match="shorter"):
+        decode(b"\xa5\x01")
+
+
+def test_decode_rejects_a_foreign_payload():
+    with pytest.raises(ValueError, match="Not a binary"):
+        decode(b"{" * wire_format.HEADER_SIZE)
+
+
+def test_decode_rejects_an_unknown_version():
+    payload = bytearray(encode("sensor/ldr", 1, [[BASE, 1]]))
+    payload[1] = 99
+    with pytest.raises(ValueError, match="version 99"):
+        decode(bytes(payload))
+
+
+def test_decode_rejects_an_unknown_topic():
+    payload = struct.pack(wire_format.HEADER, wire_format.MAGIC, wire_format.VERSION, 99, 1, 0, BASE)
+    with pytest.raises(ValueError, match="topic code 99"):
+        decode(payload)
+
+
+def test_decode_rejects_a_truncated_payload():
+    payload = encode("sensor/ldr", 1, [[BASE, 1], [BASE + 1, 0]])
+    with pytest.raises(ValueError, match="length"):
+        decode(payload[:-1])
+
+
+def test_is_binary():
+    payload = encode("sensor/ldr", 1, [[BASE, 1]])
+    assert is_binary(payload)
+    assert not is_binary(b'{"value": 1}')
+    assert not is_binary(b"")
+    assert is_binary(b"{", wire_format.CONTENT_TYPE + "; v=1")
+    assert not is_binary(payload, wire_format.JSON_CONTENT_TYPE)
@@ -0,0 +1,130 @@
+# Compact binary payload for the sensor topics, shared by final_pub.py (MicroPython) and final_sub.py.
+#
+# Layout (little endian), version 1:
+#   header: magic (B) = 0xA5, version (B), topic code (B), device id (H), sample count (H), base epoch (I)
+#   sample: seconds after base epoch (H) followed by the topic's scaled integer values
+#
+# One payload therefore covers a window of MAX_WINDOW seconds from its first sample, with samples in time
+# order, and at most MAX_SAMPLES samples. encode() enforces that; encode_batches() splits longer batches,
+# or batches across a clock step, into several payloads.
+#
+# JSON payloads always start with "{", so the magic byte tells the two formats apart when the broker
+# does not carry an MQTT 5 content type.
+try:
+    import ustruct as struct
+except ImportError:
+    import struct
+
+MAGIC = 0xA5
+VERSION = 1
+SUPPORTED_VERSIONS = (1,)
+CONTENT_TYPE = "application/vnd.iot3.sensor"
+JSON_CONTENT_TYPE = "application/json"
+
+HEADER = "<BBBHHI"
+HEADER_SIZE = struct.calcsize(HEADER)
+MAX_WINDOW = 0xFFFF  # Seconds from the first sample of a payload to its last
+MAX_SAMPLES = 0xFFFF
+
+# Box status codes
+STATUS_CODES = {"full": 0, "empty": 1}
+STATUS_NAMES = {0: "full", 1: "empty"}
+
+# topic -> (code, sample format after the time offset, field names, scale per field)
+# A scale of None marks the box status, which is sent as a status code.
+TOPICS = {
+    "esp32/ultrasound_data": (1, "<HH", ("distance",), (100,)),  # Distance in 1/100 cm
+    "esp32/empty_box_status": (2, "<HBH", ("status", "distance"), (None, 100)),
+    "sensor/ldr": (3, "<HB", ("value",), (1,)),
+    "battery/percentage": (4, "<HHB", ("voltage", "percentage"), (1000, 1)),  # Voltage in mV
+}
+TOPIC_NAMES = {spec[0]: topic for topic, spec in TOPICS.items()}
+
+
+def _scale(value, scale, limit):
+    if scale is None:
+        return STATUS_CODES[value]
+    return max(0, min(limit, int(round(value * scale))))
+
+
+def encode(topic, device_id, samples):
+    """Encode [[epoch, value...], ...] samples (values in the topic's field order) into one payload.
+
+    Every sample must lie within MAX_WINDOW seconds at or after the first one (ValueError otherwise);
+    use encode_batches() for samples that may not.
+    """
+    code, sample_format, _, scales = TOPICS[topic]
+    if not 0 < len(samples) <= MAX_SAMPLES:
+        raise ValueError("A payload carries 1 to %d samples" % MAX_SAMPLES)
+    base = samples[0][0]
+    parts = [struct.pack(HEADER, MAGIC, VERSION, code, device_id, len(samples), base)]
+    limits = [0xFFFF if char == "H" else 0xFF for char in sample_format[2:]]
+    for sample in samples:
+        offset = sample[0] - base
+        if not 0 <= offset <= MAX_WINDOW:
+            raise ValueError("Sample time outside the batch window")
+        values = [_scale(value, scale, limit) for value, scale, limit in zip(sample[1:], scales, limits)]
+        parts.append(struct.pack(sample_format, offset, *values))
+    return b"".join(parts)
+
+
+def split_windows(samples):
+    """Split samples into runs that encode() accepts, keeping their order.
+
+    A new run starts at a sample before the run's first sample (the clock stepped back, for example
+    when NTP synced after an unsynced boot), more than MAX_WINDOW seconds after it, or after MAX_SAMPLES.
+    """
+    windows = []
+    window = None
+    for sample in samples:
+        if (window is None or not 0 <= sample[0] - window[0][0] <= MAX_WINDOW
+                or len(window) >= MAX_SAMPLES):
+            window = []
+            windows.append(window)
+        window.append(sample)
+    return windows
+
+
+def encode_batches(topic, device_id, samples):
+    """Encode any list of samples into as few payloads as the batch window allows."""
+    return [encode(topic, device_id, window) for window in split_windows(samples)]
+
+
+def is_binary(payload, content_type=None):
+    """Negotiate the payload format: the MQTT 5 content type if present, otherwise the magic byte."""
+    if content_type:
+        return content_type.split(";")[0].strip() == CONTENT_TYPE
+    return len(payload) > 0 and payload[0] == MAGIC
+
+
+def decode(payload):
+    """Decode a binary payload into (topic, device id, [(epoch, {field: value}), ...])."""
+    if len(payload) < HEADER_SIZE:
+        raise ValueError("Binary payload shorter than its header")
+    magic, version, code, device_id, count, base = struct.unpack_from(HEADER, payload, 0)
+    if magic != MAGIC:
+        raise ValueError("Not a binary sensor payload")
+    if version not in SUPPORTED_VERSIONS:
+        raise ValueError("Unsupported binary payload version %d" % version)
+    topic = TOPIC_NAMES.get(code)
+    if topic is None:
+        raise ValueError("Unknown topic code %d" % code)
+
+    _, sample_format, fields, scales = TOPICS[topic]
+    size = struct.calcsize(sample_format)
+    if len(payload) != HEADER_SIZE + count * size:
+        raise ValueError("Binary payload length does not match its sample count")
+
+    samples = []
+    for i in range(count):
+        unpacked = struct.unpack_from(sample_format, payload, HEADER_SIZE + i * size)
+        reading = {}
+        for field, scale, value in zip(fields, scales, unpacked[1:]):
+            if scale is None:
+                reading[field] = STATUS_NAMES.get(value, "unknown")
+            elif scale == 1:
+                reading[field] = value
+            else:
+                reading[field] = value / scale
+        samples.append((base + unpacked[0], reading))
+    return topic, device_id, samples